@@ -1,11 +1,24 @@
 # app_context.py
 import logging
+import os
 from concurrent.futures import ProcessPoolExecutor
 
+import sharding
+
 logger = logging.getLogger(__name__)
 
 _process_pool_executor = None
 
+def _preload_face_recognition():
+    """Инициализатор процесса пула: загружает face_recognition (dlib, модели) до первой задачи."""
+    try:
+        import face_recognition  # noqa: F401
+    except Exception as e:
+        logger.warning(f"Не удалось заранее загрузить face_recognition в процессе пула: {e}")
+
+def _noop():
+    return None
+
 def get_process_pool_executor() -> ProcessPoolExecutor:
     """
     Возвращает существующий пул процессов или создает новый, если его еще нет.
@@ -14,10 +27,20 @@ def get_process_pool_executor() -> ProcessPoolExecutor:
     global _process_pool_executor
     if _process_pool_executor is None:
         logger.info("Первый запрос на распознавание лиц. Создание пула процессов...")
-        _process_pool_executor = ProcessPoolExecutor()
+        # При шардировании ядра делятся между воркерами, иначе процессов будет больше, чем ядер
+        shard = sharding.current_shard()
+        max_workers = max(1, (os.cpu_count() or 1) // shard[1]) if shard else None
+        _process_pool_executor = ProcessPoolExecutor(max_workers=max_workers, initializer=_preload_face_recognition)
         logger.info("Пул процессов успешно создан.")
     return _process_pool_executor
 
+def warm_up_process_pool():
+    """
+    Создает пул и запускает его процессы в фоне, не дожидаясь их: face_recognition загружается
+    в воркерах параллельно с работой бота, и первый чек-ин не ждет загрузки моделей.
+    """
+    get_process_pool_executor().submit(_noop)
+
 def shutdown_executor():
     """Корректно закрывает пул процессов, если он был создан."""
     global _process_pool_executor
@@ -0,0 +1,67 @@
+# bench_report_grid.py
+"""
+Микро-бенчмарк построения матрицы посещаемости на синтетических данных.
+Запуск: python bench_report_grid.py [сотрудников] [дней]
+По умолчанию 5000 сотрудников x 366 дней.
+"""
+import random
+import sys
+import time as timer
+from datetime import date, timedelta
+
+import report_grid
+
+
+def make_synthetic_data(num_employees: int, num_days: int, seed: int = 42):
+    rng = random.Random(seed)
+    start_date = date(2024, 1, 1)
+    end_date = start_date + timedelta(days=num_days - 1)
+    employees = [(100000 + i, f"Сотрудник {i:05d}") for i in range(num_employees)]
+
+    schedule_rows = []
+    for emp_id, _ in employees:
+        # Две версии графика: исходная и смена графика в середине периода
+        for effective_date in (start_date - timedelta(days=30), start_date + timedelta(days=rng.randint(0, num_days - 1))):
+            for day_of_week in range(7):
+                schedule_rows.append((emp_id, day_of_week, effective_date, day_of_week < 5 or rng.random() < 0.1))
+
+    flags = [report_grid.FLAG_SUCCESS, report_grid.FLAG_LATE, report_grid.FLAG_SUCCESS | report_grid.FLAG_APPROVED_LEAVE,
+             report_grid.FLAG_LATE | report_grid.FLAG_ABSENT_INCOMPLETE]
+    checkin_rows = []
+    for emp_id, _ in employees:
+        for offset in range(num_days):
+            if rng.random() < 0.65:
+                checkin_rows.append((emp_id, offset, rng.choice(flags)))
+
+    leave_rows = []
+    for emp_id, _ in employees:
+        leave_start = start_date + timedelta(days=rng.randint(0, num_days - 1))
+        leave_rows.append((emp_id, leave_start, leave_start + timedelta(days=rng.randint(0, 14)), rng.choice(['VACATION', 'SICK_LEAVE'])))
+
+    holidays = {start_date + timedelta(days=rng.randint(0, num_days - 1)) for _ in range(12)}
+    return employees, start_date, end_date, schedule_rows, checkin_rows, leave_rows, holidays
+
+
+def main():
+    num_employees = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    num_days = int(sys.argv[2]) if len(sys.argv) > 2 else 366
+
+    print(f"Генерация данных: {num_employees} сотрудников x {num_days} дней...")
+    employees, start_date, end_date, schedule_rows, checkin_rows, leave_rows, holidays = make_synthetic_data(num_employees, num_days)
+    today = end_date
+    print(f"Версий графиков: {len(schedule_rows)}, дней с чекинами: {len(checkin_rows)}, отсутствий: {len(leave_rows)}")
+
+    started = timer.perf_counter()
+    grid = report_grid.build_attendance_grid(employees, start_date, end_date, today, schedule_rows, checkin_rows, leave_rows, holidays)
+    built = timer.perf_counter()
+    rows_count = sum(1 for _ in grid.rows())
+    finished = timer.perf_counter()
+
+    cells = num_employees * num_days
+    print(f"Построение сетки: {(built - started) * 1000:.1f} мс")
+    print(f"Подписи статусов: {(finished - built) * 1000:.1f} мс ({rows_count} строк)")
+    print(f"Итого: {(finished - started) * 1000:.1f} мс, {cells / (finished - started) / 1e6:.2f} млн ячеек/с")
+
+
+if __name__ == "__main__":
+    main()
@@ -32,6 +32,78 @@ DB_HOST = os.getenv("DB_HOST")
 if not DB_HOST:
     raise ValueError("Не найден DB_HOST в файле .env.")
 PERSISTENCE_FILE = "bot_persistence.pickle"
+PERSISTENCE_BACKEND = os.getenv("PERSISTENCE_BACKEND", "postgres")  # "postgres" или "pickle" (старый файл)
+PERSISTENCE_FLUSH_DELAY_SECONDS = 2     # Пачка изменений состояния пишется в БД не чаще этого интервала
+PERSISTENCE_TTL_DAYS = 30               # Состояния пользователей/диалогов старше этого срока удаляются
+PERSISTENCE_TTL_CLEANUP_INTERVAL_SECONDS = 6 * 3600  # Как часто удалять устаревшие состояния (и при запуске)
+PERSISTENCE_UPDATE_INTERVAL_SECONDS = 60  # Как часто PTB передает состояние в хранилище (bot_data - целиком)
+
+# --- Исходящие сообщения (диспетчер с ограничением скорости) ---
+DISPATCHER_WORKERS = 8                  # Параллельных отправок
+DISPATCHER_GLOBAL_RATE = 25             # Сообщений в секунду на весь бот (лимит Telegram ~30)
+DISPATCHER_PER_CHAT_INTERVAL = 1.0      # Секунд между сообщениями в один чат
+DISPATCHER_MAX_RETRIES = 3              # Повторов при сетевых ошибках
+DISPATCHER_BACKOFF_SECONDS = 1.0        # Начальная задержка повтора (удваивается)
+CONCURRENT_UPDATES = int(os.getenv("CONCURRENT_UPDATES", "16"))  # Апдейтов разных пользователей одновременно
+# Сколько апдейтов принимается в обработку (вместе с ожидающими своей очереди у того же пользователя)
+MAX_PENDING_UPDATES = int(os.getenv("MAX_PENDING_UPDATES", "256"))
+
+# --- Получение апдейтов ---
+# polling - опрос Telegram; webhook - отдельный ASGI-сервер для вебхука; webapp - бот работает внутри веб-панели
+UPDATE_MODE = os.getenv("UPDATE_MODE", "polling")
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")                      # Публичный адрес, например https://example.com
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/telegram/webhook")
+WEBHOOK_SECRET_TOKEN = os.getenv("WEBHOOK_SECRET_TOKEN")    # Проверяется в заголовке X-Telegram-Bot-Api-Secret-Token
+WEBHOOK_LISTEN_HOST = os.getenv("WEBHOOK_LISTEN_HOST", "127.0.0.1")
+WEBHOOK_LISTEN_PORT = int(os.getenv("WEBHOOK_LISTEN_PORT", "8443"))
+# Каталог Unix-сокетов воркеров при шардированном запуске (sharding.py)
+SHARD_SOCKET_DIR = os.getenv("SHARD_SOCKET_DIR", "/tmp")
+# Адрес Bot API (для локального тестового сервера fake_bot_api.py), например http://127.0.0.1:8081/bot
+BOT_API_BASE_URL = os.getenv("BOT_API_BASE_URL")
+REPORT_MAX_RANGE_DAYS = 5 * 366  # Максимальная длина периода для отчета-матрицы
+REPORT_CACHE_MAX_ENTRIES = 64           # Кэш отчетов за закрытые периоды: максимум записей
+REPORT_CACHE_MAX_WEIGHT = 20_000_000    # ... и суммарный "вес" (символы/ячейки)
+HOLIDAY_CACHE_TTL_SECONDS = 600         # Как часто перечитывать календарь праздников из БД
+EMPLOYEE_CACHE_TTL_SECONDS = 300        # Как часто перечитывать список активных сотрудников
+EMPLOYEE_PAGE_SIZE = 50                 # Сотрудников на странице списка в веб-панели
+EMPLOYEE_COUNT_LIMIT = 1000             # Выше этого числа совпадений поиска счетчик показывается как "1000+"
+# Аренда задачи планировщика между репликами бота: через столько секунд после падения лидера задачу подхватит другая
+JOB_LEASE_SECONDS = int(os.getenv("JOB_LEASE_SECONDS", "120"))
+JOB_RUNS_RETENTION_DAYS = 14            # Сколько дней хранить журнал запусков задач (job_runs)
+# Сколько секунд браузер держит отчет за закрытый период без перепроверки (остальное - только через ETag)
+HTTP_CACHE_CLOSED_PERIOD_MAX_AGE = 600
+# Живая лента дашборда (SSE): сколько последних событий хранить для догона после переподключения,
+# сколько непрочитанных событий допускается на клиента и как часто слать keep-alive комментарий
+LIVE_EVENTS_BUFFER = 1000
+LIVE_EVENTS_CLIENT_QUEUE = 256
+LIVE_EVENTS_HEARTBEAT_SECONDS = 15
+# Сессии веб-панели: initData проверяется один раз, дальше запросы несут подписанный токен (webapp_auth.py)
+WEBAPP_SESSION_TTL_SECONDS = 3600       # Срок жизни токена; по истечении панель получает новый по тому же initData
+WEBAPP_INIT_DATA_MAX_AGE_SECONDS = 86400  # initData старше этого (по auth_date) не принимается
+WEBAPP_INIT_DATA_CACHE_SIZE = 256       # Сколько недавно проверенных initData помнить без пересчета HMAC
+WEBAPP_URL_TOKEN_TTL_SECONDS = 60       # Одноразовый по назначению токен в URL (EventSource, скачивание) - только для одного пути
+BATCH_MAX_ITEMS = 1000  # Максимум элементов в одном пакетном запросе веб-панели
+# Метрики (metrics.py): внутренние HTTP-листенеры, не публичный сервер веб-панели. Порт процесса бота
+# (0 - выключен; воркер шарда i слушает порт + i) и порт процесса веб-панели (вместе со встроенным ботом)
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "9105"))
+WEBAPP_METRICS_PORT = int(os.getenv("WEBAPP_METRICS_PORT", "9104"))
+METRICS_MAX_SERIES = 200  # Максимум серий (комбинаций меток) одной метрики
+# Трассировка чекина (tracing.py): сколько последних спанов держать в памяти процесса и куда их выгружать -
+# в JSONL-файл и/или OTLP/HTTP-коллектор (например, http://127.0.0.1:4318/v1/traces); пустая строка - не выгружать
+TRACE_ENABLED = os.getenv("TRACE_ENABLED", "1") != "0"
+TRACE_BUFFER_SIZE = 5000
+TRACE_EXPORT_FILE = os.getenv("TRACE_EXPORT_FILE", "")
+TRACE_OTLP_ENDPOINT = os.getenv("TRACE_OTLP_ENDPOINT", "")
+TRACE_EXPORT_INTERVAL_SECONDS = 10
+# Профиль SQL-запросов (query_profiler.py): порог медленного запроса, доля медленных запросов, для которых
+# в фоне снимается EXPLAIN (ANALYZE, BUFFERS), и не чаще какого интервала это делается для одного запроса
+DB_SLOW_QUERY_MS = int(os.getenv("DB_SLOW_QUERY_MS", "200"))
+DB_SLOW_QUERY_EXPLAIN_SAMPLE = float(os.getenv("DB_SLOW_QUERY_EXPLAIN_SAMPLE", "0.2"))
+DB_SLOW_QUERY_EXPLAIN_INTERVAL_SECONDS = 300
+DB_QUERY_STATS_MAX_ENTRIES = 500        # Максимум пар (место вызова, запрос) в статистике
+# Канал LISTEN/NOTIFY шины инвалидации кэшей между ботом и веб-панелью (пустая строка - только локально)
+INVALIDATION_CHANNEL = os.getenv("INVALIDATION_CHANNEL", "cache_invalidation")
 
 # --- Состояния для диалогов ---
 CHOOSE_ACTION, AWAITING_PHOTO, AWAITING_LOCATION, REGISTER_FACE = range(4)
@@ -68,6 +140,7 @@ AWAITING_NEW_FACE_PHOTO = 27 # <-- ИЗМЕНЕНИЕ: Сдвигаем на 1,
 # --- КОНЕЦ НОВЫХ СОСТОЯНИЙ ---
 AWAITING_SCHEDULE_FILE = 32
 AWAITING_ADD_EMPLOYEES_FILE = 33
+AWAITING_SCHEDULE_CONFIRM = 34
 
 # --- Тексты кнопок ---
 BUTTON_ARRIVAL = "✅ Приход"
@@ -92,6 +165,8 @@ BUTTON_LEAVE_TYPE_SICK = "Больничный"
 BUTTON_CANCEL_LEAVE = "🚫 Отменить отсутствие" 
 BUTTON_UPDATE_PHOTO = "📸 Обновить фото" 
 BUTTON_MANAGE_HOLIDAYS = "🎉 Управление праздниками"
+BUTTON_APPLY_SCHEDULES = "✅ Применить изменения"
+BUTTON_CANCEL_SCHEDULES = "❌ Не применять"
 
 # --- Другие константы ---
 LIVENESS_ACTIONS = ["улыбнитесь в камеру", "покажите на камеру большой палец 👍", "покажите на камеру знак 'мир' двумя пальцами ✌️"]
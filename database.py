@@ -1,60 +1,30 @@
 # database.py
+from __future__ import annotations
+
+import contextlib
 import logging
 import asyncpg
-import numpy as np
 import calendar
+import report_grid
+import metrics
+import tracing
+from query_profiler import ProfiledConnection, query_profiler
+from report_cache import report_cache
+from holiday_calendar import holiday_calendar
+from employee_cache import employee_cache
+from invalidation_bus import invalidation_bus, InvalidationMessage, EMPLOYEE, SCHEDULE, LEAVE, HOLIDAY, CHECK_IN
 from datetime import datetime, date, time, timedelta
 from collections import defaultdict
 from zoneinfo import ZoneInfo
-from config import DB_USER, DB_PASSWORD, DB_NAME, DB_HOST, LOCAL_TIMEZONE
+from typing import TYPE_CHECKING
+from config import DB_USER, DB_PASSWORD, DB_NAME, DB_HOST, LOCAL_TIMEZONE, EMPLOYEE_COUNT_LIMIT
 
-logger = logging.getLogger(__name__)
+if TYPE_CHECKING:
+    import numpy as np  # Только для аннотаций: NumPy грузится при первом построении отчета (report_grid)
 
-# --- Вспомогательная функция для создания комбинированного статуса ---
-def _build_composite_status(status_list: list, is_work_day: bool, is_past_date: bool, is_holiday: bool) -> str:
-    """
-    Создает детализированную строку статуса на основе всех событий за день.
-    """
-    if is_holiday: # <-- НОВАЯ ПРОВЕРКА
-        return "Праздник"
-    if not is_work_day:
-        return "Выходной"
-
-    # Статусы, которые определяют весь день, имеют наивысший приоритет.
-    if 'VACATION' in status_list:
-        return 'Отпуск'
-    if 'SICK_LEAVE' in status_list:
-        return 'Больничный'
-
-    # Определяем статус прихода
-    arrival_status = ""
-    if 'LATE' in status_list:
-        arrival_status = "Опоздал"
-    elif 'SUCCESS' in status_list:
-        arrival_status = "Вовремя"
-    
-    # Если сотрудник не пришел на работу
-    if not arrival_status:
-        if is_past_date:
-            return "Пропустил"  # День прошел, а сотрудника не было
-        else:
-            return "—"  # Будущий рабочий день
-
-    # Определяем статус ухода или завершения дня
-    departure_status = ""
-    if 'APPROVED_LEAVE' in status_list:
-        departure_status = "Отпросился"
-    # Статус "не завершил день" добавляется, если не было явного ухода пораньше
-    elif 'ABSENT_INCOMPLETE' in status_list:
-        departure_status = "Не завершил день"
-
-    # Собираем итоговую строку
-    final_parts = [arrival_status]
-    if departure_status:
-        final_parts.append(departure_status)
-        
-    return ", ".join(final_parts)
+logger = logging.getLogger(__name__)
 
+CHECKIN_ATTEMPTS = metrics.registry.counter("checkin_attempts_total", "Записанные попытки чекина", ("type", "status"))
 
 async def get_db_connection():
     """
@@ -65,9 +35,12 @@ async def get_db_connection():
         user=DB_USER,
         password=DB_PASSWORD,
         database=DB_NAME,
-        host=DB_HOST
+        host=DB_HOST,
+        connection_class=ProfiledConnection  # Учет времени каждого запроса (query_profiler, /db_stats)
     )
 
+query_profiler.connect = get_db_connection  # Отдельное соединение для EXPLAIN медленных запросов
+
 async def init_db():
     """Инициализирует таблицы в базе данных PostgreSQL с правильными типами данных."""
     conn = await get_db_connection()
@@ -125,19 +98,80 @@ async def init_db():
             );
         """)
         # --- КОНЕЦ НОВОЙ ТАБЛИЦЫ ---
+        # --- НОВЫЙ БЛОК: индексы для постраничного списка и поиска сотрудников ---
+        await conn.execute("""
+            CREATE INDEX IF NOT EXISTS idx_employees_active_name
+            ON employees (full_name, telegram_id) WHERE is_active = TRUE
+        """)
+        try:
+            await conn.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+            await conn.execute("""
+                CREATE INDEX IF NOT EXISTS idx_employees_name_trgm
+                ON employees USING gin (full_name gin_trgm_ops) WHERE is_active = TRUE
+            """)
+        except asyncpg.PostgresError as e:
+            # Без прав на расширение поиск работает, но полным просмотром таблицы
+            logger.warning(f"Не удалось создать триграммный индекс для поиска сотрудников: {e}")
+        # --- КОНЕЦ НОВОГО БЛОКА ---
+        # Лог сотрудника читается страницами по (timestamp, id) от новых событий к старым
+        await conn.execute("""
+            CREATE INDEX IF NOT EXISTS idx_check_ins_employee_ts
+            ON check_ins (employee_telegram_id, timestamp DESC, id DESC)
+        """)
+        # --- НОВЫЙ БЛОК: аренды и журнал запусков задач планировщика (несколько реплик бота) ---
+        await conn.execute("""
+            CREATE TABLE IF NOT EXISTS job_leases (
+                job_name TEXT PRIMARY KEY,
+                holder TEXT NOT NULL,
+                acquired_at TIMESTAMPTZ NOT NULL,
+                expires_at TIMESTAMPTZ NOT NULL
+            );
+        """)
+        await conn.execute("""
+            CREATE TABLE IF NOT EXISTS job_runs (
+                id BIGSERIAL PRIMARY KEY,
+                job_name TEXT NOT NULL,
+                scheduled_for TIMESTAMPTZ NOT NULL,
+                holder TEXT NOT NULL,
+                started_at TIMESTAMPTZ NOT NULL,
+                finished_at TIMESTAMPTZ,
+                status TEXT NOT NULL, -- 'running', 'ok' или 'error'
+                error TEXT,
+                UNIQUE(job_name, scheduled_for)
+            );
+        """)
+        # --- КОНЕЦ НОВОГО БЛОКА ---
         logger.info("База данных PostgreSQL инициализирована.")
     finally:
         await conn.close()
 
 # --- НОВЫЕ ФУНКЦИИ ДЛЯ РАБОТЫ С ПРАЗДНИКАМИ ---
+async def load_holiday_calendar():
+    """Загружает все праздники в календарь в памяти (при старте и по истечении TTL)."""
+    conn = await get_db_connection()
+    try:
+        rows = await conn.fetch("SELECT holiday_date, holiday_name FROM holidays")
+        holiday_calendar.replace((row['holiday_date'], row['holiday_name']) for row in rows)
+        logger.info(f"Календарь праздников загружен: {len(rows)} дат.")
+    finally:
+        await conn.close()
+
+async def _get_holiday_calendar():
+    """Возвращает актуальный календарь праздников, при необходимости перечитывая его из БД."""
+    if holiday_calendar.is_stale():
+        await load_holiday_calendar()
+    return holiday_calendar
+
 async def add_holiday(holiday_date: date, holiday_name: str):
     """Добавляет новый праздничный день в БД."""
     conn = await get_db_connection()
     try:
-        await conn.execute(
-            "INSERT INTO holidays (holiday_date, holiday_name) VALUES ($1, $2) ON CONFLICT (holiday_date) DO UPDATE SET holiday_name = $2",
-            holiday_date, holiday_name
-        )
+        async with invalidation_bus.transaction(conn) as changes:
+            await conn.execute(
+                "INSERT INTO holidays (holiday_date, holiday_name) VALUES ($1, $2) ON CONFLICT (holiday_date) DO UPDATE SET holiday_name = $2",
+                holiday_date, holiday_name
+            )
+            changes.append(InvalidationMessage(HOLIDAY, start_date=holiday_date, end_date=holiday_date, name=holiday_name))
     finally:
         await conn.close()
 
@@ -145,27 +179,21 @@ async def delete_holiday(holiday_date: date):
     """Удаляет праздничный день из БД."""
     conn = await get_db_connection()
     try:
-        await conn.execute("DELETE FROM holidays WHERE holiday_date = $1", holiday_date)
+        async with invalidation_bus.transaction(conn) as changes:
+            await conn.execute("DELETE FROM holidays WHERE holiday_date = $1", holiday_date)
+            changes.append(InvalidationMessage(HOLIDAY, start_date=holiday_date, end_date=holiday_date))
     finally:
         await conn.close()
 
 async def get_holidays_for_year(year: int) -> list[dict]:
-    """Получает все праздники за указанный год."""
-    conn = await get_db_connection()
-    try:
-        rows = await conn.fetch("SELECT holiday_date, holiday_name FROM holidays WHERE EXTRACT(YEAR FROM holiday_date) = $1 ORDER BY holiday_date", year)
-        return [dict(row) for row in rows]
-    finally:
-        await conn.close()
+    """Получает все праздники за указанный год (из календаря в памяти)."""
+    calendar_cache = await _get_holiday_calendar()
+    return calendar_cache.for_year(year)
 
 async def is_holiday(target_date: date) -> bool:
-    """Проверяет, является ли указанная дата праздником."""
-    conn = await get_db_connection()
-    try:
-        result = await conn.fetchval("SELECT 1 FROM holidays WHERE holiday_date = $1", target_date)
-        return result is not None
-    finally:
-        await conn.close()
+    """Проверяет, является ли указанная дата праздником (без запроса к БД, пока календарь актуален)."""
+    calendar_cache = await _get_holiday_calendar()
+    return target_date in calendar_cache
 # --- КОНЕЦ НОВЫХ ФУНКЦИЙ ---
 
 async def get_employee_data(telegram_id, include_inactive=False):
@@ -209,52 +237,95 @@ async def get_employee_with_schedule(telegram_id: int) -> dict | None:
     finally:
         await conn.close()
 
-async def get_all_active_employees(search_query: str = None, sort_by: str = 'full_name', sort_order: str = 'asc') -> list[dict]:
+async def get_active_employees_page(search_query: str = None, sort_by: str = 'full_name', sort_order: str = 'asc',
+                                    limit: int = 50, after: tuple | None = None) -> dict:
     """
-    Получает список всех активных сотрудников из PostgreSQL с возможностью поиска и сортировки.
+    Одна страница активных сотрудников с keyset-пагинацией: сортировка по (full_name, telegram_id)
+    или по telegram_id, after - ключ последней строки предыдущей страницы. Каждая страница читается
+    по индексу за одно и то же время, независимо от ее номера.
+    Возвращает {'items', 'next_after', 'total', 'total_is_estimate'}; total считается только для
+    первой страницы: без поиска - из кэша активных сотрудников, с поиском - с ограничением сверху.
     """
     # Белый список колонок для сортировки, чтобы предотвратить SQL-инъекции
-    allowed_sort_columns = ['telegram_id', 'full_name']
-    if sort_by not in allowed_sort_columns:
+    if sort_by not in ('telegram_id', 'full_name'):
         sort_by = 'full_name'  # Значение по умолчанию
+    descending = sort_order.lower() == 'desc'
+    direction, comparison = ('DESC', '<') if descending else ('ASC', '>')
+    order_columns = ['full_name', 'telegram_id'] if sort_by == 'full_name' else ['telegram_id']
 
-    # Белый список для направления сортировки
-    sort_order = 'DESC' if sort_order.lower() == 'desc' else 'ASC'
-
+    conditions = ["is_active = TRUE"]
     query_params = []
-    # Базовый запрос
-    sql = "SELECT telegram_id, full_name, is_active FROM employees WHERE is_active = TRUE"
-
-    # Если есть поисковый запрос, добавляем условие WHERE
-    # ILIKE - это регистронезависимый поиск в PostgreSQL
     if search_query:
-        sql += " AND full_name ILIKE $1"
-        query_params.append(f"%{search_query}%")
-
-    # Добавляем сортировку
-    sql += f" ORDER BY {sort_by} {sort_order}"
+        # ILIKE по триграммному индексу; % и _ из запроса ищутся как обычные символы
+        escaped = search_query.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+        query_params.append(f"%{escaped}%")
+        conditions.append(f"full_name ILIKE ${len(query_params)}")
+    if after is not None:
+        placeholders = []
+        for value in after[:len(order_columns)]:
+            query_params.append(value)
+            placeholders.append(f"${len(query_params)}")
+        conditions.append(f"({', '.join(order_columns)}) {comparison} ({', '.join(placeholders)})")
+    query_params.append(limit + 1)  # Лишняя строка показывает, есть ли следующая страница
+
+    sql = f"""
+        SELECT telegram_id, full_name, is_active FROM employees
+        WHERE {' AND '.join(conditions)}
+        ORDER BY {', '.join(f'{column} {direction}' for column in order_columns)}
+        LIMIT ${len(query_params)}
+    """
     conn = await get_db_connection()
     try:
-        # Выполняем запрос с динамически собранными параметрами
         rows = await conn.fetch(sql, *query_params)
-        return [dict(row) for row in rows]
+        total, total_is_estimate = None, False
+        if after is None:
+            if not search_query:
+                if employee_cache.is_stale():
+                    await load_employee_cache()
+                total = len(employee_cache)
+            else:
+                # Считаем не больше EMPLOYEE_COUNT_LIMIT совпадений: дальше точное число не нужно
+                total = await conn.fetchval(
+                    "SELECT count(*) FROM (SELECT 1 FROM employees WHERE is_active = TRUE AND full_name ILIKE $1 LIMIT $2) AS matched",
+                    query_params[0], EMPLOYEE_COUNT_LIMIT + 1
+                )
+                if total > EMPLOYEE_COUNT_LIMIT:
+                    total, total_is_estimate = EMPLOYEE_COUNT_LIMIT, True
     finally:
         await conn.close()
 
+    has_more = len(rows) > limit
+    items = [dict(row) for row in rows[:limit]]
+    next_after = None
+    if has_more:
+        last = items[-1]
+        next_after = (last['full_name'], last['telegram_id']) if sort_by == 'full_name' else (last['telegram_id'],)
+    return {'items': items, 'next_after': next_after, 'total': total, 'total_is_estimate': total_is_estimate}
+
 async def is_employee_active(telegram_id: int) -> bool:
-    """Проверяет, активен ли сотрудник в базе данных PostgreSQL."""
+    """Проверяет, активен ли сотрудник (по кэшу в памяти; БД читается только при устаревании кэша)."""
+    if employee_cache.is_stale():
+        await load_employee_cache()
+    return telegram_id in employee_cache
+
+# --- НОВЫЙ БЛОК: КЭШ АКТИВНЫХ СОТРУДНИКОВ И ШИНА ИНВАЛИДАЦИИ ---
+async def load_employee_cache():
+    """Полностью перечитывает список активных сотрудников в кэш."""
     conn = await get_db_connection()
     try:
-        # Используем conn.fetchval() для получения одного значения из одной строки - это очень эффективно
-        is_active = await conn.fetchval(
-            "SELECT is_active FROM employees WHERE telegram_id = $1",
-            telegram_id
-        )
-        # fetchval вернет None, если ничего не найдено, или значение (True/False)
-        return is_active if is_active is not None else False
+        rows = await conn.fetch("SELECT telegram_id FROM employees WHERE is_active = TRUE")
+        employee_cache.replace(row['telegram_id'] for row in rows)
     finally:
         await conn.close()
 
+async def start_invalidation_bus():
+    """Подписывает процесс на шину инвалидации кэшей (изменения из бота/веб-панели)."""
+    await invalidation_bus.start(get_db_connection)
+
+async def stop_invalidation_bus():
+    await invalidation_bus.stop()
+# --- КОНЕЦ НОВОГО БЛОКА ---
+
 async def get_all_active_employees_with_schedules(for_date: date) -> list:
     """
     Получает список активных сотрудников и их АКТУАЛЬНЫЙ на for_date график.
@@ -377,11 +448,12 @@ async def set_employee_active_status(telegram_id: int, is_active: bool):
     """Устанавливает статус активности сотрудника в PostgreSQL."""
     conn = await get_db_connection()
     try:
-        # conn.execute достаточно для INSERT/UPDATE/DELETE, commit не нужен
-        await conn.execute(
-            "UPDATE employees SET is_active = $1 WHERE telegram_id = $2",
-            is_active, telegram_id
-        )
+        async with invalidation_bus.transaction(conn) as changes:
+            await conn.execute(
+                "UPDATE employees SET is_active = $1 WHERE telegram_id = $2",
+                is_active, telegram_id
+            )
+            changes.append(InvalidationMessage(EMPLOYEE, telegram_id=telegram_id, is_active=is_active))
     finally:
         await conn.close()
 
@@ -390,10 +462,12 @@ async def set_face_encoding(telegram_id: int, encoding: np.ndarray):
     encoding_bytes = encoding.tobytes()
     conn = await get_db_connection()
     try:
-        await conn.execute(
-            "UPDATE employees SET face_encoding = $1 WHERE telegram_id = $2",
-            encoding_bytes, telegram_id
-        )
+        async with invalidation_bus.transaction(conn) as changes:
+            await conn.execute(
+                "UPDATE employees SET face_encoding = $1 WHERE telegram_id = $2",
+                encoding_bytes, telegram_id
+            )
+            changes.append(InvalidationMessage(EMPLOYEE, telegram_id=telegram_id))
     finally:
         await conn.close()
 
@@ -405,7 +479,7 @@ async def add_or_update_employee(telegram_id: int, full_name: str, schedule_data
     conn = await get_db_connection()
     try:
         # Используем транзакцию, чтобы все 7 дней обновились как единое целое.
-        async with conn.transaction():
+        async with invalidation_bus.transaction(conn) as changes:
             # Шаг 1: Обновляем самого сотрудника
             await conn.execute(
                 """
@@ -414,6 +488,7 @@ async def add_or_update_employee(telegram_id: int, full_name: str, schedule_data
                 """,
                 telegram_id, full_name
             )
+            changes.append(InvalidationMessage(EMPLOYEE, telegram_id=telegram_id, is_active=True))
 
             # Шаг 2: Обновляем/вставляем график для каждого из 7 дней
             for day_of_week in range(7):
@@ -436,25 +511,32 @@ async def add_or_update_employee(telegram_id: int, full_name: str, schedule_data
                     """,
                     telegram_id, day_of_week, effective_date, start_time, end_time
                 )
+            changes.append(InvalidationMessage(SCHEDULE, telegram_id=telegram_id, start_date=effective_date))
         
         logger.info(f"График для сотрудника {telegram_id} с {effective_date} успешно обновлен (метод ON CONFLICT).")
     finally:
         await conn.close()
 
+@tracing.traced()
 async def log_check_in_attempt(telegram_id: int, check_in_type: str, status: str, lat=None, lon=None, distance=None, similarity=None):
     """Логирует попытку чекина в PostgreSQL."""
     conn = await get_db_connection()
     try:
         # Мы не передаем timestamp, так как в таблице стоит DEFAULT NOW() AT TIME ZONE 'utc'
         # База данных сама подставит корректное UTC время.
-        await conn.execute(
-            """
-            INSERT INTO check_ins 
-            (employee_telegram_id, check_in_type, status, latitude, longitude, distance_meters, face_similarity) 
-            VALUES ($1, $2, $3, $4, $5, $6, $7)
-            """, 
-            telegram_id, check_in_type, status, lat, lon, distance, similarity
-        )
+        async with invalidation_bus.transaction(conn) as changes:
+            await conn.execute(
+                """
+                INSERT INTO check_ins 
+                (employee_telegram_id, check_in_type, status, latitude, longitude, distance_meters, face_similarity) 
+                VALUES ($1, $2, $3, $4, $5, $6, $7)
+                """, 
+                telegram_id, check_in_type, status, lat, lon, distance, similarity
+            )
+            today = datetime.now(LOCAL_TIMEZONE).date()
+            changes.append(InvalidationMessage(CHECK_IN, telegram_id=telegram_id, start_date=today, end_date=today,
+                                              kind=check_in_type, status=status))
+        CHECKIN_ATTEMPTS.labels(check_in_type, status).inc()
     finally:
         await conn.close()
 
@@ -467,29 +549,39 @@ async def override_as_absent(telegram_id: int, for_date: date):
 
     conn = await get_db_connection()
     try:
-        await conn.execute(
-            "INSERT INTO check_ins (timestamp, employee_telegram_id, check_in_type, status) VALUES ($1, $2, $3, $4)",
-            timestamp_utc, telegram_id, 'SYSTEM', 'ABSENT_INCOMPLETE'
-        )
+        async with invalidation_bus.transaction(conn) as changes:
+            await conn.execute(
+                "INSERT INTO check_ins (timestamp, employee_telegram_id, check_in_type, status) VALUES ($1, $2, $3, $4)",
+                timestamp_utc, telegram_id, 'SYSTEM', 'ABSENT_INCOMPLETE'
+            )
+            changes.append(InvalidationMessage(CHECK_IN, telegram_id=telegram_id, start_date=for_date, end_date=for_date,
+                                              kind='SYSTEM', status='ABSENT_INCOMPLETE'))
         logger.info(f"Сотрудник {telegram_id} помечен как прогульщик (не отметил уход) за {for_date.isoformat()}")
     finally:
         await conn.close()
 
+def _leave_status(leave_type: str) -> str:
+    """Тип отсутствия из подписи кнопки/формы ('Отпуск', 'Больничный') в значение leaves.leave_type."""
+    return 'VACATION' if 'отпуск' in leave_type.lower() else 'SICK_LEAVE'
+
 async def add_leave_period(telegram_id: int, start_date: date, end_date: date, leave_type: str):
     """Добавляет записи об отпуске/больничном в отдельную таблицу 'leaves'."""
     conn = await get_db_connection()
     try:
         # Убедимся, что тип отпуска соответствует ожидаемым значениям
-        leave_status = 'VACATION' if 'отпуск' in leave_type.lower() else 'SICK_LEAVE'
+        leave_status = _leave_status(leave_type)
         
         # Просто вставляем одну запись на весь период. Это гораздо эффективнее.
-        await conn.execute(
-            """
-            INSERT INTO leaves (employee_telegram_id, start_date, end_date, leave_type)
-            VALUES ($1, $2, $3, $4)
-            """,
-            telegram_id, start_date, end_date, leave_status
-        )
+        async with invalidation_bus.transaction(conn) as changes:
+            await conn.execute(
+                """
+                INSERT INTO leaves (employee_telegram_id, start_date, end_date, leave_type)
+                VALUES ($1, $2, $3, $4)
+                """,
+                telegram_id, start_date, end_date, leave_status
+            )
+            changes.append(InvalidationMessage(LEAVE, telegram_id=telegram_id, start_date=start_date, end_date=end_date,
+                                              kind=leave_status))
         logger.info(f"Для сотрудника {telegram_id} назначен(а) {leave_type} с {start_date} по {end_date}.")
     finally:
         await conn.close()
@@ -512,7 +604,12 @@ async def get_all_checkins_for_export() -> list:
         await conn.close()
 
 async def get_report_stats_for_period(start_date: date, end_date: date) -> dict:
-    """Собирает статистику для текстового отчета из PostgreSQL."""
+    """Собирает статистику для текстового отчета из PostgreSQL (закрытые периоды берутся из кэша)."""
+    cached_stats = report_cache.get('period_stats', start_date, end_date)
+    if cached_stats is not None:
+        return cached_stats
+    generation = report_cache.generation
+
     stats = {
         'total_work_days': 0, 'total_arrivals': 0, 'total_lates': 0,
         'absences': defaultdict(list), 'late_employees': defaultdict(list)
@@ -577,6 +674,8 @@ async def get_report_stats_for_period(start_date: date, end_date: date) -> dict:
 
     finally:
         await conn.close()
+    report_cache.put('period_stats', start_date, end_date, stats, generation=generation,
+                     weight=sum(len(dates) for dates in stats['absences'].values()) + sum(len(dates) for dates in stats['late_employees'].values()) + 1)
     return stats
 
 async def cancel_leave_period(telegram_id: int, start_date: date, end_date: date) -> int:
@@ -588,149 +687,515 @@ async def cancel_leave_period(telegram_id: int, start_date: date, end_date: date
             DELETE FROM leaves 
             WHERE employee_telegram_id = $1 
             AND start_date <= $2 AND end_date >= $3
+            RETURNING start_date, end_date
         """
-        status_str = await conn.execute(query, telegram_id, end_date, start_date)
-        rows_deleted = int(status_str.split()[-1])
+        async with invalidation_bus.transaction(conn) as changes:
+            deleted_rows = await conn.fetch(query, telegram_id, end_date, start_date)
+            if deleted_rows:
+                # Удаленные периоды могли выходить за пределы запрошенного диапазона
+                changes.append(InvalidationMessage(
+                    LEAVE, telegram_id=telegram_id,
+                    start_date=min(row['start_date'] for row in deleted_rows),
+                    end_date=max(row['end_date'] for row in deleted_rows),
+                    status='CANCELLED'
+                ))
+        rows_deleted = len(deleted_rows)
         logger.info(f"Для сотрудника {telegram_id} отменено отсутствие с {start_date} по {end_date}. Удалено записей: {rows_deleted}")
         return rows_deleted
     finally:
         await conn.close()
 
+# --- НОВЫЙ БЛОК: ПАКЕТНЫЕ ИЗМЕНЕНИЯ ДЛЯ ВЕБ-ПАНЕЛИ ---
+# Каждая функция - одна транзакция и по одному запросу на таблицу (unnest/ANY), независимо от размера пакета.
+# Входные данные уже проверены вызывающим кодом (без повторов ключей внутри пакета).
+
+async def add_holidays_batch(holidays: list[tuple[date, str]]) -> dict[date, bool]:
+    """Добавляет/переименовывает праздники. Возвращает {дата: True - добавлен, False - переименован}."""
+    conn = await get_db_connection()
+    try:
+        async with invalidation_bus.transaction(conn) as changes:
+            rows = await conn.fetch(
+                """
+                INSERT INTO holidays (holiday_date, holiday_name)
+                SELECT * FROM unnest($1::date[], $2::text[])
+                ON CONFLICT (holiday_date) DO UPDATE SET holiday_name = EXCLUDED.holiday_name
+                RETURNING holiday_date, (xmax = 0) AS inserted
+                """,
+                [holiday_date for holiday_date, _ in holidays], [name for _, name in holidays]
+            )
+            for holiday_date, name in holidays:
+                changes.append(InvalidationMessage(HOLIDAY, start_date=holiday_date, end_date=holiday_date, name=name))
+        logger.info(f"Пакетно добавлено/обновлено праздников: {len(rows)}")
+        return {row['holiday_date']: row['inserted'] for row in rows}
+    finally:
+        await conn.close()
+
+async def set_employees_active_status_batch(telegram_ids: list[int], is_active: bool) -> set[int]:
+    """Устанавливает статус активности сразу нескольким сотрудникам. Возвращает id найденных."""
+    conn = await get_db_connection()
+    try:
+        async with invalidation_bus.transaction(conn) as changes:
+            rows = await conn.fetch(
+                "UPDATE employees SET is_active = $1 WHERE telegram_id = ANY($2::bigint[]) RETURNING telegram_id",
+                is_active, telegram_ids
+            )
+            updated = {row['telegram_id'] for row in rows}
+            for telegram_id in updated:
+                changes.append(InvalidationMessage(EMPLOYEE, telegram_id=telegram_id, is_active=is_active))
+        logger.info(f"Пакетно изменен статус активности ({is_active}) у сотрудников: {len(updated)}")
+        return updated
+    finally:
+        await conn.close()
+
+async def get_existing_employee_ids(telegram_ids: list[int]) -> set[int]:
+    """Возвращает те из telegram_ids, для которых есть сотрудник (активный или нет)."""
+    conn = await get_db_connection()
+    try:
+        rows = await conn.fetch("SELECT telegram_id FROM employees WHERE telegram_id = ANY($1::bigint[])", telegram_ids)
+        return {row['telegram_id'] for row in rows}
+    finally:
+        await conn.close()
+
+async def add_leave_periods_batch(periods: list[tuple[int, date, date, str]]):
+    """
+    Назначает периоды отсутствия [(telegram_id, начало, конец, тип), ...] - все или ни одного.
+    Сотрудники проверяются заранее (get_existing_employee_ids); если кого-то удалили в промежутке,
+    внешний ключ откатывает весь пакет и функция выбрасывает ValueError.
+    """
+    conn = await get_db_connection()
+    try:
+        async with invalidation_bus.transaction(conn) as changes:
+            try:
+                await conn.execute(
+                    """
+                    INSERT INTO leaves (employee_telegram_id, start_date, end_date, leave_type)
+                    SELECT * FROM unnest($1::bigint[], $2::date[], $3::date[], $4::text[])
+                    """,
+                    [period[0] for period in periods], [period[1] for period in periods],
+                    [period[2] for period in periods], [_leave_status(period[3]) for period in periods]
+                )
+            except asyncpg.ForeignKeyViolationError:
+                raise ValueError("Сотрудник пакета удален во время применения; пакет не применен.")
+            for telegram_id, start_date, end_date, leave_type in periods:
+                changes.append(InvalidationMessage(LEAVE, telegram_id=telegram_id, start_date=start_date,
+                                                   end_date=end_date, kind=_leave_status(leave_type)))
+        logger.info(f"Пакетно назначено периодов отсутствия: {len(periods)}")
+    finally:
+        await conn.close()
+
+async def add_or_update_employees_batch(employees: list[tuple[int, str, dict, date]]) -> dict[int, bool]:
+    """
+    Пакетный вариант add_or_update_employee: [(telegram_id, ФИО, график, дата вступления), ...].
+    Возвращает {telegram_id: True - добавлен, False - обновлен}.
+    """
+    schedule_columns = ([], [], [], [], [])
+    for telegram_id, _, schedule_data, effective_date in employees:
+        for day_of_week in range(7):
+            times = schedule_data.get(day_of_week) or {}
+            for column, value in zip(schedule_columns, (telegram_id, day_of_week, effective_date, times.get('start'), times.get('end'))):
+                column.append(value)
+
+    conn = await get_db_connection()
+    try:
+        async with invalidation_bus.transaction(conn) as changes:
+            rows = await conn.fetch(
+                """
+                INSERT INTO employees (telegram_id, full_name, is_active)
+                SELECT telegram_id, full_name, TRUE FROM unnest($1::bigint[], $2::text[]) AS t(telegram_id, full_name)
+                ON CONFLICT (telegram_id) DO UPDATE SET full_name = EXCLUDED.full_name, is_active = TRUE
+                RETURNING telegram_id, (xmax = 0) AS inserted
+                """,
+                [employee[0] for employee in employees], [employee[1] for employee in employees]
+            )
+            await conn.execute(
+                """
+                INSERT INTO schedules (employee_telegram_id, day_of_week, effective_from_date, start_time, end_time)
+                SELECT * FROM unnest($1::bigint[], $2::int[], $3::date[], $4::time[], $5::time[])
+                ON CONFLICT (employee_telegram_id, day_of_week, effective_from_date) DO UPDATE SET
+                    start_time = EXCLUDED.start_time,
+                    end_time = EXCLUDED.end_time
+                """,
+                *schedule_columns
+            )
+            for telegram_id, _, _, effective_date in employees:
+                changes.append(InvalidationMessage(EMPLOYEE, telegram_id=telegram_id, is_active=True))
+                changes.append(InvalidationMessage(SCHEDULE, telegram_id=telegram_id, start_date=effective_date))
+        logger.info(f"Пакетно добавлено/обновлено сотрудников с графиками: {len(rows)}")
+        return {row['telegram_id']: row['inserted'] for row in rows}
+    finally:
+        await conn.close()
+# --- КОНЕЦ НОВОГО БЛОКА ---
+
 # --- ПОЛНОСТЬЮ ПЕРЕРАБОТАННАЯ ФУНКЦИЯ ---
 async def get_monthly_summary_data(year: int, month: int) -> list[list]:
     """Собирает и формирует данные для сводного месячного отчета с КОМБИНИРОВАННЫМИ статусами."""
-    conn = await get_db_connection()
     try:
         start_date = date(year, month, 1)
-        num_days = calendar.monthrange(year, month)[1]
-        end_date = date(year, month, num_days)
-        today = datetime.now(LOCAL_TIMEZONE).date()
-        holidays_rows = await conn.fetch("SELECT holiday_date FROM holidays WHERE holiday_date BETWEEN $1 AND $2", start_date, end_date)
-        holidays_set = {row['holiday_date'] for row in holidays_rows}
+        end_date = date(year, month, calendar.monthrange(year, month)[1])
     except ValueError:
         logger.error(f"Неверный год или месяц: {year}-{month}")
-        await conn.close()
         return []
 
-    try:
-        # 1. Получаем всех активных сотрудников
-        emp_rows = await conn.fetch("SELECT telegram_id, full_name FROM employees WHERE is_active = TRUE ORDER BY full_name")
-        all_employees = {row['telegram_id']: row['full_name'] for row in emp_rows}
-        
-        # 2. Получаем все события чекинов за месяц
-        start_dt_utc = datetime.combine(start_date, time.min, tzinfo=LOCAL_TIMEZONE).astimezone(ZoneInfo("UTC"))
-        end_dt_utc = datetime.combine(end_date, time.max, tzinfo=LOCAL_TIMEZONE).astimezone(ZoneInfo("UTC"))
-        
-        query = "SELECT employee_telegram_id, timestamp, status FROM check_ins WHERE timestamp BETWEEN $1 AND $2"
-        event_rows = await conn.fetch(query, start_dt_utc, end_dt_utc)
-        
-        # 3. Группируем все статусы по сотруднику и по дню
-        checkins = defaultdict(lambda: defaultdict(list))
-        for row in event_rows:
-            local_date_iso = row['timestamp'].astimezone(LOCAL_TIMEZONE).date().isoformat()
-            checkins[row['employee_telegram_id']][local_date_iso].append(row['status'])
-        leaves_rows = await conn.fetch("SELECT employee_telegram_id, start_date, end_date, leave_type FROM leaves WHERE start_date <= $1 AND end_date >= $2", end_date, start_date)
-        # Добавляем статусы отпусков и больничных в общую структуру
-        for row in leaves_rows:
-            current_date = row['start_date']
-            while current_date <= row['end_date']:
-                if start_date <= current_date <= end_date:
-                     checkins[row['employee_telegram_id']][current_date.isoformat()].append(row['leave_type'])
-                current_date += timedelta(days=1)
+    cached_table = report_cache.get('monthly_table', start_date, end_date)
+    if cached_table is not None:
+        return cached_table
+    generation = report_cache.generation
+
+    result_table = [report_grid.range_header(start_date, end_date)]
+    async for employee_row in iter_attendance_rows(start_date, end_date):
+        result_table.append(employee_row)
+    report_cache.put('monthly_table', start_date, end_date, result_table, generation=generation, weight=len(result_table) * len(result_table[0]))
+    return result_table
+# --- КОНЕЦ ПЕРЕРАБОТАННОЙ ФУНКЦИИ ---
 
+# --- НОВЫЙ БЛОК: ОТЧЕТ ЗА ПРОИЗВОЛЬНЫЙ ПЕРИОД ---
+ATTENDANCE_CHUNK_SIZE = 500  # Сотрудников в одной порции матрицы
 
-        # 5. Формируем итоговую таблицу
-        header = ["Сотрудник"] + [f"{day:02d}.{month:02d}" for day in range(1, num_days + 1)]
-        result_table = [header]
+async def count_active_employees() -> int:
+    """Возвращает количество активных сотрудников (для постраничной выдачи отчетов)."""
+    conn = await get_db_connection()
+    try:
+        return await conn.fetchval("SELECT COUNT(*) FROM employees WHERE is_active = TRUE")
+    finally:
+        await conn.close()
 
-        for emp_id, name in all_employees.items():
-            employee_row = [name]
-            for day in range(1, num_days + 1):
-                current_date = date(year, month, day)
-                schedule_for_day = await get_schedule_for_specific_date(conn, emp_id, current_date)
-                status_list = checkins.get(emp_id, {}).get(current_date.isoformat(), [])
-              
-                # Вызываем новую функцию для создания комбинированного статуса
-                final_status_str = _build_composite_status(
-                    status_list, 
-                    is_work_day=(schedule_for_day is not None),
-                    is_past_date=(current_date <= today),
-                    is_holiday=(current_date in holidays_set) # <-- НОВЫЙ ПАРАМЕТР
-                )
-                employee_row.append(final_status_str)
-                
-            result_table.append(employee_row)
+async def iter_attendance_rows(start_date: date, end_date: date, offset: int = 0, limit: int | None = None,
+                               chunk_size: int = ATTENDANCE_CHUNK_SIZE):
+    """
+    Асинхронный генератор строк матрицы посещаемости [ФИО, статус, ...] за произвольный период.
+    Сотрудники и праздники загружаются один раз, графики/чекины/отсутствия - порциями по chunk_size
+    сотрудников, поэтому память ограничена chunk_size x дней, а строки отдаются по мере расчета.
+    """
+    async for grid in iter_attendance_grids(start_date, end_date, offset, limit, chunk_size):
+        for employee_row in grid.rows():
+            yield employee_row
+
+async def iter_attendance_grids(start_date: date, end_date: date, offset: int = 0, limit: int | None = None,
+                                chunk_size: int = ATTENDANCE_CHUNK_SIZE):
+    """Асинхронный генератор порций матрицы посещаемости (AttendanceGrid по chunk_size сотрудников)."""
+    today = datetime.now(LOCAL_TIMEZONE).date()
+    holidays_set = set((await _get_holiday_calendar()).between(start_date, end_date))
+    conn = await get_db_connection()
+    try:
+        emp_rows = await conn.fetch(
+            "SELECT telegram_id, full_name FROM employees WHERE is_active = TRUE ORDER BY full_name, telegram_id OFFSET $1 LIMIT $2",
+            offset, limit
+        )
+        employees = [(row['telegram_id'], row['full_name']) for row in emp_rows]
 
-        return result_table
+        for chunk_start in range(0, len(employees), chunk_size):
+            chunk = employees[chunk_start:chunk_start + chunk_size]
+            yield await _load_attendance_grid(conn, chunk, start_date, end_date, today, holidays_set)
     finally:
         await conn.close()
-# --- КОНЕЦ ПЕРЕРАБОТАННОЙ ФУНКЦИИ ---
 
-async def get_employee_log(employee_id: int, start_date: date, end_date: date) -> list[dict]:
+async def get_monthly_report_compact(year: int, month: int) -> dict | None:
+    """
+    Месячный отчет в компактном формате веб-панели: подписи статусов один раз в labels,
+    у каждого сотрудника - строка кодов (report_grid.CODE_CHARS, символ на день).
+    None - неверный месяц.
+    """
+    try:
+        start_date = date(year, month, 1)
+        end_date = date(year, month, calendar.monthrange(year, month)[1])
+    except ValueError:
+        logger.error(f"Неверный год или месяц: {year}-{month}")
+        return None
+
+    cached_report = report_cache.get('monthly_compact', start_date, end_date)
+    if cached_report is not None:
+        return cached_report
+    generation = report_cache.generation
+
+    names, codes = [], []
+    async for grid in iter_attendance_grids(start_date, end_date):
+        names.extend(grid.employee_names)
+        codes.extend(grid.code_strings())
+    report = {
+        'labels': list(report_grid.STATUS_LABELS),
+        'header': report_grid.range_header(start_date, end_date),
+        'names': names,
+        'codes': codes,
+    }
+    report_cache.put('monthly_compact', start_date, end_date, report, generation=generation, weight=len(names) * (end_date.day + 1))
+    return report
+# --- КОНЕЦ НОВОГО БЛОКА ---
+
+async def _load_attendance_grid(conn, employees: list[tuple], start_date: date, end_date: date, today: date, holidays) -> report_grid.AttendanceGrid:
+    """
+    Загружает графики, чекины и отсутствия для указанных сотрудников за период
+    (по одному запросу на таблицу) и строит матрицу посещаемости.
+    """
+    employee_ids = [emp_id for emp_id, _ in employees]
+    start_dt_utc = datetime.combine(start_date, time.min, tzinfo=LOCAL_TIMEZONE).astimezone(ZoneInfo("UTC"))
+    end_dt_utc = datetime.combine(end_date, time.max, tzinfo=LOCAL_TIMEZONE).astimezone(ZoneInfo("UTC"))
+
+    schedule_rows = await conn.fetch(
+        """
+        SELECT employee_telegram_id, day_of_week, effective_from_date,
+               (start_time IS NOT NULL AND end_time IS NOT NULL) AS is_work_day
+        FROM schedules
+        WHERE employee_telegram_id = ANY($1::bigint[]) AND effective_from_date <= $2
+        """,
+        employee_ids, end_date
+    )
+    # Номер дня в локальной зоне и битовые флаги считаются в SQL: одна строка на (сотрудник, день)
+    checkin_rows = await conn.fetch(
+        f"""
+        SELECT employee_telegram_id, (timestamp AT TIME ZONE $3)::date - $5::date AS day_offset,
+               bit_or({report_grid.checkin_flags_sql()}) AS flags
+        FROM check_ins
+        WHERE employee_telegram_id = ANY($4::bigint[]) AND timestamp BETWEEN $1 AND $2
+        GROUP BY 1, 2
+        """,
+        start_dt_utc, end_dt_utc, LOCAL_TIMEZONE.key, employee_ids, start_date
+    )
+    leave_rows = await conn.fetch(
+        """
+        SELECT employee_telegram_id, start_date, end_date, leave_type FROM leaves
+        WHERE employee_telegram_id = ANY($3::bigint[]) AND start_date <= $1 AND end_date >= $2
+        """,
+        end_date, start_date, employee_ids
+    )
+    return report_grid.build_attendance_grid(
+        employees, start_date, end_date, today,
+        schedule_rows=[tuple(row.values()) for row in schedule_rows],
+        checkin_rows=[tuple(row.values()) for row in checkin_rows],
+        leave_rows=[tuple(row.values()) for row in leave_rows],
+        holidays=holidays
+    )
+
+# --- НОВЫЙ БЛОК: ЛОГ СОТРУДНИКА ПОСТРАНИЧНО И ПОТОКОМ ---
+# Время переводится в локальную зону и форматируется в SQL; sort_ts и id - ключ keyset-курсора
+_EMPLOYEE_LOG_SQL = """
+    SELECT id, timestamp AS sort_ts,
+           to_char(timestamp AT TIME ZONE $4, 'DD.MM.YYYY HH24:MI:SS') AS timestamp,
+           check_in_type, status, distance_meters, face_similarity
+    FROM check_ins
+    WHERE employee_telegram_id = $1 AND timestamp BETWEEN $2 AND $3 {keyset}
+    ORDER BY sort_ts DESC, id DESC
+"""
+
+def _employee_log_params(employee_id: int, start_date: date, end_date: date) -> list:
+    start_dt_utc = datetime.combine(start_date, time.min, tzinfo=LOCAL_TIMEZONE).astimezone(ZoneInfo("UTC"))
+    end_dt_utc = datetime.combine(end_date, time.max, tzinfo=LOCAL_TIMEZONE).astimezone(ZoneInfo("UTC"))
+    return [employee_id, start_dt_utc, end_dt_utc, LOCAL_TIMEZONE.key]
+
+def _log_entry(row) -> dict:
+    entry = dict(row)
+    del entry['id'], entry['sort_ts']
+    return entry
+
+async def get_employee_log_page(employee_id: int, start_date: date, end_date: date, limit: int = 100,
+                                before: tuple[datetime, int] | None = None) -> tuple[list[dict], tuple | None]:
     """
-    Получает детализированный лог всех событий сотрудника за период.
+    Страница лога событий сотрудника за период, от новых к старым. before - (timestamp, id)
+    последнего события предыдущей страницы. Возвращает (события, ключ для следующей страницы или None).
     """
-    start_dt_utc = datetime.combine(start_date, time.min).astimezone(ZoneInfo("UTC"))
-    end_dt_utc = datetime.combine(end_date, time.max).astimezone(ZoneInfo("UTC"))
+    params = _employee_log_params(employee_id, start_date, end_date)
+    keyset = ""
+    if before is not None:
+        params.extend(before)
+        keyset = "AND (timestamp, id) < ($5, $6)"
+    params.append(limit + 1)
+    sql = _EMPLOYEE_LOG_SQL.format(keyset=keyset) + f" LIMIT ${len(params)}"
 
     conn = await get_db_connection()
     try:
-        query = """
-            SELECT timestamp, check_in_type, status, distance_meters, face_similarity
-            FROM check_ins
-            WHERE employee_telegram_id = $1 AND timestamp BETWEEN $2 AND $3
-            ORDER BY timestamp DESC
+        rows = await conn.fetch(sql, *params)
+    finally:
+        await conn.close()
+    next_before = (rows[limit - 1]['sort_ts'], rows[limit - 1]['id']) if len(rows) > limit else None
+    return [_log_entry(row) for row in rows[:limit]], next_before
+
+async def iter_employee_log(employee_id: int, start_date: date, end_date: date, prefetch: int = 500):
+    """Асинхронный генератор всех событий сотрудника за период через серверный курсор (память - prefetch строк)."""
+    conn = await get_db_connection()
+    try:
+        async with conn.transaction():
+            sql = _EMPLOYEE_LOG_SQL.format(keyset="")
+            # aclosing: при досрочной остановке потока обход курсора (и его учет в query_profiler) завершается сразу
+            cursor = conn.cursor(sql, *_employee_log_params(employee_id, start_date, end_date), prefetch=prefetch)
+            async with contextlib.aclosing(aiter(cursor)) as rows:
+                async for row in rows:
+                    yield _log_entry(row)
+    finally:
+        await conn.close()
+# --- КОНЕЦ НОВОГО БЛОКА ---
+
+# --- НОВЫЙ БЛОК: DIFF И DRY-RUN ДЛЯ МАССОВОГО ОБНОВЛЕНИЯ ГРАФИКОВ ---
+def _week_from_schedule(schedule: dict) -> tuple:
+    """Приводит график из файла к кортежу из 7 пар (start, end); (None, None) - выходной."""
+    week = []
+    for day_of_week in range(7):
+        times = schedule.get(day_of_week)
+        start_time = times.get('start') if times else None
+        end_time = times.get('end') if times else None
+        week.append((start_time, end_time))
+    return tuple(week)
+
+def _effective_week(day_versions: dict, on_date: date) -> tuple | None:
+    """
+    Возвращает действующий на on_date график недели по индексу версий
+    {день недели: [(effective_from_date, (start, end)), ...]} (списки отсортированы по дате).
+    Если ни одной версии на эту дату нет - возвращает None.
+    """
+    week, has_version = [], False
+    for day_of_week in range(7):
+        current = (None, None)
+        for effective_date, times in day_versions.get(day_of_week, []):
+            if effective_date > on_date:
+                break
+            current, has_version = times, True
+        week.append(current)
+    return tuple(week) if has_version else None
+
+def _compute_schedules_diff(existing_rows: list, schedules_data: list[dict]) -> dict:
+    """
+    Сравнивает загружаемые графики с текущими версиями в памяти.
+    existing_rows - строки (telegram_id, full_name, day_of_week, effective_from_date, start_time, end_time),
+    где поля графика равны None, если у сотрудника нет версий.
+    """
+    names = {}
+    versions = defaultdict(lambda: defaultdict(list))
+    for row in existing_rows:
+        names[row['telegram_id']] = row['full_name']
+        if row['effective_from_date'] is not None:
+            versions[row['telegram_id']][row['day_of_week']].append(
+                (row['effective_from_date'], (row['start_time'], row['end_time']))
+            )
+    for day_versions in versions.values():
+        for day_list in day_versions.values():
+            day_list.sort(key=lambda item: item[0])
+
+    # Повторы (сотрудник, дата) внутри файла: побеждает последняя строка.
+    # Сортируем по дате, чтобы более ранняя загрузка учитывалась при сравнении более поздней.
+    deduplicated = {(data['telegram_id'], data['effective_date']): data for data in schedules_data}
+    diff = {'changes': [], 'unchanged': [], 'unknown': []}
+
+    for (telegram_id, effective_date), data in sorted(deduplicated.items()):
+        if telegram_id not in names:
+            diff['unknown'].append(telegram_id)
+            continue
+
+        new_week = _week_from_schedule(data['schedule'])
+        day_versions = versions[telegram_id]
+        current_week = _effective_week(day_versions, effective_date)
+        if current_week == new_week:
+            diff['unchanged'].append({'telegram_id': telegram_id, 'full_name': names[telegram_id], 'effective_date': effective_date})
+            continue
+
+        rows_to_write = []
+        for day_of_week, times in enumerate(new_week):
+            day_list = day_versions[day_of_week]
+            exact = next((i for i, (d, _) in enumerate(day_list) if d == effective_date), None)
+            # Строка на ту же дату с теми же значениями уже есть - переписывать ее незачем
+            if exact is not None and day_list[exact][1] == times:
+                continue
+            rows_to_write.append((telegram_id, day_of_week, effective_date, times[0], times[1]))
+            # Обновляем индекс, чтобы следующие строки файла сравнивались уже с новой версией
+            if exact is not None:
+                day_list[exact] = (effective_date, times)
+            else:
+                day_list.append((effective_date, times))
+                day_list.sort(key=lambda item: item[0])
+
+        diff['changes'].append({
+            'telegram_id': telegram_id,
+            'full_name': names[telegram_id],
+            'effective_date': effective_date,
+            'kind': 'added' if current_week is None else 'changed',
+            'old_week': current_week,
+            'new_week': new_week,
+            'rows': rows_to_write,
+        })
+
+    diff['unknown'] = sorted(set(diff['unknown']))
+    return diff
+
+class SchedulesChangedError(Exception):
+    """Графики в БД изменились между предпросмотром и подтверждением - diff нужно построить заново."""
+
+
+async def _diff_schedules_on(conn, schedules_data: list[dict]) -> dict:
+    """Строит diff по текущему состоянию БД на conn (все версии графиков - одним запросом)."""
+    if not schedules_data:
+        return {'changes': [], 'unchanged': [], 'unknown': []}
+
+    telegram_ids = sorted({data['telegram_id'] for data in schedules_data})
+    max_effective_date = max(data['effective_date'] for data in schedules_data)
+    rows = await conn.fetch(
         """
-        rows = await conn.fetch(query, employee_id, start_dt_utc, end_dt_utc)
-        
-        # Конвертируем время в локальную зону и форматируем
-        log_entries = []
-        for row in rows:
-            local_ts = row['timestamp'].astimezone(LOCAL_TIMEZONE)
-            entry = dict(row)
-            entry['timestamp'] = local_ts.strftime('%d.%m.%Y %H:%M:%S')
-            log_entries.append(entry)
-            
-        return log_entries
+        SELECT e.telegram_id, e.full_name, s.day_of_week, s.effective_from_date, s.start_time, s.end_time
+        FROM employees e
+        LEFT JOIN schedules s ON s.employee_telegram_id = e.telegram_id AND s.effective_from_date <= $2
+        WHERE e.telegram_id = ANY($1::bigint[])
+        """,
+        telegram_ids, max_effective_date
+    )
+    return _compute_schedules_diff(rows, schedules_data)
+
+def _diff_signature(diff: dict) -> tuple:
+    """То, что определяет запись diff: строки к записи, пропускаемые и неизвестные сотрудники."""
+    return (
+        [(change['telegram_id'], change['effective_date'], change['rows']) for change in diff['changes']],
+        [(item['telegram_id'], item['effective_date']) for item in diff['unchanged']],
+        diff['unknown'],
+    )
+
+async def diff_bulk_schedules(schedules_data: list[dict]) -> dict:
+    """Строит предварительный отчет об изменениях графиков без записи в БД."""
+    conn = await get_db_connection()
+    try:
+        return await _diff_schedules_on(conn, schedules_data)
     finally:
         await conn.close()
 
-# --- НОВАЯ ФУНКЦИЯ ДЛЯ МАССОВОГО ОБНОВЛЕНИЯ ---
-async def bulk_add_or_update_schedules(schedules_data: list[dict]):
+async def apply_schedules_diff(diff: dict, schedules_data: list[dict]) -> int:
     """
-    Массово добавляет или обновляет графики для списка сотрудников
-    в рамках одной транзакции для эффективности.
+    Записывает в БД только измененные строки графиков из diff (построенного по schedules_data).
+    Внутри транзакции diff строится заново при заблокированной для записи таблице графиков:
+    если он отличается от показанного администратору, ничего не записывается - SchedulesChangedError.
+    Возвращает число записанных строк.
     """
     conn = await get_db_connection()
     try:
         # Используем транзакцию: если хоть одна запись не удастся, все изменения откатятся.
-        async with conn.transaction():
-            for data in schedules_data:
-                telegram_id = data['telegram_id']
-                effective_date = data['effective_date']
-                schedule = data['schedule']
-
-                # Эта логика повторяет вашу функцию add_or_update_employee,
-                # но выполняется в рамках одного соединения и транзакции.
-                for day_of_week in range(7):
-                    times = schedule.get(day_of_week)
-                    start_time = times.get('start') if times else None
-                    end_time = times.get('end') if times else None
-                    
-                    await conn.execute(
-                        """
-                        INSERT INTO schedules (employee_telegram_id, day_of_week, effective_from_date, start_time, end_time)
-                        VALUES ($1, $2, $3, $4, $5)
-                        ON CONFLICT (employee_telegram_id, day_of_week, effective_from_date) DO UPDATE SET
-                            start_time = EXCLUDED.start_time,
-                            end_time = EXCLUDED.end_time
-                        """,
-                        telegram_id, day_of_week, effective_date, start_time, end_time
-                    )
-        logger.info(f"Массовое обновление графиков завершено. Обработано записей: {len(schedules_data)}")
+        async with invalidation_bus.transaction(conn) as changes:
+            # Блокировка не мешает чтению, но не дает другим записям графиков вклиниться до COMMIT
+            await conn.execute("LOCK TABLE schedules IN SHARE ROW EXCLUSIVE MODE")
+            if _diff_signature(await _diff_schedules_on(conn, schedules_data)) != _diff_signature(diff):
+                raise SchedulesChangedError("Графики изменились после предпросмотра.")
+            rows = [row for change in diff['changes'] for row in change['rows']]
+            if not rows:
+                return 0
+            await conn.executemany(
+                """
+                INSERT INTO schedules (employee_telegram_id, day_of_week, effective_from_date, start_time, end_time)
+                VALUES ($1, $2, $3, $4, $5)
+                ON CONFLICT (employee_telegram_id, day_of_week, effective_from_date) DO UPDATE SET
+                    start_time = EXCLUDED.start_time,
+                    end_time = EXCLUDED.end_time
+                """,
+                rows
+            )
+            changes.append(InvalidationMessage(SCHEDULE, start_date=min(row[2] for row in rows)))
+        logger.info(f"Массовое обновление графиков завершено. Сотрудников изменено: {len(diff['changes'])}, записано строк: {len(rows)}")
+        return len(rows)
     finally:
         await conn.close()
-# --- КОНЕЦ НОВОЙ ФУНКЦИИ ---
+
+async def bulk_add_or_update_schedules(schedules_data: list[dict], dry_run: bool = False) -> dict:
+    """
+    Массово добавляет или обновляет графики для списка сотрудников.
+    Строки, совпадающие с действующим графиком, пропускаются. При dry_run=True
+    только возвращает отчет об изменениях, ничего не записывая.
+    """
+    diff = await diff_bulk_schedules(schedules_data)
+    if not dry_run:
+        await apply_schedules_diff(diff, schedules_data)
+    return diff
+# --- КОНЕЦ НОВОГО БЛОКА ---
 
 async def get_personal_monthly_stats(employee_id: int) -> dict:
     """
@@ -872,4 +1337,34 @@ async def get_dashboard_stats(for_date: date) -> dict:
     finally:
         await conn.close()
     
-    return stats
\ No newline at end of file
+    return stats
+
+
+async def get_pg_stat_statements(limit: int = 10) -> list[dict] | None:
+    """
+    Самые затратные запросы по данным pg_stat_statements (все процессы и клиенты БД).
+    Возвращает None, если расширение не установлено или не загружено.
+    """
+    conn = await get_db_connection()
+    try:
+        for time_column in ('total_exec_time', 'total_time'):  # PostgreSQL 13+ / более ранние версии
+            try:
+                rows = await conn.fetch(f"""
+                    SELECT query, calls, {time_column} AS total_ms, {time_column} / GREATEST(calls, 1) AS mean_ms, rows
+                    FROM pg_stat_statements
+                    WHERE dbid = (SELECT oid FROM pg_database WHERE datname = current_database())
+                    ORDER BY {time_column} DESC
+                    LIMIT $1
+                """, limit)
+                return [dict(row) for row in rows]
+            except asyncpg.UndefinedColumnError:
+                continue
+            except (asyncpg.UndefinedTableError, asyncpg.ObjectNotInPrerequisiteStateError):
+                return None
+        return None
+    finally:
+        await conn.close()
+
+
+# Замер длительности и ошибок всех асинхронных функций модуля (метрика checkin_db_call_seconds{function})
+metrics.instrument_async_functions(globals(), metrics.DB_CALL_SECONDS, metrics.DB_CALL_ERRORS, __name__)
@@ -0,0 +1,324 @@
+# db_persistence.py
+import asyncio
+import hashlib
+import logging
+import os
+import pickle
+import time as timer
+
+from telegram.ext import BasePersistence, PersistenceInput
+
+import database
+import sharding
+from config import (
+    PERSISTENCE_FILE, PERSISTENCE_FLUSH_DELAY_SECONDS, PERSISTENCE_TTL_DAYS, PERSISTENCE_UPDATE_INTERVAL_SECONDS
+)
+
+logger = logging.getLogger(__name__)
+
+KIND_BOT = 'bot'
+KIND_USER = 'user'
+KIND_CHAT = 'chat'
+CONVERSATION_PREFIX = 'conv:'
+_MISSING = object()
+
+
+class PostgresPersistence(BasePersistence):
+    """
+    Хранение состояния бота в таблице bot_persistence по одной строке на ключ:
+    user_data и chat_data - по id, bot_data - по ключу верхнего уровня, состояния диалогов -
+    по (имя диалога, ключ). Каждое значение пиклится отдельно; в БД уходят только строки,
+    хэш которых изменился с прошлой записи, пачкой через PERSISTENCE_FLUSH_DELAY_SECONDS.
+    PTB каждые update_interval секунд передает bot_data целиком: ключи, равные переданным в прошлый раз,
+    даже не пиклятся. Каждый вид данных читается только когда PTB его запрашивает; строки, не обновлявшиеся
+    PERSISTENCE_TTL_DAYS дней (кроме bot_data), удаляются при запуске и далее по расписанию
+    (delete_expired, задача планировщика в main.py), а строки активных пользователей с неизменными данными
+    переписываются раз в полсрока, чтобы очистка их не удалила.
+    При шардировании (shard=(номер, всего)) читаются только пользователи, чаты и диалоги
+    этого шарда, а bot_data у каждого шарда свой (первый запуск берет общий как исходный).
+    """
+
+    def __init__(self, flush_delay: float = PERSISTENCE_FLUSH_DELAY_SECONDS, ttl_days: int = PERSISTENCE_TTL_DAYS,
+                 import_pickle_file: str | None = PERSISTENCE_FILE,
+                 update_interval: float = PERSISTENCE_UPDATE_INTERVAL_SECONDS,
+                 shard: tuple[int, int] | None = None):
+        super().__init__(store_data=PersistenceInput(callback_data=False), update_interval=update_interval)
+        self.flush_delay = flush_delay
+        self.ttl_days = ttl_days
+        self._refresh_after = ttl_days * 86400 / 2
+        self.import_pickle_file = import_pickle_file
+        self.shard = shard
+        self._bot_kind = f"{KIND_BOT}:{shard[0]}/{shard[1]}" if shard else KIND_BOT
+        self._digests: dict[tuple[str, str], bytes] = {}
+        self._written_at: dict[tuple[str, str], float] = {}  # timer.monotonic() последней записи строки
+        self._pending: dict[tuple[str, str], bytes | None] = {}  # None - удалить строку
+        self._bot_keys: set[str] = set()
+        self._bot_values: dict[str, object] = {}  # Копии значений bot_data из прошлого update_bot_data
+        self._flush_task: asyncio.Task | None = None
+        self._write_lock = asyncio.Lock()
+        self._ready = False
+
+    # --- Подготовка таблицы, очистка и импорт старого pickle ---
+    async def _ensure_ready(self):
+        if self._ready:
+            return
+        conn = await database.get_db_connection()
+        try:
+            await conn.execute("""
+                CREATE TABLE IF NOT EXISTS bot_persistence (
+                    kind TEXT NOT NULL,
+                    key TEXT NOT NULL,
+                    data BYTEA NOT NULL,
+                    updated_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+                    PRIMARY KEY (kind, key)
+                )
+            """)
+            is_empty = await conn.fetchval("SELECT NOT EXISTS (SELECT 1 FROM bot_persistence)")
+        finally:
+            await conn.close()
+        self._ready = True
+        expired = await self.delete_expired()
+        logger.info(f"Хранилище состояния бота готово, удалено устаревших записей: {expired}")
+        if is_empty and self.import_pickle_file and os.path.exists(self.import_pickle_file):
+            await self._import_pickle(self.import_pickle_file)
+
+    async def delete_expired(self) -> int:
+        """Удаляет устаревшие строки и забывает их хэши: если данные еще в памяти, следующее изменение их запишет."""
+        conn = await database.get_db_connection()
+        try:
+            rows = await conn.fetch(
+                """
+                DELETE FROM bot_persistence WHERE kind NOT LIKE $1 || '%' AND updated_at < NOW() - make_interval(days => $2)
+                RETURNING kind, key
+                """,
+                KIND_BOT, self.ttl_days
+            )
+        finally:
+            await conn.close()
+        for row in rows:
+            row_key = (row['kind'], row['key'])
+            self._digests.pop(row_key, None)
+            self._written_at.pop(row_key, None)
+        return len(rows)
+
+    async def _import_pickle(self, path: str):
+        """Однократный перенос данных из файла PicklePersistence (single_file) в пустую таблицу."""
+        try:
+            with open(path, 'rb') as f:
+                data = pickle.load(f)
+        except Exception as e:
+            logger.error(f"Не удалось прочитать {path} для импорта состояния: {e}", exc_info=True)
+            return
+        for user_id, user_data in (data.get('user_data') or {}).items():
+            self._stage(KIND_USER, user_id, user_data)
+        for chat_id, chat_data in (data.get('chat_data') or {}).items():
+            self._stage(KIND_CHAT, chat_id, chat_data)
+        for bot_key, value in (data.get('bot_data') or {}).items():
+            self._stage(KIND_BOT, bot_key, value)
+            self._bot_keys.add(repr(bot_key))
+        for name, states in (data.get('conversations') or {}).items():
+            for conv_key, state in states.items():
+                self._stage(CONVERSATION_PREFIX + name, conv_key, state)
+        await self._write_pending()
+        logger.info(f"Состояние бота импортировано из {path}.")
+
+    # --- Чтение ---
+    async def _load(self, kind: str) -> list[tuple]:
+        await self._ensure_ready()
+        conn = await database.get_db_connection()
+        try:
+            rows = await conn.fetch(
+                "SELECT key, data, EXTRACT(EPOCH FROM NOW() - updated_at)::float8 AS age FROM bot_persistence WHERE kind = $1",
+                kind
+            )
+        finally:
+            await conn.close()
+        now = timer.monotonic()
+        result = []
+        for row in rows:
+            blob = bytes(row['data'])
+            try:
+                key, value = pickle.loads(blob)
+            except Exception as e:
+                logger.error(f"Не удалось восстановить запись {kind}/{row['key']}: {e}")
+                continue
+            if self.shard and kind != self._bot_kind and not sharding.owns_key(key):
+                continue
+            self._digests[(kind, row['key'])] = self._digest(blob)
+            self._written_at[(kind, row['key'])] = now - row['age']
+            result.append((key, value))
+        return result
+
+    async def get_user_data(self) -> dict:
+        return dict(await self._load(KIND_USER))
+
+    async def get_chat_data(self) -> dict:
+        return dict(await self._load(KIND_CHAT))
+
+    async def get_bot_data(self) -> dict:
+        items = await self._load(self._bot_kind)
+        if not items and self._bot_kind != KIND_BOT:
+            # Первый запуск шарда: стартуем с общего bot_data, дальше пишем в свой
+            items = await self._load(KIND_BOT)
+        self._bot_keys = {repr(key) for key, _ in items}
+        return dict(items)
+
+    async def load_bot_data_value(self, bot_key):
+        """Текущее значение ключа bot_data в БД (например, записанное другой репликой) или None."""
+        await self._ensure_ready()
+        conn = await database.get_db_connection()
+        try:
+            blob = await conn.fetchval(
+                "SELECT data FROM bot_persistence WHERE kind = $1 AND key = $2", self._bot_kind, repr(bot_key)
+            )
+        finally:
+            await conn.close()
+        if blob is None:
+            return None
+        try:
+            return pickle.loads(bytes(blob))[1]
+        except Exception as e:
+            logger.error(f"Не удалось восстановить запись {self._bot_kind}/{bot_key!r}: {e}")
+            return None
+
+    async def get_conversations(self, name: str) -> dict:
+        return dict(await self._load(CONVERSATION_PREFIX + name))
+
+    async def get_callback_data(self):
+        return None
+
+    # --- Запись: только изменившиеся ключи ---
+    @staticmethod
+    def _digest(blob: bytes) -> bytes:
+        return hashlib.blake2b(blob, digest_size=16).digest()
+
+    def _stage(self, kind: str, key, value):
+        """Пиклит значение и ставит в очередь на запись, если оно изменилось или строка давно не обновлялась."""
+        row_key = (kind, repr(key))
+        try:
+            blob = pickle.dumps((key, value), protocol=pickle.HIGHEST_PROTOCOL)
+        except Exception as e:
+            logger.error(f"Не удалось сохранить состояние {kind}/{key!r}: {e}")
+            return
+        digest = self._digest(blob)
+        if (self._digests.get(row_key) == digest
+                and timer.monotonic() - self._written_at.get(row_key, float('-inf')) < self._refresh_after):
+            return
+        self._digests[row_key] = digest
+        self._pending[row_key] = blob
+        self._schedule_flush()
+
+    def _stage_delete(self, kind: str, key_text: str):
+        row_key = (kind, key_text)
+        self._digests.pop(row_key, None)
+        self._written_at.pop(row_key, None)
+        self._pending[row_key] = None
+        self._schedule_flush()
+
+    def _schedule_flush(self):
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.get_running_loop().create_task(self._delayed_flush())
+
+    async def _delayed_flush(self):
+        await asyncio.sleep(self.flush_delay)
+        # shield: отмена задачи при остановке не должна обрывать уже начатую запись
+        await asyncio.shield(self._write_pending())
+
+    async def _write_pending(self):
+        # Блокировка сохраняет порядок записей: более свежая пачка не обгонит предыдущую
+        async with self._write_lock:
+            if not self._pending:
+                return
+            pending, self._pending = self._pending, {}
+            upserts = [(kind, key, blob) for (kind, key), blob in pending.items() if blob is not None]
+            deletes = [(kind, key) for (kind, key), blob in pending.items() if blob is None]
+            try:
+                await self._ensure_ready()
+                conn = await database.get_db_connection()
+                try:
+                    async with conn.transaction():
+                        if upserts:
+                            await conn.executemany(
+                                """
+                                INSERT INTO bot_persistence (kind, key, data, updated_at) VALUES ($1, $2, $3, NOW())
+                                ON CONFLICT (kind, key) DO UPDATE SET data = EXCLUDED.data, updated_at = NOW()
+                                """,
+                                upserts
+                            )
+                        if deletes:
+                            await conn.executemany("DELETE FROM bot_persistence WHERE kind = $1 AND key = $2", deletes)
+                finally:
+                    await conn.close()
+                written_at = timer.monotonic()
+                for kind, key, _ in upserts:
+                    self._written_at[(kind, key)] = written_at
+            except Exception as e:
+                logger.error(f"Не удалось записать состояние бота ({len(pending)} ключей): {e}", exc_info=True)
+                # Возвращаем неудавшиеся записи в очередь, не затирая более свежие изменения
+                for row_key, blob in pending.items():
+                    self._pending.setdefault(row_key, blob)
+                    self._digests.pop(row_key, None)
+                    if row_key[0] == self._bot_kind:
+                        self._bot_values.pop(row_key[1], None)
+                self._schedule_flush()
+
+    async def update_user_data(self, user_id: int, data: dict) -> None:
+        self._stage(KIND_USER, user_id, data)
+
+    async def update_chat_data(self, chat_id: int, data: dict) -> None:
+        self._stage(KIND_CHAT, chat_id, data)
+
+    async def update_bot_data(self, data: dict) -> None:
+        # data - глубокая копия от PTB, поэтому ее значения можно хранить для сравнения со следующим вызовом
+        current_keys = set()
+        for bot_key, value in data.items():
+            key_text = repr(bot_key)
+            current_keys.add(key_text)
+            if _same_value(self._bot_values.get(key_text, _MISSING), value):
+                continue
+            self._bot_values[key_text] = value
+            self._stage(self._bot_kind, bot_key, value)
+        for removed_key in self._bot_keys - current_keys:
+            self._bot_values.pop(removed_key, None)
+            self._stage_delete(self._bot_kind, removed_key)
+        self._bot_keys = current_keys
+
+    async def update_conversation(self, name: str, key: tuple, new_state) -> None:
+        if new_state is None:
+            self._stage_delete(CONVERSATION_PREFIX + name, repr(key))
+        else:
+            self._stage(CONVERSATION_PREFIX + name, key, new_state)
+
+    async def update_callback_data(self, data) -> None:
+        pass
+
+    async def drop_user_data(self, user_id: int) -> None:
+        self._stage_delete(KIND_USER, repr(user_id))
+
+    async def drop_chat_data(self, chat_id: int) -> None:
+        self._stage_delete(KIND_CHAT, repr(chat_id))
+
+    async def refresh_user_data(self, user_id: int, user_data: dict) -> None:
+        pass
+
+    async def refresh_chat_data(self, chat_id: int, chat_data: dict) -> None:
+        pass
+
+    async def refresh_bot_data(self, bot_data: dict) -> None:
+        pass
+
+    async def flush(self) -> None:
+        """Вызывается PTB при остановке: дописывает все накопленные изменения сразу."""
+        if self._flush_task and not self._flush_task.done():
+            self._flush_task.cancel()
+        await self._write_pending()
+
+
+def _same_value(previous, value) -> bool:
+    """Дешевая проверка перед пиклингом; при сомнении (другой тип, ошибка сравнения) - считаем изменившимся."""
+    if previous is _MISSING or type(previous) is not type(value):
+        return False
+    try:
+        return bool(previous == value)
+    except Exception:
+        return False
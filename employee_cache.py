@@ -0,0 +1,56 @@
+# employee_cache.py
+import logging
+import time as timer
+
+from config import EMPLOYEE_CACHE_TTL_SECONDS
+from invalidation_bus import invalidation_bus, InvalidationMessage, EMPLOYEE, RESET
+
+logger = logging.getLogger(__name__)
+
+
+class ActiveEmployeeCache:
+    """
+    Множество telegram_id активных сотрудников в памяти для проверок доступа без запроса к БД.
+    Обновляется точечно при изменениях (через шину инвалидации - из этого или другого процесса)
+    и полностью перечитывается по истечении EMPLOYEE_CACHE_TTL_SECONDS.
+    """
+
+    def __init__(self, ttl_seconds: float = EMPLOYEE_CACHE_TTL_SECONDS):
+        self.ttl_seconds = ttl_seconds
+        self._active_ids: set[int] = set()
+        self._loaded_at: float | None = None
+
+    def is_stale(self) -> bool:
+        return self._loaded_at is None or timer.monotonic() - self._loaded_at > self.ttl_seconds
+
+    def mark_stale(self):
+        """Заставляет перечитать список при следующей проверке (например, после потери LISTEN-соединения)."""
+        self._loaded_at = None
+
+    def replace(self, active_ids):
+        self._active_ids = set(active_ids)
+        self._loaded_at = timer.monotonic()
+
+    def set_status(self, telegram_id: int, is_active: bool):
+        if is_active:
+            self._active_ids.add(telegram_id)
+        else:
+            self._active_ids.discard(telegram_id)
+
+    def __contains__(self, telegram_id: int) -> bool:
+        return telegram_id in self._active_ids
+
+    def __len__(self) -> int:
+        return len(self._active_ids)
+
+
+employee_cache = ActiveEmployeeCache()
+
+
+def _on_employee_change(message: InvalidationMessage):
+    if message.is_active is not None:
+        employee_cache.set_status(message.telegram_id, message.is_active)
+
+
+invalidation_bus.subscribe(EMPLOYEE, _on_employee_change)
+invalidation_bus.subscribe(RESET, lambda message: employee_cache.mark_stale())
@@ -0,0 +1,129 @@
+# fake_bot_api.py
+"""
+Локальная заглушка Telegram Bot API для проверки диспетчера сообщений и рассылок без реального Telegram.
+Имитирует лимиты: не больше GLOBAL_LIMIT сообщений в секунду на бота и одного сообщения в секунду
+в один чат, при нарушении отвечает 429 с retry_after, как настоящий API.
+
+Запуск:  python fake_bot_api.py [порт] [задержка_мс]
+В .env бота:  BOT_API_BASE_URL=http://127.0.0.1:8081/bot
+Статистика:   GET http://127.0.0.1:8081/stats
+Апдейты:      POST http://127.0.0.1:8081/fake/updates (тело - JSON апдейта): после setWebhook заглушка
+              перешлет его на вебхук с секретным токеном, иначе отдаст в ответе на getUpdates.
+"""
+import asyncio
+import json
+import sys
+import time as timer
+import urllib.parse
+from collections import defaultdict, deque
+
+import httpx
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse
+
+GLOBAL_LIMIT = 30
+PER_CHAT_INTERVAL = 1.0
+
+app = FastAPI(title="Fake Telegram Bot API")
+app.state.latency = 0.0
+stats = {'sent': 0, 'rate_limited': 0, 'by_chat': defaultdict(int)}
+_recent = deque()
+_last_by_chat: dict[int, float] = {}
+_message_id = 0
+_webhook = {'url': None, 'secret_token': None}
+_updates: deque = deque()  # Апдейты для getUpdates, пока вебхук не установлен
+
+
+async def _read_params(request: Request) -> dict:
+    body = await request.body()
+    if request.headers.get('content-type', '').startswith('application/json'):
+        return json.loads(body or b'{}')
+    params = {}
+    for key, value in urllib.parse.parse_qsl(body.decode()):
+        try:
+            params[key] = json.loads(value)
+        except ValueError:
+            params[key] = value
+    return params
+
+
+def _too_many_requests(retry_after: int) -> JSONResponse:
+    stats['rate_limited'] += 1
+    return JSONResponse(status_code=429, content={
+        "ok": False, "error_code": 429, "description": f"Too Many Requests: retry after {retry_after}",
+        "parameters": {"retry_after": retry_after}
+    })
+
+
+@app.get("/stats")
+async def get_stats():
+    return {**stats, 'by_chat': dict(stats['by_chat'])}
+
+
+@app.post("/fake/updates")
+async def push_update(request: Request):
+    """Доставляет апдейт на зарегистрированный вебхук, как это делает Telegram, или ставит в очередь getUpdates."""
+    if not _webhook['url']:
+        _updates.append(await request.json())
+        return {"ok": True, "queued": len(_updates)}
+    headers = {"X-Telegram-Bot-Api-Secret-Token": _webhook['secret_token'] or ""}
+    async with httpx.AsyncClient() as client:
+        response = await client.post(_webhook['url'], content=await request.body(),
+                                     headers={**headers, "Content-Type": "application/json"})
+    return {"ok": response.status_code == 200, "webhook_status": response.status_code}
+
+
+@app.post("/bot{token}/{method}")
+async def bot_method(token: str, method: str, request: Request):
+    global _message_id
+    params = await _read_params(request)
+    if app.state.latency:
+        await asyncio.sleep(app.state.latency)
+
+    if method == 'getMe':
+        return {"ok": True, "result": {"id": 1, "is_bot": True, "first_name": "Fake", "username": "fake_checkin_bot",
+                                       "can_join_groups": False, "can_read_all_group_messages": False,
+                                       "supports_inline_queries": False}}
+    if method == 'setWebhook':
+        _webhook.update(url=params.get('url'), secret_token=params.get('secret_token'))
+        return {"ok": True, "result": True}
+    if method == 'deleteWebhook':
+        _webhook.update(url=None, secret_token=None)
+        return {"ok": True, "result": True}
+    if method == 'setMyCommands':
+        return {"ok": True, "result": True}
+    if method == 'getUpdates':
+        offset = int(params.get('offset') or 0)
+        while _updates and _updates[0]['update_id'] < offset:
+            _updates.popleft()  # Подтверждены клиентом
+        if not _updates:
+            await asyncio.sleep(min(float(params.get('timeout', 0) or 0), 1))
+        return {"ok": True, "result": list(_updates)[:int(params.get('limit') or 100)]}
+    if method != 'sendMessage':
+        return JSONResponse(status_code=400, content={
+            "ok": False, "error_code": 400, "description": f"Bad Request: method {method} is not emulated"
+        })
+
+    chat_id = int(params['chat_id'])
+    now = timer.monotonic()
+    while _recent and now - _recent[0] > 1:
+        _recent.popleft()
+    if len(_recent) >= GLOBAL_LIMIT:
+        return _too_many_requests(1)
+    if now - _last_by_chat.get(chat_id, -PER_CHAT_INTERVAL) < PER_CHAT_INTERVAL:
+        return _too_many_requests(1)
+
+    _recent.append(now)
+    _last_by_chat[chat_id] = now
+    _message_id += 1
+    stats['sent'] += 1
+    stats['by_chat'][chat_id] += 1
+    return {"ok": True, "result": {"message_id": _message_id, "date": int(timer.time()),
+                                   "chat": {"id": chat_id, "type": "private"}, "text": params.get('text', '')}}
+
+
+if __name__ == "__main__":
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else 8081
+    app.state.latency = (int(sys.argv[2]) if len(sys.argv) > 2 else 0) / 1000
+    uvicorn.run(app, host="127.0.0.1", port=port)
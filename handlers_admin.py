@@ -2,8 +2,13 @@
 import logging
 import re
 import csv
+import calendar
 import database
 import config
+import report_grid
+
+from report_cache import report_cache
+from query_profiler import query_profiler
 
 from datetime import time, datetime, date, timedelta
 from io import StringIO, BytesIO
@@ -12,6 +17,7 @@ from telegram import Update, ReplyKeyboardMarkup, InputFile, MessageOriginUser,
 from telegram.ext import ContextTypes, ConversationHandler
 
 from jobs import send_report_for_period
+from message_dispatcher import get_message_dispatcher
 from keyboards import admin_menu_keyboard, reports_menu_keyboard, leave_type_keyboard, holidays_menu_keyboard
 from keyboards import (
     BUTTON_LEAVE_TYPE_VACATION, BUTTON_LEAVE_TYPE_SICK
@@ -124,18 +130,25 @@ async def admin_monthly_csv_get_month(update: Update, context: ContextTypes.DEFA
 
         await update.message.reply_text(f"Пожалуйста, подождите, идет формирование сводного отчета за {month:02d}.{year}...")
         
-        summary_data = await database.get_monthly_summary_data(year, month)
-
-        if not summary_data or len(summary_data) <= 1:
-            await update.message.reply_text("Нет данных для формирования отчета за указанный период.")
-            await admin_reports_menu(update, context)
-            return config.ADMIN_REPORTS_MENU
-
-        output = StringIO()
-        writer = csv.writer(output)
-        writer.writerows(summary_data)
+        start_date = date(year, month, 1)
+        end_date = date(year, month, calendar.monthrange(year, month)[1])
+        encoded_csv = report_cache.get('monthly_csv', start_date, end_date)
+        if encoded_csv is None:
+            generation = report_cache.generation
+            summary_data = await database.get_monthly_summary_data(year, month)
+
+            if not summary_data or len(summary_data) <= 1:
+                await update.message.reply_text("Нет данных для формирования отчета за указанный период.")
+                await admin_reports_menu(update, context)
+                return config.ADMIN_REPORTS_MENU
+
+            output = StringIO()
+            writer = csv.writer(output)
+            writer.writerows(summary_data)
+            encoded_csv = output.getvalue().encode('utf-8')
+            report_cache.put('monthly_csv', start_date, end_date, encoded_csv, generation=generation, weight=len(encoded_csv))
         
-        csv_bytes = BytesIO(output.getvalue().encode('utf-8'))
+        csv_bytes = BytesIO(encoded_csv)
         filename = f"monthly_summary_{year}_{month:02d}.csv"
         
         await update.message.reply_document(
@@ -154,6 +167,48 @@ async def admin_monthly_csv_get_month(update: Update, context: ContextTypes.DEFA
         )
         return config.MONTHLY_CSV_GET_MONTH
 
+async def admin_range_report(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Команда /range_report ДД.ММ.ГГГГ-ДД.ММ.ГГГГ: матрица посещаемости за произвольный период в CSV."""
+    if update.effective_user.id not in ADMIN_IDS:
+        return
+
+    try:
+        start_date_str, end_date_str = "".join(context.args).split('-')
+        start_date = datetime.strptime(start_date_str.strip(), '%d.%m.%Y').date()
+        end_date = datetime.strptime(end_date_str.strip(), '%d.%m.%Y').date()
+    except (ValueError, IndexError):
+        await update.message.reply_text("Использование: /range_report ДД.ММ.ГГГГ-ДД.ММ.ГГГГ\nНапример: /range_report 01.01.2025-31.12.2025")
+        return
+
+    if start_date > end_date:
+        await update.message.reply_text("Ошибка: Начальная дата не может быть позже конечной.")
+        return
+    if (end_date - start_date).days + 1 > config.REPORT_MAX_RANGE_DAYS:
+        await update.message.reply_text(f"Ошибка: Период не может быть длиннее {config.REPORT_MAX_RANGE_DAYS} дней.")
+        return
+
+    period_str = f"{start_date.strftime('%d.%m.%Y')}-{end_date.strftime('%d.%m.%Y')}"
+    await update.message.reply_text(f"Пожалуйста, подождите, идет формирование отчета за {period_str}...")
+
+    output = StringIO()
+    writer = csv.writer(output)
+    writer.writerow(report_grid.range_header(start_date, end_date))
+    rows_count = 0
+    async for employee_row in database.iter_attendance_rows(start_date, end_date):
+        writer.writerow(employee_row)
+        rows_count += 1
+
+    if not rows_count:
+        await update.message.reply_text("Нет данных для формирования отчета за указанный период.")
+        return
+
+    csv_bytes = BytesIO(output.getvalue().encode('utf-8'))
+    filename = f"attendance_{start_date.isoformat()}_{end_date.isoformat()}.csv"
+    await update.message.reply_document(
+        document=InputFile(csv_bytes, filename=filename),
+        caption=f"Сводный отчет по посещаемости за {period_str} ({rows_count} сотрудников)"
+    )
+
 async def handle_leave_request_decision(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Обрабатывает решение администратора по запросу на уход."""
     query = update.callback_query
@@ -179,14 +234,14 @@ async def handle_leave_request_decision(update: Update, context: ContextTypes.DE
 
         await query.edit_message_text(text=f"{original_text}\n\n✅ *ВЫ РАЗРЕШИЛИ УХОД*", parse_mode='Markdown')
         try:
-            await context.bot.send_message(chat_id=user_id, text="✅ Ваш запрос на уход одобрен. Ваш рабочий день завершен.")
+            await get_message_dispatcher(context.bot).send(user_id, "✅ Ваш запрос на уход одобрен. Ваш рабочий день завершен.")
         except Exception as e:
             logger.error(f"Не удалось уведомить сотрудника {user_id} об одобрении: {e}")
 
     elif action == 'deny':
         await query.edit_message_text(text=f"{original_text}\n\n❌ *ВЫ ОТКЛОНИЛИ ЗАПРОС*", parse_mode='Markdown')
         try:
-            await context.bot.send_message(chat_id=user_id, text="❌ В вашем запросе на уход было отказано. Не забудьте отметиться в конце рабочего дня.")
+            await get_message_dispatcher(context.bot).send(user_id, "❌ В вашем запросе на уход было отказано. Не забудьте отметиться в конце рабочего дня.")
         except Exception as e:
             logger.error(f"Не удалось уведомить сотрудника {user_id} об отказе: {e}")
 
@@ -536,17 +591,25 @@ async def handle_schedule_file(update: Update, context: ContextTypes.DEFAULT_TYP
         await update.message.reply_text(f"Критическая ошибка при чтении файла: {e}")
         return ConversationHandler.END
 
+    diff = {'changes': [], 'unchanged': [], 'unknown': []}
     if schedules_to_update:
         try:
-            await database.bulk_add_or_update_schedules(schedules_to_update)
+            # Сначала только считаем изменения, запись - после подтверждения
+            diff = await database.bulk_add_or_update_schedules(schedules_to_update, dry_run=True)
         except Exception as e:
-            await update.message.reply_text(f"Произошла ошибка при обновлении данных в базе: {e}")
+            await update.message.reply_text(f"Произошла ошибка при сравнении с данными в базе: {e}")
             return ConversationHandler.END
-            
-    success_count = len(schedules_to_update)
-    error_count = len(errors)
-    
-    summary = f"Обработка файла завершена.\n\n✅ Успешно обработано и готово к обновлению: *{success_count}* записей.\n❌ Обнаружено ошибок: *{error_count}*."
+
+    for telegram_id in diff['unknown']:
+        errors.append(f"Сотрудник с ID {telegram_id} не найден в базе. Сначала добавьте его.")
+
+    summary = (
+        f"Обработка файла завершена.\n\n"
+        f"🆕 Новых графиков: *{sum(1 for c in diff['changes'] if c['kind'] == 'added')}*\n"
+        f"✏️ Изменений: *{sum(1 for c in diff['changes'] if c['kind'] == 'changed')}*\n"
+        f"➖ Без изменений (будут пропущены): *{len(diff['unchanged'])}*\n"
+        f"❌ Обнаружено ошибок: *{len(errors)}*."
+    )
     await update.message.reply_text(summary, parse_mode='Markdown')
 
     if errors:
@@ -558,6 +621,68 @@ async def handle_schedule_file(update: Update, context: ContextTypes.DEFAULT_TYP
             caption="Найдены ошибки. Исправьте их в исходном файле и отправьте его снова."
         )
 
+    if not diff['changes']:
+        await update.message.reply_text("Изменений для записи нет.")
+        return ConversationHandler.END
+
+    await update.message.reply_text(
+        _format_schedules_diff_preview(diff['changes']),
+        reply_markup=ReplyKeyboardMarkup([[config.BUTTON_APPLY_SCHEDULES, config.BUTTON_CANCEL_SCHEDULES]], resize_keyboard=True, one_time_keyboard=True)
+    )
+    context.user_data['pending_schedules_diff'] = diff
+    context.user_data['pending_schedules_data'] = schedules_to_update
+    return config.AWAITING_SCHEDULE_CONFIRM
+
+def _format_schedules_diff_preview(changes: list[dict], limit: int = 20) -> str:
+    """Формирует текст предпросмотра изменений графиков (только измененные дни)."""
+    def fmt(times):
+        start_time, end_time = times
+        if start_time and end_time:
+            return f"{start_time.strftime('%H:%M')}-{end_time.strftime('%H:%M')}"
+        return "выходной"
+
+    short_days = ["Пн", "Вт", "Ср", "Чт", "Пт", "Сб", "Вс"]
+    lines = ["Предпросмотр изменений:"]
+    for change in changes[:limit]:
+        header = f"• {change['full_name']} ({change['telegram_id']}) с {change['effective_date'].strftime('%d.%m.%Y')}"
+        if change['kind'] == 'added':
+            lines.append(f"{header}: новый график")
+            continue
+        days = [
+            f"{short_days[i]} {fmt(old)} → {fmt(new)}"
+            for i, (old, new) in enumerate(zip(change['old_week'], change['new_week'])) if old != new
+        ]
+        lines.append(f"{header}: {'; '.join(days)}")
+    if len(changes) > limit:
+        lines.append(f"... и еще {len(changes) - limit}")
+    lines.append("\nПрименить изменения?")
+    return "\n".join(lines)
+
+async def handle_schedule_confirm(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    """Записывает подготовленные изменения графиков после подтверждения администратора."""
+    diff = context.user_data.pop('pending_schedules_diff', None)
+    schedules_data = context.user_data.pop('pending_schedules_data', None)
+    if update.message.text != config.BUTTON_APPLY_SCHEDULES or not diff or not schedules_data:
+        await update.message.reply_text("Изменения не применены.", reply_markup=admin_menu_keyboard())
+        return ConversationHandler.END
+
+    try:
+        rows_written = await database.apply_schedules_diff(diff, schedules_data)
+    except database.SchedulesChangedError:
+        await update.message.reply_text(
+            "Графики в базе изменились после предпросмотра, изменения не применены. "
+            "Отправьте файл снова, чтобы увидеть актуальный список изменений.",
+            reply_markup=admin_menu_keyboard()
+        )
+        return ConversationHandler.END
+    except Exception as e:
+        await update.message.reply_text(f"Произошла ошибка при обновлении данных в базе: {e}", reply_markup=admin_menu_keyboard())
+        return ConversationHandler.END
+
+    await update.message.reply_text(
+        f"✅ Графики обновлены для {len(diff['changes'])} сотрудников (записано строк: {rows_written}).",
+        reply_markup=admin_menu_keyboard()
+    )
     return ConversationHandler.END
 
 # --- КОНЕЦ НОВОГО БЛОКА ---
@@ -832,6 +957,46 @@ async def admin_back_to_menu(update: Update, context: ContextTypes.DEFAULT_TYPE)
     await admin_command(update, context)
     return ADMIN_MENU
 
+def _format_query_stats(top: int = 10) -> str:
+    """Текст сводки query_profiler: время по функциям и самые медленные запросы этого процесса."""
+    since = datetime.fromtimestamp(query_profiler.started_at, LOCAL_TIMEZONE).strftime('%d.%m.%Y %H:%M')
+    lines = [f"Запросы к БД из процесса бота с {since}", "", "По функциям (всего с / вызовов / сред. мс / макс. мс / медленных):"]
+    for call_site, stats in query_profiler.by_function()[:top]:
+        lines.append(f"{call_site}: {stats.total:.2f} / {stats.calls} / {stats.total / stats.calls * 1000:.1f} / "
+                     f"{stats.max * 1000:.0f} / {stats.slow}" + (f", ошибок: {stats.errors}" if stats.errors else ""))
+    lines += ["", "Самые долгие запросы (макс. мс, вызовов):"]
+    for call_site, query, stats in query_profiler.top_queries(5, key='max'):
+        lines.append(f"{stats.max * 1000:.0f} мс, {stats.calls}x, {call_site}: {query[:150]}")
+    if query_profiler.untracked:
+        lines.append(f"\nЗапросов вне статистики (превышен лимит записей): {query_profiler.untracked}")
+    return "\n".join(lines)
+
+async def admin_db_stats(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Команда /db_stats [reset]: где тратится время БД - профиль запросов бота и pg_stat_statements."""
+    if update.effective_user.id not in ADMIN_IDS:
+        return
+
+    if context.args and context.args[0].lower() == "reset":
+        query_profiler.reset()
+        await update.message.reply_text("Статистика запросов сброшена.")
+        return
+
+    text = _format_query_stats()
+    try:
+        statements = await database.get_pg_stat_statements(5)
+    except Exception as e:
+        logger.error(f"Ошибка при чтении pg_stat_statements: {e}", exc_info=True)
+        statements = None
+    if statements is None:
+        text += "\n\npg_stat_statements недоступно (расширение не установлено)."
+    else:
+        text += "\n\npg_stat_statements, все клиенты БД (всего с / вызовов / сред. мс):"
+        for row in statements:
+            query = " ".join(row['query'].split())[:150]
+            text += f"\n{row['total_ms'] / 1000:.2f} / {row['calls']} / {row['mean_ms']:.1f}: {query}"
+
+    await update.message.reply_text(text[:4000])  # Лимит длины сообщения Telegram
+
 async def admin_web_ui(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Отправляет кнопку для открытия веб-интерфейса администратора."""
     # ВАЖНО: URL должен указывать на адрес, где запущен ваш webapp.
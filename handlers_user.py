@@ -1,21 +1,24 @@
 # handlers_user.py
+from __future__ import annotations
+
 import logging
 import asyncio
 import random
-import face_recognition
-import numpy as np
 import database
 import config
+import metrics
+import tracing
 
 from datetime import datetime, date, time, timedelta
 from io import BytesIO
-from concurrent.futures import ProcessPoolExecutor
+from typing import TYPE_CHECKING
 from app_context import get_process_pool_executor
+from message_dispatcher import get_message_dispatcher
 from telegram import Update, ReplyKeyboardMarkup, KeyboardButton, ReplyKeyboardRemove, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import ContextTypes, ConversationHandler
-from geopy.distance import geodesic
 
 from database import is_day_finished_for_user
+from notification_ledger import get_notification_ledger, FLAG_UNHANDLED_LATE
 from decorators import check_active_employee
 from keyboards import main_menu_keyboard
 
@@ -25,28 +28,51 @@ from config import (
     AWAITING_LEAVE_REASON, ADMIN_IDS, AWAITING_NEW_FACE_PHOTO
 )
 
+if TYPE_CHECKING:
+    import numpy as np
+
+# face_recognition (dlib и модели) и NumPy импортируются только внутри воркеров пула процессов:
+# основной процесс бота их не загружает, а пул прогревает их заранее (app_context).
+
 def _face_recognition_worker(image_bytes: bytes) -> np.ndarray | None:
     """Синхронная функция для поиска и кодирования лица на фото."""
-    image = face_recognition.load_image_file(BytesIO(image_bytes))
-    face_encodings = face_recognition.face_encodings(image)
+    import face_recognition
+    with tracing.span("face_worker.load_image"):
+        image = face_recognition.load_image_file(BytesIO(image_bytes))
+    with tracing.span("face_worker.encode"):
+        face_encodings = face_recognition.face_encodings(image)
     return face_encodings[0] if face_encodings else None
 
 def _face_verification_worker(image_bytes: bytes, known_encoding_bytes: bytes, threshold: float) -> tuple[float, bool]:
     """Синхронная функция для сравнения двух лиц с заданным порогом."""
+    import face_recognition
+    import numpy as np
     known_encoding = np.frombuffer(known_encoding_bytes)
-    image = face_recognition.load_image_file(BytesIO(image_bytes))
+    with tracing.span("face_worker.load_image"):
+        image = face_recognition.load_image_file(BytesIO(image_bytes))
     
-    new_face_encodings = face_recognition.face_encodings(image)
+    with tracing.span("face_worker.encode"):
+        new_face_encodings = face_recognition.face_encodings(image)
     if not new_face_encodings:
         return 0.0, False
         
-    distance = face_recognition.face_distance([known_encoding], new_face_encodings[0])[0]
+    with tracing.span("face_worker.compare"):
+        distance = face_recognition.face_distance([known_encoding], new_face_encodings[0])[0]
     similarity_score = max(0.0, (1.0 - distance) * 100)
     is_match = distance < threshold
     return similarity_score, is_match
 
 logger = logging.getLogger(__name__)
 
+FACE_WORKER_SECONDS = metrics.registry.histogram(
+    "checkin_face_worker_seconds", "Время распознавания и сравнения лица в пуле процессов (с ожиданием воркера)"
+)
+FACE_VERIFICATIONS = metrics.registry.counter("checkin_face_verifications_total", "Проверки лица по результату", ("result",))
+CHECKIN_SECONDS = metrics.registry.histogram(
+    "checkin_processing_seconds", "Обработка чекина от получения геолокации до ответа сотруднику"
+)
+
+@tracing.traced()
 async def verify_face(user_id: int, new_photo_file_id: str, context: ContextTypes.DEFAULT_TYPE, custom_threshold: float = None) -> tuple[float, bool]:
     """
     Верифицирует лицо на фото.
@@ -54,24 +80,26 @@ async def verify_face(user_id: int, new_photo_file_id: str, context: ContextType
     """
     employee_data = await database.get_employee_data(user_id)
     if not employee_data or not employee_data["face_encoding"]:
+        FACE_VERIFICATIONS.labels("no_encoding").inc()
         return 0.0, False
 
     known_encoding_bytes = employee_data["face_encoding"]
-    new_photo_file = await context.bot.get_file(new_photo_file_id)
-    
-    photo_stream = BytesIO()
-    await new_photo_file.download_to_memory(photo_stream)
-    image_bytes = photo_stream.getvalue()
+    with tracing.span("verify_face.download"):
+        new_photo_file = await context.bot.get_file(new_photo_file_id)
+        photo_stream = BytesIO()
+        await new_photo_file.download_to_memory(photo_stream)
+        image_bytes = photo_stream.getvalue()
 
     threshold_to_use = custom_threshold if custom_threshold is not None else config.FACE_DISTANCE_THRESHOLD_CHECKIN
 
-    loop = asyncio.get_running_loop()
     executor = get_process_pool_executor()
 
-    # В воркер передаем нужный порог
-    similarity_score, is_match = await loop.run_in_executor(
-        executor, _face_verification_worker, image_bytes, known_encoding_bytes, threshold_to_use
-    )
+    # В воркер передаем нужный порог; трасса чекина продолжается внутри воркера
+    with FACE_WORKER_SECONDS.time():
+        similarity_score, is_match = await tracing.run_in_executor(
+            executor, _face_verification_worker, image_bytes, known_encoding_bytes, threshold_to_use
+        )
+    FACE_VERIFICATIONS.labels("match" if is_match else "no_match").inc()
     
     logger.info(f"Сравнение для {user_id}: схожесть {similarity_score:.2f}%. Порог: < {threshold_to_use}. Результат: {is_match}")
     return similarity_score, is_match
@@ -120,6 +148,7 @@ async def register_face(update: Update, context: ContextTypes.DEFAULT_TYPE) -> i
     await update.message.reply_text("Отлично! Ваше лицо зарегистрировано.", reply_markup=main_menu_keyboard())
     return CHOOSE_ACTION
 
+@tracing.traced_handler("handle_arrival", start=True, continue_states=(AWAITING_PHOTO,))
 @check_active_employee
 async def handle_arrival(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Обрабатывает нажатие кнопки 'Приход' для своевременных и опоздавших сотрудников."""
@@ -129,7 +158,8 @@ async def handle_arrival(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         await update.message.reply_text("Вы уже отмечали приход сегодня.", reply_markup=main_menu_keyboard())
         return CHOOSE_ACTION
     
-    is_unhandled_late = user.id in context.bot_data.get('unhandled_late_users', set())
+    today = datetime.now(database.LOCAL_TIMEZONE).date()
+    is_unhandled_late = get_notification_ledger(context.bot_data).is_set(today, user.id, FLAG_UNHANDLED_LATE)
 
     if is_unhandled_late:
         logger.info(f"Пользователь {user.id} нажал 'Приход' будучи в списке опоздавших. Начинаем late check-in.")
@@ -153,6 +183,7 @@ async def handle_arrival(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     await update.message.reply_text(f"Для подтверждения прихода, пожалуйста, {action} и сделайте селфи.", reply_markup=ReplyKeyboardRemove())
     return AWAITING_PHOTO
 
+@tracing.traced_handler("handle_late_checkin", start=True, continue_states=(AWAITING_PHOTO,))
 async def handle_late_checkin(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Обрабатывает нажатие кнопки 'Отметиться с опозданием'."""
     action = random.choice(LIVENESS_ACTIONS)
@@ -205,16 +236,16 @@ async def ask_leave_get_reason(update: Update, context: ContextTypes.DEFAULT_TYP
         f"Сотрудник: *{employee_name}*\n"
         f"Причина: _{reason}_"
     )
-    for admin_id in config.ADMIN_IDS:
-        try:
-            await context.bot.send_message(chat_id=admin_id, text=text_for_admin, reply_markup=reply_markup, parse_mode='Markdown')
-        except Exception as e:
-            logger.error(f"Не удалось отправить запрос админу {admin_id}: {e}")
+    results = await get_message_dispatcher(context.bot).broadcast(config.ADMIN_IDS, text_for_admin, reply_markup=reply_markup, parse_mode='Markdown')
+    for admin_id, result in results.items():
+        if isinstance(result, Exception):
+            logger.error(f"Не удалось отправить запрос админу {admin_id}: {result}")
 
     await update.message.reply_text("Ваш запрос отправлен администратору. Ожидайте решения.", reply_markup=main_menu_keyboard())
     
     return config.CHOOSE_ACTION
 
+@tracing.traced_handler("handle_departure", start=True, continue_states=(AWAITING_PHOTO,))
 @check_active_employee
 async def handle_departure(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     user = update.effective_user
@@ -307,6 +338,7 @@ async def update_photo_receive(update: Update, context: ContextTypes.DEFAULT_TYP
     return CHOOSE_ACTION
 
 
+@tracing.traced_handler("awaiting_photo", continue_states=(AWAITING_LOCATION,))
 @check_active_employee
 async def awaiting_photo(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     # ... (скопируйте сюда содержимое функции awaiting_photo из bot.py)
@@ -315,7 +347,9 @@ async def awaiting_photo(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     await update.message.reply_text("Отлично, фото получил. Теперь, пожалуйста, подтвердите вашу геолокацию.", reply_markup=ReplyKeyboardMarkup(location_keyboard, resize_keyboard=True, one_time_keyboard=True))
     return AWAITING_LOCATION
 
+@tracing.traced_handler("awaiting_location")
 @check_active_employee
+@metrics.timed(CHECKIN_SECONDS)
 async def awaiting_location(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     user, user_location = update.effective_user, update.message.location
     photo_file_id = context.user_data.get('photo_file_id')
@@ -333,9 +367,11 @@ async def awaiting_location(update: Update, context: ContextTypes.DEFAULT_TYPE)
     await update.message.reply_text("Геолокация получена. Начинаю проверку...", reply_markup=ReplyKeyboardRemove())
     
     user_coords = (user_location.latitude, user_location.longitude)
-    
-    # Вычисляем расстояние до каждой офисной локации
-    distances = [geodesic(office_coords, user_coords).meters for office_coords in WORK_LOCATION_COORDS]
+    with tracing.span("geodesic"):
+        from geopy.distance import geodesic  # Нужен только здесь - не грузим при старте бота
+        
+        # Вычисляем расстояние до каждой офисной локации
+        distances = [geodesic(office_coords, user_coords).meters for office_coords in WORK_LOCATION_COORDS]
     
     # Находим минимальное расстояние до ближайшего офиса
     min_distance = round(min(distances), 2)
@@ -359,8 +395,10 @@ async def awaiting_location(update: Update, context: ContextTypes.DEFAULT_TYPE)
     # Используем min_distance для логирования
     await database.log_check_in_attempt(user.id, check_in_type, status, user_location.latitude, user_location.longitude, min_distance, face_similarity)
     
-    if user.id in context.bot_data.get('unhandled_late_users', set()):
-        context.bot_data['unhandled_late_users'].remove(user.id)
+    ledger = get_notification_ledger(context.bot_data)
+    today = datetime.now(database.LOCAL_TIMEZONE).date()
+    if ledger.is_set(today, user.id, FLAG_UNHANDLED_LATE):
+        ledger.clear(today, user.id, FLAG_UNHANDLED_LATE)
         logger.info(f"Пользователь {user.id} успешно прошел late-checkin и удален из списка.")
 
     success_message = f"✅ {'Приход' if check_in_type == 'ARRIVAL' else 'Уход'} успешно отмечен!"
@@ -398,6 +436,7 @@ async def employee_cancel_command(update: Update, context: ContextTypes.DEFAULT_
     context.user_data.clear()
     return CHOOSE_ACTION
 
+@tracing.traced_handler("late_checkin_callback", start=True, continue_states=(AWAITING_PHOTO,))
 async def late_checkin_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     # ... (скопируйте сюда содержимое функции late_checkin_callback из bot.py)
     query = update.callback_query
@@ -0,0 +1,75 @@
+# holiday_calendar.py
+import bisect
+import time as timer
+from datetime import date
+
+from config import HOLIDAY_CACHE_TTL_SECONDS
+from invalidation_bus import invalidation_bus, InvalidationMessage, HOLIDAY, RESET
+
+
+class HolidayCalendar:
+    """
+    Праздничные дни в памяти: словарь дата -> название для проверок за O(1)
+    и отсортированные списки дат по годам для выборок по диапазону через bisect.
+    Загружается целиком из таблицы holidays (она небольшая), обновляется по шине инвалидации
+    и на всякий случай перечитывается через HOLIDAY_CACHE_TTL_SECONDS.
+    """
+
+    def __init__(self, ttl_seconds: float = HOLIDAY_CACHE_TTL_SECONDS):
+        self.ttl_seconds = ttl_seconds
+        self._names: dict[date, str] = {}
+        self._by_year: dict[int, list[date]] = {}
+        self._loaded_at: float | None = None
+
+    def is_stale(self) -> bool:
+        return self._loaded_at is None or timer.monotonic() - self._loaded_at > self.ttl_seconds
+
+    def mark_stale(self):
+        self._loaded_at = None
+
+    def replace(self, rows):
+        """Полностью заменяет календарь строками (holiday_date, holiday_name)."""
+        self._names = {holiday_date: holiday_name for holiday_date, holiday_name in rows}
+        self._by_year = {}
+        for holiday_date in sorted(self._names):
+            self._by_year.setdefault(holiday_date.year, []).append(holiday_date)
+        self._loaded_at = timer.monotonic()
+
+    def add(self, holiday_date: date, holiday_name: str):
+        if holiday_date not in self._names:
+            bisect.insort(self._by_year.setdefault(holiday_date.year, []), holiday_date)
+        self._names[holiday_date] = holiday_name
+
+    def remove(self, holiday_date: date):
+        if self._names.pop(holiday_date, None) is not None:
+            self._by_year[holiday_date.year].remove(holiday_date)
+
+    def __contains__(self, target_date: date) -> bool:
+        return target_date in self._names
+
+    def between(self, start_date: date, end_date: date) -> list[date]:
+        """Праздники в диапазоне [start_date, end_date] по возрастанию."""
+        result = []
+        for year in range(start_date.year, end_date.year + 1):
+            dates = self._by_year.get(year)
+            if dates:
+                result.extend(dates[bisect.bisect_left(dates, start_date):bisect.bisect_right(dates, end_date)])
+        return result
+
+    def for_year(self, year: int) -> list[dict]:
+        """Праздники года в формате get_holidays_for_year."""
+        return [{'holiday_date': d, 'holiday_name': self._names[d]} for d in self._by_year.get(year, [])]
+
+
+holiday_calendar = HolidayCalendar()
+
+
+def _on_holiday_change(message: InvalidationMessage):
+    if message.name is None:
+        holiday_calendar.remove(message.start_date)
+    else:
+        holiday_calendar.add(message.start_date, message.name)
+
+
+invalidation_bus.subscribe(HOLIDAY, _on_holiday_change)
+invalidation_bus.subscribe(RESET, lambda message: holiday_calendar.mark_stale())
@@ -0,0 +1,135 @@
+# http_cache.py
+import calendar
+import hashlib
+import os
+import re
+import uuid
+from dataclasses import dataclass, field
+from datetime import date, datetime
+from typing import Callable
+
+from fastapi import FastAPI, Request
+from fastapi.responses import Response
+
+from config import LOCAL_TIMEZONE, HTTP_CACHE_CLOSED_PERIOD_MAX_AGE
+from invalidation_bus import invalidation_bus, EMPLOYEE, SCHEDULE, LEAVE, HOLIDAY, CHECK_IN, RESET
+
+ALL_ENTITIES = (EMPLOYEE, SCHEDULE, LEAVE, HOLIDAY, CHECK_IN)
+
+
+class EntityVersions:
+    """
+    Счетчики версий сущностей: увеличиваются при каждом изменении (через шину инвалидации -
+    и из веб-панели, и из бота). ETag ответа строится из версий сущностей, от которых он зависит,
+    поэтому проверка If-None-Match не обращается к БД. epoch отличает процесс: после перезапуска
+    старые ETag не совпадут со свежими счетчиками.
+    """
+
+    def __init__(self):
+        self.epoch = uuid.uuid4().hex[:8]
+        self._versions = dict.fromkeys(ALL_ENTITIES, 0)
+
+    def bump(self, entity: str):
+        self._versions[entity] = self._versions.get(entity, 0) + 1
+
+    def bump_all(self):
+        for entity in self._versions:
+            self._versions[entity] += 1
+
+    def snapshot(self, entities) -> tuple:
+        return tuple(self._versions.get(entity, 0) for entity in entities)
+
+
+entity_versions = EntityVersions()
+
+for _entity in ALL_ENTITIES:
+    invalidation_bus.subscribe(_entity, lambda message, entity=_entity: entity_versions.bump(entity))
+invalidation_bus.subscribe(RESET, lambda message: entity_versions.bump_all())
+
+
+@dataclass(frozen=True)
+class CacheRule:
+    """
+    Правило кэширования GET-эндпоинта: path - регулярное выражение пути, entities - от чего зависит
+    ответ. period_end(match, query) возвращает последний день периода отчета: пока период не
+    закрыт, ответ зависит еще и от текущей даты; закрытый период браузер может держать max-age.
+    static_file - ответ зависит только от файла (ETag по времени изменения и размеру).
+    """
+    path: str
+    entities: tuple = ()
+    period_end: Callable | None = None
+    static_file: str | None = None
+    _regex: re.Pattern = field(init=False, repr=False, compare=False)
+
+    def __post_init__(self):
+        object.__setattr__(self, '_regex', re.compile(self.path + '$'))
+
+    def match(self, path: str):
+        return self._regex.match(path)
+
+
+def month_end(match, query) -> date:
+    year, month = int(match['year']), int(match['month'])
+    return date(year, month, calendar.monthrange(year, month)[1])
+
+
+def query_end_date(match, query) -> date:
+    return date.fromisoformat(query['end_date'])
+
+
+def _etag_and_cache_control(rule: CacheRule, match, request: Request) -> tuple[str, str]:
+    if rule.static_file:
+        stat = os.stat(rule.static_file)
+        # HTML меняется с выкладкой - браузер каждый раз переспрашивает, но получает 304
+        return f'"{stat.st_mtime_ns:x}-{stat.st_size:x}"', "no-cache"
+
+    key = [request.url.path, request.url.query, repr(entity_versions.snapshot(rule.entities))]
+    cache_control = "private, no-cache"
+    if rule.period_end is not None:
+        today = datetime.now(LOCAL_TIMEZONE).date()
+        if rule.period_end(match, request.query_params) < today:
+            cache_control = f"private, max-age={HTTP_CACHE_CLOSED_PERIOD_MAX_AGE}"
+        else:
+            key.append(today.isoformat())  # Статусы открытого периода меняются со сменой дня
+    digest = hashlib.blake2b("|".join(key).encode(), digest_size=12).hexdigest()
+    return f'W/"{entity_versions.epoch}-{digest}"', cache_control
+
+
+def _etag_matches(if_none_match: str, etag: str) -> bool:
+    # Сравнение слабое (RFC 9110): W/ не учитывается
+    bare = etag.removeprefix('W/')
+    return any(candidate.strip() == '*' or candidate.strip().removeprefix('W/') == bare
+               for candidate in if_none_match.split(','))
+
+
+def install(app: FastAPI, rules: list[CacheRule]):
+    """
+    Подключает кэширующий middleware: для GET-запросов по правилам ставит ETag и Cache-Control,
+    а на совпавший If-None-Match отвечает 304, не вызывая эндпоинт (и не обращаясь к БД).
+    """
+    @app.middleware("http")
+    async def http_cache_middleware(request: Request, call_next):
+        if request.method not in ("GET", "HEAD"):
+            return await call_next(request)
+        for rule in rules:
+            match = rule.match(request.url.path)
+            if match:
+                break
+        else:
+            return await call_next(request)
+
+        try:
+            etag, cache_control = _etag_and_cache_control(rule, match, request)
+        except (ValueError, KeyError, OSError):
+            # Некорректные параметры - пусть эндпоинт сам вернет ошибку валидации
+            return await call_next(request)
+
+        if_none_match = request.headers.get("if-none-match")
+        if if_none_match and _etag_matches(if_none_match, etag):
+            return Response(status_code=304, headers={"ETag": etag, "Cache-Control": cache_control})
+
+        response = await call_next(request)
+        if response.status_code == 200:
+            response.headers["ETag"] = etag
+            response.headers["Cache-Control"] = cache_control
+        return response
@@ -0,0 +1,180 @@
+# invalidation_bus.py
+import asyncio
+import json
+import logging
+import uuid
+from collections import defaultdict
+from contextlib import asynccontextmanager
+from dataclasses import dataclass, asdict
+from datetime import date
+
+from config import INVALIDATION_CHANNEL
+
+logger = logging.getLogger(__name__)
+
+# --- Типы сущностей, об изменении которых сообщает шина ---
+EMPLOYEE = 'employee'
+SCHEDULE = 'schedule'
+LEAVE = 'leave'
+HOLIDAY = 'holiday'
+CHECK_IN = 'check_in'
+# Служебное сообщение: связь с БД потеряна, изменения могли быть пропущены - кэши нужно сбросить
+RESET = 'reset'
+
+RECONNECT_DELAY_SECONDS = 5
+
+
+@dataclass(frozen=True)
+class InvalidationMessage:
+    """
+    Сообщение об изменении данных. Поля, не относящиеся к сущности, остаются None:
+    EMPLOYEE - telegram_id, is_active (None, если статус и ФИО не менялись);
+    SCHEDULE - telegram_id (None для массовой загрузки), start_date = дата вступления в силу;
+    LEAVE / CHECK_IN - telegram_id, start_date, end_date;
+    HOLIDAY - start_date, name (None, если праздник удален).
+    kind/status - что именно записано (для живой ленты дашборда, live_events.py):
+    CHECK_IN - check_in_type и status записи; LEAVE - тип отсутствия, status 'CANCELLED' при отмене.
+    """
+    entity: str
+    telegram_id: int | None = None
+    start_date: date | None = None
+    end_date: date | None = None
+    is_active: bool | None = None
+    name: str | None = None
+    kind: str | None = None
+    status: str | None = None
+    origin: str | None = None
+
+    def encode(self) -> str:
+        data = {key: value for key, value in asdict(self).items() if value is not None}
+        for key in ('start_date', 'end_date'):
+            if key in data:
+                data[key] = data[key].isoformat()
+        return json.dumps(data, ensure_ascii=False, separators=(',', ':'))
+
+    @classmethod
+    def decode(cls, payload: str) -> 'InvalidationMessage':
+        data = json.loads(payload)
+        for key in ('start_date', 'end_date'):
+            if key in data:
+                data[key] = date.fromisoformat(data[key])
+        return cls(**data)
+
+
+class InvalidationBus:
+    """
+    Шина инвалидации кэшей между процессами (бот и веб-панель) поверх Postgres LISTEN/NOTIFY.
+    Запись публикует сообщения внутри своей транзакции (NOTIFY доставляется только после COMMIT),
+    локальные подписчики вызываются сразу после успешного COMMIT, а сообщения от других процессов
+    приходят через выделенное LISTEN-соединение. Свои же сообщения, вернувшиеся по LISTEN,
+    отбрасываются по origin.
+    """
+
+    def __init__(self, channel: str = INVALIDATION_CHANNEL):
+        self.channel = channel
+        self.origin = uuid.uuid4().hex[:12]
+        self._handlers = defaultdict(list)
+        self._connect = None
+        self._conn = None
+        self._reconnect_task = None
+        self._stopping = False
+
+    def subscribe(self, entity: str, handler):
+        """Регистрирует синхронный обработчик handler(message) для сущности (или RESET)."""
+        self._handlers[entity].append(handler)
+
+    def dispatch(self, message: InvalidationMessage):
+        for handler in self._handlers.get(message.entity, ()):
+            try:
+                handler(message)
+            except Exception as e:
+                logger.error(f"Ошибка обработчика инвалидации для {message.entity}: {e}", exc_info=True)
+
+    @asynccontextmanager
+    async def transaction(self, conn):
+        """
+        Открывает транзакцию на conn и отдает список, куда записывающий код добавляет сообщения.
+        Перед COMMIT сообщения уходят в NOTIFY, после COMMIT - локальным подписчикам.
+        """
+        messages = []
+        async with conn.transaction():
+            yield messages
+            if self.channel and messages:
+                # Один запрос на все сообщения транзакции, сколько бы их ни было (пакетные изменения)
+                await conn.execute(
+                    "SELECT pg_notify($1, payload) FROM unnest($2::text[]) WITH ORDINALITY AS t(payload, n) ORDER BY n",
+                    self.channel, [self._with_origin(message).encode() for message in messages]
+                )
+        for message in messages:
+            self.dispatch(message)
+
+    def _with_origin(self, message: InvalidationMessage) -> InvalidationMessage:
+        return InvalidationMessage(**{**asdict(message), 'origin': self.origin})
+
+    def _on_notification(self, connection, pid, channel, payload):
+        try:
+            message = InvalidationMessage.decode(payload)
+        except (ValueError, TypeError) as e:
+            logger.warning(f"Непонятное сообщение шины инвалидации {payload!r}: {e}")
+            self.dispatch(InvalidationMessage(RESET))
+            return
+        if message.origin != self.origin:
+            self.dispatch(message)
+
+    def _on_termination(self, connection):
+        if self._stopping:
+            return
+        logger.warning("LISTEN-соединение шины инвалидации потеряно, кэши будут сброшены.")
+        self._conn = None
+        self.dispatch(InvalidationMessage(RESET))
+        self._reconnect_task = asyncio.get_running_loop().create_task(self._reconnect())
+
+    async def _listen(self):
+        conn = await self._connect()
+        try:
+            await conn.add_listener(self.channel, self._on_notification)
+        except BaseException:
+            await conn.close()
+            raise
+        conn.add_termination_listener(self._on_termination)
+        self._conn = conn
+
+    async def _reconnect(self):
+        while not self._stopping and self._conn is None:
+            await asyncio.sleep(RECONNECT_DELAY_SECONDS)
+            try:
+                await self._listen()
+                # Пока соединения не было, сообщения могли потеряться
+                self.dispatch(InvalidationMessage(RESET))
+                logger.info("LISTEN-соединение шины инвалидации восстановлено.")
+            except Exception as e:
+                logger.warning(f"Не удалось переподключить шину инвалидации: {e}")
+
+    async def start(self, connect):
+        """
+        Подписывается на канал; connect - корутина-фабрика соединения (database.get_db_connection).
+        Если БД недоступна, не падает: подписка повторяется в фоне, а после успеха кэши сбрасываются (RESET).
+        """
+        if not self.channel or self._conn is not None:
+            return
+        self._stopping = False
+        self._connect = connect
+        try:
+            await self._listen()
+        except Exception as e:
+            logger.warning(f"Шина инвалидации не подписалась на канал '{self.channel}': {e}. Повтор в фоне.")
+            if self._reconnect_task is None or self._reconnect_task.done():
+                self._reconnect_task = asyncio.get_running_loop().create_task(self._reconnect())
+            return
+        logger.info(f"Шина инвалидации слушает канал '{self.channel}' (origin={self.origin}).")
+
+    async def stop(self):
+        self._stopping = True
+        if self._reconnect_task:
+            self._reconnect_task.cancel()
+        if self._conn is not None:
+            await self._conn.close()
+            self._conn = None
+
+
+invalidation_bus = InvalidationBus()
@@ -0,0 +1,190 @@
+# job_leader.py
+import asyncio
+import functools
+import logging
+import os
+import socket
+import time as timer
+import uuid
+from datetime import datetime
+
+import metrics
+from config import JOB_LEASE_SECONDS, JOB_RUNS_RETENTION_DAYS, LOCAL_TIMEZONE
+
+logger = logging.getLogger(__name__)
+
+JOB_SECONDS = metrics.registry.histogram(
+    "checkin_job_duration_seconds", "Длительность задач планировщика (на реплике-лидере)", ("job",),
+    buckets=(0.1, 0.5, 1, 5, 15, 30, 60, 120, 300, 600, 1800)
+)
+JOB_RUNS = metrics.registry.counter("checkin_job_runs_total", "Запуски задач планировщика по исходу", ("job", "status"))
+
+# Аренда берется, если ее нет, она истекла или уже принадлежит этой реплике (тогда просто продлевается).
+# gained - аренда только что перешла к этой реплике (новая или перехваченная), а не продлена
+_ACQUIRE_SQL = """
+    INSERT INTO job_leases (job_name, holder, acquired_at, expires_at)
+    VALUES ($1, $2, NOW(), NOW() + make_interval(secs => $3))
+    ON CONFLICT (job_name) DO UPDATE
+    SET holder = EXCLUDED.holder,
+        acquired_at = CASE WHEN job_leases.holder = EXCLUDED.holder THEN job_leases.acquired_at ELSE NOW() END,
+        expires_at = EXCLUDED.expires_at
+    WHERE job_leases.holder = EXCLUDED.holder OR job_leases.expires_at < NOW()
+    RETURNING acquired_at = NOW() AS gained
+"""
+_RENEW_SQL = """
+    UPDATE job_leases SET expires_at = NOW() + make_interval(secs => $3)
+    WHERE job_name = $1 AND holder = $2
+"""
+
+
+class JobLeader:
+    """
+    Лидерство над задачами планировщика для нескольких реплик бота. У каждой задачи своя
+    аренда (строка job_leases): задачу выполняет только реплика, удерживающая аренду. Держатель
+    продлевает ее при каждом запуске и во время выполнения, поэтому задача "прилипает" к
+    одной реплике; если та упала, аренда истекает через JOB_LEASE_SECONDS и ее забирает другая.
+    Каждый запуск пишется в job_runs с уникальным ключом (задача, минута запуска) - даже при
+    смене лидера в момент срабатывания одна и та же рассылка или штраф не выполнятся дважды.
+
+    Обработчики из add_lease_gained_listener вызываются перед первым запуском задачи на реплике,
+    только что получившей аренду (чтобы перечитать общее состояние, записанное прежним лидером),
+    из add_run_finished_listener - после каждого запуска (чтобы сохранить это состояние сразу).
+    """
+
+    def __init__(self, connect, lease_seconds: float = JOB_LEASE_SECONDS):
+        self._connect = connect
+        self.lease_seconds = lease_seconds
+        self.holder = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:6]}"
+        self._lease_gained_listeners = []
+        self._run_finished_listeners = []
+
+    def add_lease_gained_listener(self, callback):
+        """callback(job_name) - корутина; ошибка в ней пишется в лог и не отменяет запуск."""
+        self._lease_gained_listeners.append(callback)
+
+    def add_run_finished_listener(self, callback):
+        """callback(job_name) - корутина, вызывается после каждого выполненного запуска."""
+        self._run_finished_listeners.append(callback)
+
+    async def _notify(self, listeners: list, job_name: str):
+        for callback in listeners:
+            try:
+                await callback(job_name)
+            except Exception as e:
+                logger.error(f"Ошибка обработчика задачи '{job_name}': {e}", exc_info=True)
+
+    def wrap(self, job_name: str, func):
+        """Возвращает корутину для add_job, выполняющую func только на реплике-лидере."""
+        @functools.wraps(func)
+        async def run(*args, **kwargs):
+            run_id, gained = await self._begin(job_name)
+            if gained:
+                await self._notify(self._lease_gained_listeners, job_name)
+            if run_id is None:
+                JOB_RUNS.labels(job_name, 'skipped').inc()
+                return
+            renew_task = asyncio.create_task(self._keep_alive(job_name))
+            status, error = 'ok', None
+            started = timer.perf_counter()
+            try:
+                await func(*args, **kwargs)
+            except Exception as e:
+                status, error = 'error', str(e)
+                logger.error(f"Задача '{job_name}' завершилась с ошибкой: {e}", exc_info=True)
+            finally:
+                renew_task.cancel()
+                JOB_SECONDS.labels(job_name).observe(timer.perf_counter() - started)
+                JOB_RUNS.labels(job_name, status).inc()
+                await self._finish(job_name, run_id, status, error)
+                await self._notify(self._run_finished_listeners, job_name)
+        return run
+
+    async def _begin(self, job_name: str) -> tuple[int | None, bool]:
+        """Берет аренду и регистрирует запуск; возвращает (id запуска или None, аренда только что получена)."""
+        scheduled_for = datetime.now(LOCAL_TIMEZONE).replace(second=0, microsecond=0)
+        try:
+            conn = await self._connect()
+        except Exception as e:
+            # Без БД лидерство не проверить - пропускаем запуск, чтобы не задвоить рассылку
+            logger.error(f"Задача '{job_name}' пропущена: нет соединения с БД ({e}).")
+            return None, False
+        try:
+            async with conn.transaction():
+                gained = await conn.fetchval(_ACQUIRE_SQL, job_name, self.holder, float(self.lease_seconds))
+                if gained is None:
+                    logger.debug(f"Задача '{job_name}' выполняется другой репликой.")
+                    return None, False
+                if gained:
+                    logger.info(f"Реплика {self.holder} получила аренду задачи '{job_name}'.")
+                run_id = await conn.fetchval("""
+                    INSERT INTO job_runs (job_name, scheduled_for, holder, started_at, status)
+                    VALUES ($1, $2, $3, NOW(), 'running')
+                    ON CONFLICT (job_name, scheduled_for) DO NOTHING
+                    RETURNING id
+                """, job_name, scheduled_for, self.holder)
+            if run_id is None:
+                logger.info(f"Задача '{job_name}' за {scheduled_for:%H:%M} уже выполнена, повтор пропущен.")
+            return run_id, gained
+        finally:
+            await conn.close()
+
+    async def _keep_alive(self, job_name: str):
+        """Продлевает аренду, пока идет долгая задача, чтобы ее не перехватила другая реплика."""
+        while True:
+            await asyncio.sleep(self.lease_seconds / 3)
+            try:
+                conn = await self._connect()
+                try:
+                    await conn.execute(_RENEW_SQL, job_name, self.holder, float(self.lease_seconds))
+                finally:
+                    await conn.close()
+            except Exception as e:
+                logger.warning(f"Не удалось продлить аренду задачи '{job_name}': {e}")
+
+    async def _finish(self, job_name: str, run_id: int, status: str, error: str | None):
+        try:
+            conn = await self._connect()
+            try:
+                await conn.execute("""
+                    UPDATE job_runs SET finished_at = NOW(), status = $2, error = $3 WHERE id = $1
+                """, run_id, status, error)
+                await conn.execute(_RENEW_SQL, job_name, self.holder, float(self.lease_seconds))
+            finally:
+                await conn.close()
+        except Exception as e:
+            logger.error(f"Не удалось записать результат задачи '{job_name}': {e}", exc_info=True)
+
+    async def cleanup_runs(self, retention_days: int = JOB_RUNS_RETENTION_DAYS):
+        """Удаляет из журнала job_runs запуски старше retention_days дней (сама запускается как задача-лидер)."""
+        conn = await self._connect()
+        try:
+            deleted = await conn.execute(
+                "DELETE FROM job_runs WHERE started_at < NOW() - make_interval(days => $1)", retention_days
+            )
+        finally:
+            await conn.close()
+        logger.info(f"Журнал запусков задач очищен, удалено записей: {deleted.split()[-1]}")
+
+    async def release_all(self):
+        """Отдает все аренды этой реплики (при остановке), чтобы другая подхватила задачи сразу."""
+        try:
+            conn = await self._connect()
+            try:
+                await conn.execute("DELETE FROM job_leases WHERE holder = $1", self.holder)
+            finally:
+                await conn.close()
+            logger.info(f"Аренды задач реплики {self.holder} освобождены.")
+        except Exception as e:
+            logger.warning(f"Не удалось освободить аренды задач: {e}")
+
+
+_job_leader = None
+
+def get_job_leader() -> JobLeader:
+    """Возвращает общий JobLeader процесса, создавая его при первом обращении."""
+    global _job_leader
+    if _job_leader is None:
+        from database import get_db_connection
+        _job_leader = JobLeader(get_db_connection)
+        logger.info(f"Идентификатор реплики для задач планировщика: {_job_leader.holder}")
+    return _job_leader
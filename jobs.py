@@ -3,8 +3,13 @@ import logging
 import re
 import config
 import database
+from report_cache import report_cache
+from message_dispatcher import get_message_dispatcher
+from sharding import owns_user
+from notification_ledger import get_notification_ledger, FLAG_WARNING, FLAG_MISSED, FLAG_DEPARTURE_REMINDER, FLAG_UNHANDLED_LATE
 
 from datetime import datetime, timedelta, time
+from functools import partial
 from telegram import InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import ContextTypes
 from database import get_all_active_employees_with_schedules, has_checked_in_today, get_report_stats_for_period, is_holiday
@@ -17,12 +22,26 @@ async def send_report_for_period(start_date, end_date, context: ContextTypes.DEF
     if not isinstance(chat_ids, list):
         chat_ids = [chat_ids]
     
+    dispatcher = get_message_dispatcher(context.bot)
+    # Не ждем отправки: диспетчер сохраняет порядок в чате, уведомление уйдет раньше отчета
     for chat_id in chat_ids:
-        try:
-            await context.bot.send_message(chat_id=chat_id, text=f"Формирую отчет: {title_prefix}...")
-        except Exception as e:
-            logger.warning(f"Не удалось отправить уведомление о начале формирования отчета на {chat_id}: {e}")
-
+        dispatcher.submit(chat_id, f"Формирую отчет: {title_prefix}...")
+
+    report_text = report_cache.get('period_text', start_date, end_date, title_prefix)
+    if report_text is None:
+        generation = report_cache.generation
+        report_text = await _render_period_report(start_date, end_date, title_prefix)
+        report_cache.put('period_text', start_date, end_date, report_text, title_prefix,
+                         generation=generation, weight=len(report_text))
+        
+    results = await dispatcher.broadcast(chat_ids, report_text, parse_mode='MarkdownV2')
+    for chat_id, result in results.items():
+        if isinstance(result, Exception):
+            logger.error(f"Не удалось отправить отчет на {chat_id}: {result}")
+            dispatcher.submit(chat_id, f"Критическая ошибка при отправке отчета: {result}")
+
+async def _render_period_report(start_date, end_date, title_prefix: str) -> str:
+    """Собирает текст отчета за период в формате MarkdownV2."""
     stats = await get_report_stats_for_period(start_date, end_date)
     
     def escape_markdown(text: str) -> str:
@@ -58,14 +77,7 @@ async def send_report_for_period(start_date, end_date, context: ContextTypes.DEF
     else:
         report_lines.append(r"    `└` Пропусков нет\!")
     
-    report_text = "\n".join(report_lines)
-        
-    for chat_id in chat_ids:
-        try:
-            await context.bot.send_message(chat_id=chat_id, text=report_text, parse_mode='MarkdownV2')
-        except Exception as e:
-            logger.error(f"Не удалось отправить отчет на {chat_id}: {e}", exc_info=True)
-            await context.bot.send_message(chat_id=chat_id, text=f"Критическая ошибка при отправке отчета: {e}")
+    return "\n".join(report_lines)
 
 async def send_daily_report_job(context: ContextTypes.DEFAULT_TYPE):
     logger.info("Формирование и отправка автоматического дневного отчета...")
@@ -139,11 +151,18 @@ async def send_dashboard_snapshot(context: ContextTypes.DEFAULT_TYPE, report_typ
 
     final_text = "\n".join(text_lines)
 
-    for admin_id in config.ADMIN_IDS:
-        try:
-            await context.bot.send_message(chat_id=admin_id, text=final_text, parse_mode='MarkdownV2')
-        except Exception as e:
-            logger.error(f"Не удалось отправить дашборд админу {admin_id}: {e}")
+    results = await get_message_dispatcher(context.bot).broadcast(config.ADMIN_IDS, final_text, parse_mode='MarkdownV2')
+    for admin_id, result in results.items():
+        if isinstance(result, Exception):
+            logger.error(f"Не удалось отправить дашборд админу {admin_id}: {result}")
+
+def _on_missed_checkin_sent(ledger, today, emp_id: int, name: str, future):
+    """Помечает сотрудника опоздавшим только если сообщение о пропуске чек-ина действительно дошло."""
+    if future.cancelled() or future.exception() is not None:
+        logger.error(f"ОШИБКА отправки уведомления об опоздании для {name}: {None if future.cancelled() else future.exception()}")
+        return
+    ledger.set(today, emp_id, FLAG_UNHANDLED_LATE)
+    logger.info(f"Сотрудник {name} (ID: {emp_id}) помечен как опоздавший.")
 
 async def check_and_send_notifications(context: ContextTypes.DEFAULT_TYPE):
     now = datetime.now(LOCAL_TIMEZONE)
@@ -152,44 +171,30 @@ async def check_and_send_notifications(context: ContextTypes.DEFAULT_TYPE):
         logger.info(f"Сегодня ({today.isoformat()}) праздник. Уведомления отключены.")
         return
     
-    today_str = today.isoformat()
-
-    # Инициализация и очистка данных
-    if 'notifications_sent' not in context.bot_data:
-        context.bot_data['notifications_sent'] = {}
-    if 'unhandled_late_users' not in context.bot_data:
-        context.bot_data['unhandled_late_users'] = set()
-    if context.bot_data.get('last_cleanup_date') != today_str:
-        context.bot_data['notifications_sent'] = {}
-        context.bot_data['unhandled_late_users'] = set()
-        context.bot_data['last_cleanup_date'] = today_str
+    # Журнал уведомлений сам обнуляется при смене дня
+    ledger = get_notification_ledger(context.bot_data)
+    dispatcher = get_message_dispatcher(context.bot)
     employees = await database.get_all_active_employees_with_schedules(today)
     if not employees:
         return
     for emp_id, name, start_time_str in employees:
         try:
-            if start_time_str is None:
+            if start_time_str is None or not owns_user(emp_id):
                 continue
             logger.info(f"---[ПРОВЕРКА]--- Сотрудник: {name} (ID: {emp_id}), график: '{start_time_str}'")
             start_time = start_time_str if isinstance(start_time_str, time) else time.fromisoformat(start_time_str)
             shift_start_datetime = datetime.combine(now.date(), start_time, tzinfo=LOCAL_TIMEZONE)
             warning_datetime = shift_start_datetime - timedelta(minutes=5)
-            warning_key = f"{emp_id}_warning_{today_str}"
-            if now >= warning_datetime and not context.bot_data['notifications_sent'].get(warning_key):
+            if now >= warning_datetime and not ledger.is_set(today, emp_id, FLAG_WARNING):
                 if not await database.has_checked_in_today(emp_id, "ARRIVAL"):
-                    await context.bot.send_message(chat_id=emp_id, text=f"🔔 Напоминание: ваш рабочий день скоро начнется. Пожалуйста, не забудьте отметиться.")
-                context.bot_data['notifications_sent'][warning_key] = True
+                    dispatcher.submit(emp_id, "🔔 Напоминание: ваш рабочий день скоро начнется. Пожалуйста, не забудьте отметиться.")
+                ledger.set(today, emp_id, FLAG_WARNING)
             missed_datetime = shift_start_datetime + timedelta(minutes=5, seconds=30)
-            missed_key = f"{emp_id}_missed_{today_str}"
-            if now >= missed_datetime and not context.bot_data['notifications_sent'].get(missed_key):
+            if now >= missed_datetime and not ledger.is_set(today, emp_id, FLAG_MISSED):
                 if not await database.has_checked_in_today(emp_id, "ARRIVAL"):
-                    try:
-                        await context.bot.send_message(chat_id=emp_id, text="Вы пропустили время для чек-ина. Пожалуйста, нажмите '✅ Приход', чтобы отметиться с опозданием.")
-                        context.bot_data['unhandled_late_users'].add(emp_id)
-                        logger.info(f"Сотрудник {name} (ID: {emp_id}) помечен как опоздавший.")
-                    except Exception as e:
-                        logger.error(f"ОШИБКА отправки уведомления об опоздании для {name}: {e}")
-                context.bot_data['notifications_sent'][missed_key] = True
+                    future = dispatcher.submit(emp_id, "Вы пропустили время для чек-ина. Пожалуйста, нажмите '✅ Приход', чтобы отметиться с опозданием.")
+                    future.add_done_callback(partial(_on_missed_checkin_sent, ledger, today, emp_id, name))
+                ledger.set(today, emp_id, FLAG_MISSED)
         except Exception as e:
             logger.error(f"Критическая ошибка в цикле уведомлений для сотрудника {name} (ID: {emp_id}): {e}", exc_info=True)
 
@@ -198,13 +203,17 @@ async def send_departure_reminders(context: ContextTypes.DEFAULT_TYPE):
     Напоминает сотрудникам отметить уход через 15 минут после окончания ИХ смены.
     """
     now = datetime.now(LOCAL_TIMEZONE)
-    today_str = now.date().isoformat()
+    today = now.date()
+    ledger = get_notification_ledger(context.bot_data)
+    dispatcher = get_message_dispatcher(context.bot)
     logger.info("---[ЗАДАЧА]--- Запуск проверки напоминаний об уходе ---")
 
     # Получаем всех, кто должен был работать сегодня
     employees = await database.get_all_active_employees_with_schedules(now.date())
 
     for emp_id, name, _ in employees:
+        if not owns_user(emp_id):
+            continue  # Сотрудника обслуживает другой шард
         try:
             # Получаем полное расписание сотрудника на сегодня, включая время ухода
             schedule = await database.get_employee_today_schedule(emp_id)
@@ -220,8 +229,7 @@ async def send_departure_reminders(context: ContextTypes.DEFAULT_TYPE):
                 continue # Еще рано, переходим к следующему сотруднику
 
             # 3. Проверяем, не отправляли ли мы ему уже напоминание сегодня
-            reminder_key = f"{emp_id}_departure_reminder_{today_str}"
-            if context.bot_data.get('notifications_sent', {}).get(reminder_key):
+            if ledger.is_set(today, emp_id, FLAG_DEPARTURE_REMINDER):
                 continue # Уже напоминали, переходим к следующему
 
             # 4. Проверяем, отметил ли сотрудник приход и уход
@@ -230,14 +238,14 @@ async def send_departure_reminders(context: ContextTypes.DEFAULT_TYPE):
 
             # 5. Если он пришел, но еще не ушел - отправляем напоминание
             if has_arrived and not has_departed:
-                await context.bot.send_message(
-                    chat_id=emp_id,
-                    text="👋 Не забудьте отметить уход! Это необходимо сделать до 23:00, иначе день будет отмечен как прогул."
+                dispatcher.submit(
+                    emp_id,
+                    "👋 Не забудьте отметить уход! Это необходимо сделать до 23:00, иначе день будет отмечен как прогул."
                 )
-                logger.info(f"Отправлено напоминание об уходе сотруднику {name} (ID: {emp_id})")
+                logger.info(f"Напоминание об уходе поставлено в очередь для сотрудника {name} (ID: {emp_id})")
 
             # 6. В любом случае помечаем, что мы его проверили, чтобы не спамить
-            context.bot_data.setdefault('notifications_sent', {})[reminder_key] = True
+            ledger.set(today, emp_id, FLAG_DEPARTURE_REMINDER)
 
         except Exception as e:
             logger.error(f"Ошибка в цикле напоминаний об уходе для {emp_id}: {e}", exc_info=True)
@@ -0,0 +1,150 @@
+# live_events.py
+import asyncio
+import json
+import uuid
+from collections import deque
+
+from config import LIVE_EVENTS_BUFFER, LIVE_EVENTS_CLIENT_QUEUE
+from invalidation_bus import invalidation_bus, InvalidationMessage, CHECK_IN, LEAVE, RESET
+
+# (check_in_type, status) -> тип события живой ленты; неудачные попытки в ленту не попадают
+_CHECK_IN_EVENTS = {
+    ('ARRIVAL', 'SUCCESS'): 'arrival',
+    ('ARRIVAL', 'LATE'): 'arrival',
+    ('DEPARTURE', 'SUCCESS'): 'departure',
+    ('SYSTEM_LEAVE', 'APPROVED_LEAVE'): 'leave_approved',
+    ('SYSTEM', 'ABSENT_INCOMPLETE'): 'penalty',
+}
+
+
+def _dumps(data) -> str:
+    return json.dumps(data, ensure_ascii=False, separators=(',', ':'))
+
+
+def to_event(message: InvalidationMessage) -> tuple[str, dict] | None:
+    """Переводит сообщение шины в событие ленты (тип, данные); None - событие дашборду не интересно."""
+    if message.entity == RESET:
+        return 'resync', {}
+    if message.entity == CHECK_IN:
+        if message.kind is None:
+            return 'resync', {}  # Сообщение от процесса старой версии - состав изменения неизвестен
+        event_type = _CHECK_IN_EVENTS.get((message.kind, message.status))
+        if event_type is None:
+            return None
+        return event_type, {'emp': message.telegram_id, 'date': message.start_date.isoformat(), 'status': message.status}
+    if message.entity == LEAVE:
+        if message.kind is None and message.status is None:
+            return 'resync', {}
+        data = {'emp': message.telegram_id, 'from': message.start_date.isoformat(), 'to': message.end_date.isoformat()}
+        if message.status == 'CANCELLED':
+            return 'leave_cancelled', data
+        return 'leave', {**data, 'status': message.kind}
+    return None
+
+
+class Subscriber:
+    """Очередь событий одного подключенного клиента. Переполненная очередь отключает клиента."""
+
+    def __init__(self, maxsize: int):
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=maxsize)
+        self.overflowed = False
+
+
+class LiveEventHub:
+    """
+    Живая лента изменений посещаемости для дашборда веб-панели (Server-Sent Events).
+    События строятся из сообщений шины инвалидации - и своих записей, и пришедших от бота через
+    LISTEN/NOTIFY, - и раздаются подписчикам. Последние LIVE_EVENTS_BUFFER событий хранятся в
+    кольцевом буфере: клиент, переподключившийся с Last-Event-ID, получает пропущенное без
+    полной перезагрузки. id события - "эпоха-номер"; эпоха меняется с перезапуском процесса,
+    и старый id тогда означает, что нужен новый снимок.
+    """
+
+    def __init__(self, buffer_size: int = LIVE_EVENTS_BUFFER, client_queue: int = LIVE_EVENTS_CLIENT_QUEUE):
+        self.epoch = uuid.uuid4().hex[:8]
+        self.seq = 0
+        self._buffer: deque = deque(maxlen=buffer_size)  # (seq, тип, json)
+        self._client_queue = client_queue
+        self._subscribers: set[Subscriber] = set()
+
+    def event_id(self, seq: int) -> str:
+        return f"{self.epoch}-{seq}"
+
+    def publish(self, event_type: str, data: dict):
+        self.seq += 1
+        event = (self.seq, event_type, _dumps(data))
+        self._buffer.append(event)
+        for subscriber in list(self._subscribers):
+            try:
+                subscriber.queue.put_nowait(event)
+            except asyncio.QueueFull:
+                # Клиент не успевает читать - отключаем; он переподключится и дочитает из буфера
+                subscriber.overflowed = True
+                self._subscribers.discard(subscriber)
+
+    def on_message(self, message: InvalidationMessage):
+        event = to_event(message)
+        if event is not None:
+            self.publish(*event)
+
+    def subscribe(self, last_event_id: str | None = None) -> tuple[Subscriber, list | None]:
+        """
+        Подключает клиента. Возвращает подписчика и события для догона после last_event_id -
+        или None, если их в буфере уже нет (или id от прежнего процесса) и нужен снимок.
+        Подписка и выборка из буфера происходят без await, поэтому события не теряются и не дублируются.
+        """
+        subscriber = Subscriber(self._client_queue)
+        self._subscribers.add(subscriber)
+        return subscriber, self._replay(last_event_id)
+
+    def unsubscribe(self, subscriber: Subscriber):
+        self._subscribers.discard(subscriber)
+
+    def _replay(self, last_event_id: str | None) -> list | None:
+        if not last_event_id:
+            return None
+        epoch, _, seq = last_event_id.partition('-')
+        if epoch != self.epoch or not seq.isdigit():
+            return None
+        seq = int(seq)
+        oldest = self._buffer[0][0] if self._buffer else self.seq + 1
+        if seq > self.seq or seq < oldest - 1:
+            return None
+        return [event for event in self._buffer if event[0] > seq]
+
+    @property
+    def subscriber_count(self) -> int:
+        return len(self._subscribers)
+
+
+def format_event(event_id: str, event_type: str, data: str) -> str:
+    return f"id: {event_id}\nevent: {event_type}\ndata: {data}\n\n"
+
+
+def compact_snapshot(for_date, stats: dict) -> str:
+    """
+    Снимок дашборда для нового клиента (данные get_dashboard_stats): имена один раз в names,
+    в группах - только id сотрудников (и статус, где он есть).
+    """
+    names = {}
+    for group in ('arrived', 'on_leave'):
+        for emp_id, item in stats[group].items():
+            names[emp_id] = item['name']
+    for group in ('departed', 'absent', 'incomplete'):
+        names.update(stats[group])
+    return _dumps({
+        'date': for_date.isoformat(),
+        'total': stats['total_scheduled'],
+        'names': names,
+        'arrived': {emp_id: item['status'] for emp_id, item in stats['arrived'].items()},
+        'departed': list(stats['departed']),
+        'on_leave': {emp_id: item['status'] for emp_id, item in stats['on_leave'].items()},
+        'absent': list(stats['absent']),
+        'incomplete': list(stats['incomplete']),
+    })
+
+
+live_event_hub = LiveEventHub()
+
+for _entity in (CHECK_IN, LEAVE, RESET):
+    invalidation_bus.subscribe(_entity, live_event_hub.on_message)
@@ -4,6 +4,9 @@ import asyncio
 import config
 import database
 import jobs
+import metrics
+import sharding
+import tracing
 
 from telegram.ext import (
     Application,
@@ -19,7 +22,12 @@ from functools import partial
 from config import (
     SCHEDULE_GET_EFFECTIVE_DATE
 )
-from app_context import shutdown_executor
+from app_context import shutdown_executor, warm_up_process_pool
+from message_dispatcher import shutdown_message_dispatcher
+from update_processor import KeyedUpdateProcessor
+from job_leader import get_job_leader
+from db_persistence import PostgresPersistence
+from notification_ledger import LEDGER_KEY, get_notification_ledger
 from keyboards import admin_menu_keyboard, reports_menu_keyboard
 from handlers_user import (
     start_command, late_checkin_callback, handle_arrival, handle_departure,
@@ -29,13 +37,13 @@ from handlers_user import (
 from handlers_admin import (
     admin_command, admin_reports_menu, admin_get_today_report, admin_get_yesterday_report,
     admin_get_weekly_report, admin_custom_report_start, admin_custom_report_get_dates,
-    admin_export_csv, admin_monthly_csv_start, admin_monthly_csv_get_month,
+    admin_export_csv, admin_monthly_csv_start, admin_monthly_csv_get_month, admin_range_report,
     admin_add_start, add_get_id, add_get_name, admin_modify_start, modify_get_id,
     admin_delete_start, delete_get_id, delete_confirm, schedule_handler_factory,
     admin_back_to_menu, handle_leave_request_decision, admin_add_leave_start, admin_add_leave_get_id,
     admin_add_leave_get_type, admin_add_leave_get_period, admin_cancel_leave_start, admin_cancel_leave_get_id, admin_cancel_leave_get_period,
-    admin_web_ui, schedule_get_effective_date, admin_holidays_menu, holiday_add_start, holiday_get_add_date, holiday_get_add_name,
-    holiday_delete_start, holiday_get_delete_date, bulk_update_start, handle_schedule_file, bulk_add_start, handle_add_employees_file
+    admin_web_ui, admin_db_stats, schedule_get_effective_date, admin_holidays_menu, holiday_add_start, holiday_get_add_date, holiday_get_add_name,
+    holiday_delete_start, holiday_get_delete_date, bulk_update_start, handle_schedule_file, handle_schedule_confirm, bulk_add_start, handle_add_employees_file
 )
 
 # Настройка логирования
@@ -44,171 +52,288 @@ logging.getLogger("httpx").setLevel(logging.WARNING)
 logging.getLogger("apscheduler").setLevel(logging.WARNING)
 logger = logging.getLogger(__name__)
 
+_metrics_server = None
+
+def build_application() -> Application:
+    """Создает Application со всеми обработчиками (общая часть для polling, webhook и запуска внутри веб-панели)."""
+    shard = sharding.current_shard()
+    if config.PERSISTENCE_BACKEND == "pickle":
+        # У каждого шарда свой файл: воркеры не должны перезаписывать состояние друг друга
+        filepath = f"{config.PERSISTENCE_FILE}.shard{shard[0]}" if shard else config.PERSISTENCE_FILE
+        persistence = PicklePersistence(filepath=filepath)
+    else:
+        persistence = PostgresPersistence(shard=shard)
+    builder = (
+        Application.builder()
+        .token(config.BOT_TOKEN)
+        .persistence(persistence)
+        .concurrent_updates(KeyedUpdateProcessor(config.CONCURRENT_UPDATES, config.MAX_PENDING_UPDATES))
+    )
+    if config.BOT_API_BASE_URL:
+        builder = builder.base_url(config.BOT_API_BASE_URL)
+    application = builder.build()
+
+    # --- РЕГИСТРАЦИЯ ОБРАБОТЧИКОВ (без изменений) ---
+    checkin_conv_handler = ConversationHandler(
+        entry_points=[
+            CommandHandler("start", start_command),
+            # УДАЛЯЕМ СТАРУЮ ТОЧКУ ВХОДА ДЛЯ ИНЛАЙН-КНОПКИ
+            # CallbackQueryHandler(late_checkin_callback, pattern="^late_checkin$")
+            MessageHandler(filters.Regex(f"^{config.BUTTON_ASK_LEAVE}$"), ask_leave_start) 
+        ],
+        states={
+            config.CHOOSE_ACTION: [
+                MessageHandler(filters.Regex(f"^{config.BUTTON_ARRIVAL}$"), handle_arrival), 
+                MessageHandler(filters.Regex(f"^{config.BUTTON_DEPARTURE}$"), handle_departure),
+                MessageHandler(filters.Regex(f"^{config.BUTTON_UPDATE_PHOTO}$"), update_photo_start),
+            ],
+            config.AWAITING_LEAVE_REASON: [MessageHandler(filters.TEXT & ~filters.COMMAND, ask_leave_get_reason)],
+            config.REGISTER_FACE: [MessageHandler(filters.PHOTO, register_face)],
+            config.AWAITING_NEW_FACE_PHOTO: [MessageHandler(filters.PHOTO, update_photo_receive)],
+            config.AWAITING_PHOTO: [MessageHandler(filters.PHOTO, awaiting_photo)],
+            config.AWAITING_LOCATION: [MessageHandler(filters.LOCATION, awaiting_location)],
+        },
+        fallbacks=[CommandHandler("cancel", employee_cancel_command)],
+        allow_reentry=True, name="checkin_conversation", persistent=True,
+    )
+    schedule_handlers = [
+        MessageHandler(
+            filters.TEXT & ~filters.COMMAND,
+            (lambda day_index=i: schedule_handler_factory(day_index))()
+        ) for i in range(7)
+    ]
+    admin_conv_handler = ConversationHandler(
+        entry_points=[CommandHandler("admin", admin_command)],
+        states={
+            config.ADMIN_MENU: [
+                MessageHandler(filters.Regex(f"^{config.BUTTON_ADMIN_ADD}$"), admin_add_start),
+                MessageHandler(filters.Regex(f"^{config.BUTTON_ADMIN_MODIFY}$"), admin_modify_start),
+                MessageHandler(filters.Regex(f"^{config.BUTTON_ADMIN_DELETE}$"), admin_delete_start),
+                MessageHandler(filters.Regex(f"^{config.BUTTON_ADMIN_REPORTS}$"), admin_reports_menu),
+                MessageHandler(filters.Regex(f"^{config.BUTTON_MANAGE_LEAVE}$"), admin_add_leave_start),
+                MessageHandler(filters.Regex(f"^{config.BUTTON_CANCEL_LEAVE}$"), admin_cancel_leave_start),
+                MessageHandler(filters.Regex(f"^{config.BUTTON_MANAGE_HOLIDAYS}$"), admin_holidays_menu), # <-- Новая точка входа
+            ],
+            config.ADMIN_REPORTS_MENU: [
+                MessageHandler(filters.Regex(f"^{config.BUTTON_REPORT_TODAY}$"), admin_get_today_report),
+                MessageHandler(filters.Regex(f"^{config.BUTTON_REPORT_YESTERDAY}$"), admin_get_yesterday_report),
+                MessageHandler(filters.Regex(f"^{config.BUTTON_REPORT_WEEK}$"), admin_get_weekly_report),
+                MessageHandler(filters.Regex(f"^{config.BUTTON_REPORT_CUSTOM}$"), admin_custom_report_start),
+                MessageHandler(filters.Regex(f"^{config.BUTTON_REPORT_EXPORT}$"), admin_export_csv),
+                MessageHandler(filters.Regex(f"^{config.BUTTON_REPORT_MONTHLY_CSV}$"), admin_monthly_csv_start),
+                MessageHandler(filters.Regex(f"^{config.BUTTON_ADMIN_BACK}$"), admin_command),
+            ],
+            config.REPORT_GET_DATES: [
+                MessageHandler(filters.Regex(f"^{config.BUTTON_ADMIN_BACK}$"), admin_reports_menu),
+                MessageHandler(filters.TEXT & ~filters.COMMAND, admin_custom_report_get_dates)
+            ],
+            config.MONTHLY_CSV_GET_MONTH: [
+                MessageHandler(filters.Regex(f"^{config.BUTTON_ADMIN_BACK}$"), admin_reports_menu),
+                MessageHandler(filters.TEXT & ~filters.COMMAND, admin_monthly_csv_get_month)
+            ],
+            config.ADD_GET_ID: [MessageHandler(filters.FORWARDED, add_get_id)],
+            config.ADD_GET_NAME: [
+                MessageHandler(filters.Regex(f"^{config.BUTTON_ADMIN_BACK}$"), admin_back_to_menu),
+                MessageHandler(filters.TEXT & ~filters.COMMAND, add_get_name)
+            ],
+            config.MODIFY_GET_ID: [MessageHandler(filters.FORWARDED, modify_get_id)],
+            config.DELETE_GET_ID: [MessageHandler(filters.FORWARDED, delete_get_id)],
+            config.DELETE_CONFIRM: [MessageHandler(filters.Regex(f"^{config.BUTTON_CONFIRM_DELETE}$") | filters.Regex(f"^{config.BUTTON_CANCEL_DELETE}$"), delete_confirm)],
+            config.LEAVE_GET_ID: [MessageHandler(filters.FORWARDED, admin_add_leave_get_id)],
+            config.LEAVE_GET_TYPE: [
+                MessageHandler(filters.Regex(f"^{config.BUTTON_ADMIN_BACK}$"), admin_back_to_menu),
+                MessageHandler(filters.TEXT & ~filters.COMMAND, admin_add_leave_get_type)
+            ],
+            config.LEAVE_GET_PERIOD: [
+                MessageHandler(filters.Regex(f"^{config.BUTTON_ADMIN_BACK}$"), admin_reports_menu),
+                MessageHandler(filters.TEXT & ~filters.COMMAND, admin_add_leave_get_period)
+            ],
+            config.CANCEL_LEAVE_GET_ID: [MessageHandler(filters.FORWARDED, admin_cancel_leave_get_id)],
+            config.CANCEL_LEAVE_GET_PERIOD: [
+                MessageHandler(filters.Regex(f"^{config.BUTTON_ADMIN_BACK}$"), admin_back_to_menu),
+                MessageHandler(filters.TEXT & ~filters.COMMAND, admin_cancel_leave_get_period)
+            ],
+            config.SCHEDULE_GET_EFFECTIVE_DATE: [
+                MessageHandler(filters.Regex(f"^{config.BUTTON_ADMIN_BACK}$"), admin_back_to_menu),
+                MessageHandler(filters.TEXT & ~filters.COMMAND, schedule_get_effective_date)
+            ],
+            config.SCHEDULE_MON: [MessageHandler(filters.Regex(f"^{config.BUTTON_ADMIN_BACK}$"), admin_back_to_menu), schedule_handlers[0]],
+            config.SCHEDULE_TUE: [MessageHandler(filters.Regex(f"^{config.BUTTON_ADMIN_BACK}$"), admin_back_to_menu), schedule_handlers[1]],
+            config.SCHEDULE_WED: [MessageHandler(filters.Regex(f"^{config.BUTTON_ADMIN_BACK}$"), admin_back_to_menu), schedule_handlers[2]],
+            config.SCHEDULE_THU: [MessageHandler(filters.Regex(f"^{config.BUTTON_ADMIN_BACK}$"), admin_back_to_menu), schedule_handlers[3]],
+            config.SCHEDULE_FRI: [MessageHandler(filters.Regex(f"^{config.BUTTON_ADMIN_BACK}$"), admin_back_to_menu), schedule_handlers[4]],
+            config.SCHEDULE_SAT: [MessageHandler(filters.Regex(f"^{config.BUTTON_ADMIN_BACK}$"), admin_back_to_menu), schedule_handlers[5]],
+            config.SCHEDULE_SUN: [MessageHandler(filters.Regex(f"^{config.BUTTON_ADMIN_BACK}$"), admin_back_to_menu), schedule_handlers[6]],
+
+            config.HOLIDAY_MENU: [
+                MessageHandler(filters.Regex("^➕ Добавить праздник$"), holiday_add_start),
+                MessageHandler(filters.Regex("^➖ Удалить праздник$"), holiday_delete_start),
+                MessageHandler(filters.Regex(f"^{config.BUTTON_ADMIN_BACK}$"), admin_command),
+            ],
+            config.HOLIDAY_GET_ADD_DATE: [
+                MessageHandler(filters.Regex(f"^{config.BUTTON_ADMIN_BACK}$"), admin_holidays_menu),
+                MessageHandler(filters.TEXT & ~filters.COMMAND, holiday_get_add_date)
+            ],
+            config.HOLIDAY_GET_ADD_NAME: [
+                MessageHandler(filters.Regex(f"^{config.BUTTON_ADMIN_BACK}$"), holiday_add_start),
+                MessageHandler(filters.TEXT & ~filters.COMMAND, holiday_get_add_name)
+            ],
+            config.HOLIDAY_GET_DELETE_DATE: [
+                MessageHandler(filters.Regex(f"^{config.BUTTON_ADMIN_BACK}$"), admin_holidays_menu),
+                MessageHandler(filters.TEXT & ~filters.COMMAND, holiday_get_delete_date)
+            ]
+        },
+        fallbacks=[MessageHandler(filters.Regex(f"^{config.BUTTON_ADMIN_BACK}$"), admin_back_to_menu), CommandHandler("cancel", admin_back_to_menu)],
+        name="admin_conversation", persistent=True,
+    )
+    bulk_update_conv = ConversationHandler(
+        entry_points=[CommandHandler("bulk_update", bulk_update_start)],
+        states={
+            config.AWAITING_SCHEDULE_FILE: [MessageHandler(filters.Document.ALL, handle_schedule_file)],
+            config.AWAITING_SCHEDULE_CONFIRM: [MessageHandler(filters.TEXT & ~filters.COMMAND, handle_schedule_confirm)]
+        },
+        fallbacks=[CommandHandler("cancel", admin_back_to_menu)]
+    )
+    bulk_add_conv = ConversationHandler(
+        entry_points=[CommandHandler("bulk_add", bulk_add_start)],
+        states={
+            config.AWAITING_ADD_EMPLOYEES_FILE: [
+                MessageHandler(filters.Document.ALL, handle_add_employees_file)
+            ]
+        },
+        fallbacks=[CommandHandler("cancel", admin_back_to_menu)]
+    )
+    application.add_handler(bulk_add_conv)
+    application.add_handler(bulk_update_conv)
+    application.add_handler(admin_conv_handler)
+    application.add_handler(checkin_conv_handler)
+
+    application.add_handler(CommandHandler("mystats", get_personal_stats))
+    # Добавляем отдельный обработчик для решения админа по уходу
+    application.add_handler(CallbackQueryHandler(handle_leave_request_decision, pattern="^leave:"))
+    application.add_handler(CommandHandler("web", admin_web_ui))
+    application.add_handler(CommandHandler("range_report", admin_range_report))
+    application.add_handler(CommandHandler("db_stats", admin_db_stats))
+    return application
+
+def build_scheduler(application: Application) -> AsyncIOScheduler:
+    """
+    Создает планировщик фоновых задач бота (еще не запущенный). Каждая задача обернута в
+    JobLeader: при нескольких репликах бота ее выполняет только держатель аренды.
+    """
+    scheduler = AsyncIOScheduler(timezone=config.LOCAL_TIMEZONE)
+    leader = get_job_leader()
+    # Напоминания каждый шард шлет своим сотрудникам (у каждого своя аренда), остальные задачи - общие
+    shard_suffix = sharding.job_suffix()
+    scheduler.add_job(leader.wrap('check_and_send_notifications' + shard_suffix, jobs.check_and_send_notifications), 'interval', minutes=1, args=[application])
+    scheduler.add_job(leader.wrap('send_daily_report', jobs.send_daily_report_job), 'cron', hour=21, minute=0, args=[application])
+
+    # Запускаем проверку каждые 15 минут в течение всего дня, чтобы охватить любой график
+    scheduler.add_job(leader.wrap('send_departure_reminders' + shard_suffix, jobs.send_departure_reminders), 'cron', hour='*', minute='*/5', args=[application])
+    scheduler.add_job(leader.wrap('apply_incomplete_day_penalty', jobs.apply_incomplete_day_penalty), 'cron', hour=0, minute=5, args=[application]) # Применяем штраф в 00:05 за вчерашний день
+
+    scheduler.add_job(leader.wrap('dashboard_midday', jobs.send_dashboard_snapshot), 'cron', hour=14, minute=35, args=[application, 'midday'])
+    scheduler.add_job(leader.wrap('dashboard_evening', jobs.send_dashboard_snapshot), 'cron', hour=20, minute=00, args=[application, 'evening'])
+    scheduler.add_job(leader.wrap('cleanup_job_runs', leader.cleanup_runs), 'cron', hour=3, minute=15)
+
+    if isinstance(application.persistence, PostgresPersistence):
+        # Журнал уведомлений общий для реплик (bot_data в БД): лидер сохраняет его после каждого запуска,
+        # а реплика, перехватившая аренду, сначала вливает сохраненный - и не повторяет уже отправленное
+        async def reload_notification_ledger(job_name: str):
+            stored = await application.persistence.load_bot_data_value(LEDGER_KEY)
+            if stored is not None:
+                get_notification_ledger(application.bot_data).merge(stored)
+
+        async def save_bot_state(job_name: str):
+            await application.update_persistence()
+
+        async def cleanup_persistence():
+            # Без лидерства: каждый процесс забывает хэши удаленных им строк, повторный DELETE безвреден
+            try:
+                expired = await application.persistence.delete_expired()
+                if expired:
+                    logger.info(f"Удалено устаревших записей состояния бота: {expired}")
+            except Exception as e:
+                logger.error(f"Не удалось удалить устаревшие записи состояния бота: {e}", exc_info=True)
+
+        scheduler.add_job(cleanup_persistence, 'interval', seconds=config.PERSISTENCE_TTL_CLEANUP_INTERVAL_SECONDS)
+        leader.add_lease_gained_listener(reload_notification_ledger)
+        leader.add_run_finished_listener(save_bot_state)
+    return scheduler
+
+async def start_bot(application: Application, scheduler: AsyncIOScheduler, update_mode: str = config.UPDATE_MODE):
+    """
+    Инициализирует БД и кэши, запускает Application и планировщик. В режиме polling сам опрашивает
+    Telegram; в режимах webhook/webapp регистрирует вебхук, а апдейты в очередь кладет webhook.py;
+    в режиме shard апдейты приходят от фронта sharding.py.
+    """
+    await database.init_db()
+    await database.load_holiday_calendar()
+    await database.load_employee_cache()
+    await database.start_invalidation_bus()
+    await application.initialize()
+    if update_mode == "polling":
+        await application.updater.start_polling()
+    elif update_mode != "shard":
+        import webhook  # FastAPI нужен только в режиме вебхука - в polling не грузим
+        await webhook.register_webhook(application)
+    await application.start()
+    scheduler.start()
+    warm_up_process_pool()
+    await start_metrics_listener(update_mode)
+    tracing.trace_exporter.start()
+    logger.info(f"Бот и планировщик запущены (режим получения апдейтов: {update_mode}).")
+
+async def start_metrics_listener(update_mode: str):
+    """Поднимает HTTP-листенер метрик; в режиме webapp листенер процесса поднимает сама веб-панель."""
+    global _metrics_server
+    if not config.METRICS_PORT or update_mode == "webapp" or _metrics_server is not None:
+        return
+    shard = sharding.current_shard()
+    port = config.METRICS_PORT + (shard[0] if shard else 0)
+    try:
+        _metrics_server = await metrics.serve(config.METRICS_HOST, port)
+    except OSError as e:
+        logger.warning(f"Не удалось открыть порт метрик {port}: {e}. Бот работает без метрик.")
+
+async def stop_metrics_listener():
+    global _metrics_server
+    if _metrics_server is not None:
+        _metrics_server.close()
+        await _metrics_server.wait_closed()
+        _metrics_server = None
+
+async def stop_bot(application: Application, scheduler: AsyncIOScheduler):
+    """Останавливает планировщик, досылает очередь сообщений и корректно останавливает Application."""
+    scheduler.shutdown(wait=False)
+    await shutdown_message_dispatcher()
+    if application.updater and application.updater.running:
+        await application.updater.stop()
+    if application.running:
+        await application.stop()
+    await application.shutdown()
+    # Аренды отдаем после shutdown: состояние (журнал уведомлений) уже записано, и новый лидер его увидит
+    await get_job_leader().release_all()
+    await database.stop_invalidation_bus()
+    await stop_metrics_listener()
+    await tracing.trace_exporter.stop()
+
 async def main() -> None:
     """Основная функция для запуска бота."""
     try:
-        persistence = PicklePersistence(filepath=config.PERSISTENCE_FILE)
-        application = Application.builder().token(config.BOT_TOKEN).persistence(persistence).build()
-        
-        # --- РЕГИСТРАЦИЯ ОБРАБОТЧИКОВ (без изменений) ---
-        checkin_conv_handler = ConversationHandler(
-            entry_points=[
-                CommandHandler("start", start_command),
-                # УДАЛЯЕМ СТАРУЮ ТОЧКУ ВХОДА ДЛЯ ИНЛАЙН-КНОПКИ
-                # CallbackQueryHandler(late_checkin_callback, pattern="^late_checkin$")
-                MessageHandler(filters.Regex(f"^{config.BUTTON_ASK_LEAVE}$"), ask_leave_start) 
-            ],
-            states={
-                config.CHOOSE_ACTION: [
-                    MessageHandler(filters.Regex(f"^{config.BUTTON_ARRIVAL}$"), handle_arrival), 
-                    MessageHandler(filters.Regex(f"^{config.BUTTON_DEPARTURE}$"), handle_departure),
-                    MessageHandler(filters.Regex(f"^{config.BUTTON_UPDATE_PHOTO}$"), update_photo_start),
-                ],
-                config.AWAITING_LEAVE_REASON: [MessageHandler(filters.TEXT & ~filters.COMMAND, ask_leave_get_reason)],
-                config.REGISTER_FACE: [MessageHandler(filters.PHOTO, register_face)],
-                config.AWAITING_NEW_FACE_PHOTO: [MessageHandler(filters.PHOTO, update_photo_receive)],
-                config.AWAITING_PHOTO: [MessageHandler(filters.PHOTO, awaiting_photo)],
-                config.AWAITING_LOCATION: [MessageHandler(filters.LOCATION, awaiting_location)],
-            },
-            fallbacks=[CommandHandler("cancel", employee_cancel_command)],
-            allow_reentry=True, name="checkin_conversation", persistent=True,
-        )
-        schedule_handlers = [
-            MessageHandler(
-                filters.TEXT & ~filters.COMMAND,
-                (lambda day_index=i: schedule_handler_factory(day_index))()
-            ) for i in range(7)
-        ]
-        admin_conv_handler = ConversationHandler(
-            entry_points=[CommandHandler("admin", admin_command)],
-            states={
-                config.ADMIN_MENU: [
-                    MessageHandler(filters.Regex(f"^{config.BUTTON_ADMIN_ADD}$"), admin_add_start),
-                    MessageHandler(filters.Regex(f"^{config.BUTTON_ADMIN_MODIFY}$"), admin_modify_start),
-                    MessageHandler(filters.Regex(f"^{config.BUTTON_ADMIN_DELETE}$"), admin_delete_start),
-                    MessageHandler(filters.Regex(f"^{config.BUTTON_ADMIN_REPORTS}$"), admin_reports_menu),
-                    MessageHandler(filters.Regex(f"^{config.BUTTON_MANAGE_LEAVE}$"), admin_add_leave_start),
-                    MessageHandler(filters.Regex(f"^{config.BUTTON_CANCEL_LEAVE}$"), admin_cancel_leave_start),
-                    MessageHandler(filters.Regex(f"^{config.BUTTON_MANAGE_HOLIDAYS}$"), admin_holidays_menu), # <-- Новая точка входа
-                ],
-                config.ADMIN_REPORTS_MENU: [
-                    MessageHandler(filters.Regex(f"^{config.BUTTON_REPORT_TODAY}$"), admin_get_today_report),
-                    MessageHandler(filters.Regex(f"^{config.BUTTON_REPORT_YESTERDAY}$"), admin_get_yesterday_report),
-                    MessageHandler(filters.Regex(f"^{config.BUTTON_REPORT_WEEK}$"), admin_get_weekly_report),
-                    MessageHandler(filters.Regex(f"^{config.BUTTON_REPORT_CUSTOM}$"), admin_custom_report_start),
-                    MessageHandler(filters.Regex(f"^{config.BUTTON_REPORT_EXPORT}$"), admin_export_csv),
-                    MessageHandler(filters.Regex(f"^{config.BUTTON_REPORT_MONTHLY_CSV}$"), admin_monthly_csv_start),
-                    MessageHandler(filters.Regex(f"^{config.BUTTON_ADMIN_BACK}$"), admin_command),
-                ],
-                config.REPORT_GET_DATES: [
-                    MessageHandler(filters.Regex(f"^{config.BUTTON_ADMIN_BACK}$"), admin_reports_menu),
-                    MessageHandler(filters.TEXT & ~filters.COMMAND, admin_custom_report_get_dates)
-                ],
-                config.MONTHLY_CSV_GET_MONTH: [
-                    MessageHandler(filters.Regex(f"^{config.BUTTON_ADMIN_BACK}$"), admin_reports_menu),
-                    MessageHandler(filters.TEXT & ~filters.COMMAND, admin_monthly_csv_get_month)
-                ],
-                config.ADD_GET_ID: [MessageHandler(filters.FORWARDED, add_get_id)],
-                config.ADD_GET_NAME: [
-                    MessageHandler(filters.Regex(f"^{config.BUTTON_ADMIN_BACK}$"), admin_back_to_menu),
-                    MessageHandler(filters.TEXT & ~filters.COMMAND, add_get_name)
-                ],
-                config.MODIFY_GET_ID: [MessageHandler(filters.FORWARDED, modify_get_id)],
-                config.DELETE_GET_ID: [MessageHandler(filters.FORWARDED, delete_get_id)],
-                config.DELETE_CONFIRM: [MessageHandler(filters.Regex(f"^{config.BUTTON_CONFIRM_DELETE}$") | filters.Regex(f"^{config.BUTTON_CANCEL_DELETE}$"), delete_confirm)],
-                config.LEAVE_GET_ID: [MessageHandler(filters.FORWARDED, admin_add_leave_get_id)],
-                config.LEAVE_GET_TYPE: [
-                    MessageHandler(filters.Regex(f"^{config.BUTTON_ADMIN_BACK}$"), admin_back_to_menu),
-                    MessageHandler(filters.TEXT & ~filters.COMMAND, admin_add_leave_get_type)
-                ],
-                config.LEAVE_GET_PERIOD: [
-                    MessageHandler(filters.Regex(f"^{config.BUTTON_ADMIN_BACK}$"), admin_reports_menu),
-                    MessageHandler(filters.TEXT & ~filters.COMMAND, admin_add_leave_get_period)
-                ],
-                config.CANCEL_LEAVE_GET_ID: [MessageHandler(filters.FORWARDED, admin_cancel_leave_get_id)],
-                config.CANCEL_LEAVE_GET_PERIOD: [
-                    MessageHandler(filters.Regex(f"^{config.BUTTON_ADMIN_BACK}$"), admin_back_to_menu),
-                    MessageHandler(filters.TEXT & ~filters.COMMAND, admin_cancel_leave_get_period)
-                ],
-                config.SCHEDULE_GET_EFFECTIVE_DATE: [
-                    MessageHandler(filters.Regex(f"^{config.BUTTON_ADMIN_BACK}$"), admin_back_to_menu),
-                    MessageHandler(filters.TEXT & ~filters.COMMAND, schedule_get_effective_date)
-                ],
-                config.SCHEDULE_MON: [MessageHandler(filters.Regex(f"^{config.BUTTON_ADMIN_BACK}$"), admin_back_to_menu), schedule_handlers[0]],
-                config.SCHEDULE_TUE: [MessageHandler(filters.Regex(f"^{config.BUTTON_ADMIN_BACK}$"), admin_back_to_menu), schedule_handlers[1]],
-                config.SCHEDULE_WED: [MessageHandler(filters.Regex(f"^{config.BUTTON_ADMIN_BACK}$"), admin_back_to_menu), schedule_handlers[2]],
-                config.SCHEDULE_THU: [MessageHandler(filters.Regex(f"^{config.BUTTON_ADMIN_BACK}$"), admin_back_to_menu), schedule_handlers[3]],
-                config.SCHEDULE_FRI: [MessageHandler(filters.Regex(f"^{config.BUTTON_ADMIN_BACK}$"), admin_back_to_menu), schedule_handlers[4]],
-                config.SCHEDULE_SAT: [MessageHandler(filters.Regex(f"^{config.BUTTON_ADMIN_BACK}$"), admin_back_to_menu), schedule_handlers[5]],
-                config.SCHEDULE_SUN: [MessageHandler(filters.Regex(f"^{config.BUTTON_ADMIN_BACK}$"), admin_back_to_menu), schedule_handlers[6]],
-
-                config.HOLIDAY_MENU: [
-                    MessageHandler(filters.Regex("^➕ Добавить праздник$"), holiday_add_start),
-                    MessageHandler(filters.Regex("^➖ Удалить праздник$"), holiday_delete_start),
-                    MessageHandler(filters.Regex(f"^{config.BUTTON_ADMIN_BACK}$"), admin_command),
-                ],
-                config.HOLIDAY_GET_ADD_DATE: [
-                    MessageHandler(filters.Regex(f"^{config.BUTTON_ADMIN_BACK}$"), admin_holidays_menu),
-                    MessageHandler(filters.TEXT & ~filters.COMMAND, holiday_get_add_date)
-                ],
-                config.HOLIDAY_GET_ADD_NAME: [
-                    MessageHandler(filters.Regex(f"^{config.BUTTON_ADMIN_BACK}$"), holiday_add_start),
-                    MessageHandler(filters.TEXT & ~filters.COMMAND, holiday_get_add_name)
-                ],
-                config.HOLIDAY_GET_DELETE_DATE: [
-                    MessageHandler(filters.Regex(f"^{config.BUTTON_ADMIN_BACK}$"), admin_holidays_menu),
-                    MessageHandler(filters.TEXT & ~filters.COMMAND, holiday_get_delete_date)
-                ]
-            },
-            fallbacks=[MessageHandler(filters.Regex(f"^{config.BUTTON_ADMIN_BACK}$"), admin_back_to_menu), CommandHandler("cancel", admin_back_to_menu)],
-            name="admin_conversation", persistent=True,
-        )
-        bulk_update_conv = ConversationHandler(
-            entry_points=[CommandHandler("bulk_update", bulk_update_start)],
-            states={
-                config.AWAITING_SCHEDULE_FILE: [MessageHandler(filters.Document.ALL, handle_schedule_file)]
-            },
-            fallbacks=[CommandHandler("cancel", admin_back_to_menu)]
-        )
-        bulk_add_conv = ConversationHandler(
-            entry_points=[CommandHandler("bulk_add", bulk_add_start)],
-            states={
-                config.AWAITING_ADD_EMPLOYEES_FILE: [
-                    MessageHandler(filters.Document.ALL, handle_add_employees_file)
-                ]
-            },
-            fallbacks=[CommandHandler("cancel", admin_back_to_menu)]
-        )
-        application.add_handler(bulk_add_conv)
-        application.add_handler(bulk_update_conv)
-        application.add_handler(admin_conv_handler)
-        application.add_handler(checkin_conv_handler)
-
-        application.add_handler(CommandHandler("mystats", get_personal_stats))
-        # Добавляем отдельный обработчик для решения админа по уходу
-        application.add_handler(CallbackQueryHandler(handle_leave_request_decision, pattern="^leave:"))
-        application.add_handler(CommandHandler("web", admin_web_ui))
-
-        scheduler = AsyncIOScheduler(timezone=config.LOCAL_TIMEZONE)
-        scheduler.add_job(jobs.check_and_send_notifications, 'interval', minutes=1, args=[application])
-        scheduler.add_job(jobs.send_daily_report_job, 'cron', hour=21, minute=0, args=[application])
-        
-        # Запускаем проверку каждые 15 минут в течение всего дня, чтобы охватить любой график
-        scheduler.add_job(jobs.send_departure_reminders, 'cron', hour='*', minute='*/5', args=[application])
-        scheduler.add_job(jobs.apply_incomplete_day_penalty, 'cron', hour=0, minute=5, args=[application]) # Применяем штраф в 00:05 за вчерашний день
-
-        scheduler.add_job(jobs.send_dashboard_snapshot, 'cron', hour=14, minute=35, args=[application, 'midday'])
-        scheduler.add_job(jobs.send_dashboard_snapshot, 'cron', hour=20, minute=00, args=[application, 'evening'])
-    
-        async with application:
-            await database.init_db()
-            await application.initialize()
-            await application.updater.start_polling()
-            await application.start()
-            scheduler.start()
-            logger.info("Бот и планировщик запущены. Нажмите Ctrl+C для остановки.")
-            await asyncio.Event().wait()
-            
+        application = build_application()
+        scheduler = build_scheduler(application)
+        await start_bot(application, scheduler)
+        try:
+            if config.UPDATE_MODE == "webhook":
+                # Отдельный ASGI-сервер, принимающий только вебхук Telegram
+                import webhook
+                await webhook.serve_standalone(application)
+            else:
+                logger.info("Нажмите Ctrl+C для остановки.")
+                await asyncio.Event().wait()
+        finally:
+            await stop_bot(application, scheduler)
     finally:
         logger.info("Закрытие пула процессов...")
         shutdown_executor()
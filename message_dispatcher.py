@@ -0,0 +1,272 @@
+# message_dispatcher.py
+import asyncio
+import logging
+import time as timer
+from collections import deque
+from datetime import timedelta
+
+import httpx
+from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter, TimedOut
+
+import metrics
+import sharding
+from config import (
+    DISPATCHER_WORKERS, DISPATCHER_GLOBAL_RATE, DISPATCHER_PER_CHAT_INTERVAL,
+    DISPATCHER_MAX_RETRIES, DISPATCHER_BACKOFF_SECONDS
+)
+
+logger = logging.getLogger(__name__)
+
+MESSAGES_SENT = metrics.registry.counter("checkin_messages_sent_total", "Исходящие сообщения по итогу доставки", ("result",))
+SEND_SECONDS = metrics.registry.histogram("checkin_message_send_seconds", "Длительность вызова send_message (одна попытка)")
+RETRY_AFTER = metrics.registry.counter("checkin_telegram_retry_after_total", "Ответы Telegram RetryAfter (превышен лимит)")
+QUEUE_SIZE = metrics.registry.gauge("checkin_message_queue_size", "Сообщения в очереди диспетчера")
+
+
+class TokenBucket:
+    """
+    Глобальный лимит отправки: не больше rate сообщений в секунду. По умолчанию без накопления
+    (capacity=1), иначе после паузы пачка из capacity сообщений плюс обычный поток превысят
+    лимит Telegram в скользящем окне в одну секунду.
+    """
+
+    def __init__(self, rate: float, capacity: float = 1):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = self.capacity
+        self._updated_at = timer.monotonic()
+        self._paused_until = 0.0
+
+    def pause(self, seconds: float):
+        """Останавливает выдачу токенов (Telegram вернул RetryAfter - лимит общий для бота)."""
+        self._paused_until = max(self._paused_until, timer.monotonic() + seconds)
+
+    async def acquire(self):
+        while True:
+            now = timer.monotonic()
+            if now < self._paused_until:
+                await asyncio.sleep(self._paused_until - now)
+                continue
+            self._tokens = min(self.capacity, self._tokens + (now - self._updated_at) * self.rate)
+            self._updated_at = now
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return
+            await asyncio.sleep((1 - self._tokens) / self.rate)
+
+
+class _OutgoingMessage:
+    __slots__ = ('chat_id', 'text', 'kwargs', 'key', 'future', 'attempts')
+
+    def __init__(self, chat_id: int, text: str, kwargs: dict, key: tuple, future: asyncio.Future):
+        self.chat_id = chat_id
+        self.text = text
+        self.kwargs = kwargs
+        self.key = key
+        self.future = future
+        self.attempts = 0
+
+
+class MessageDispatcher:
+    """
+    Очередь исходящих сообщений с пулом воркеров. Соблюдает глобальный лимит Telegram
+    (DISPATCHER_GLOBAL_RATE сообщений в секунду) и интервал между сообщениями в один чат,
+    сохраняя порядок сообщений внутри чата. RetryAfter приостанавливает всю отправку на
+    указанное время, сетевые ошибки повторяются с экспоненциальной задержкой. Одинаковое
+    сообщение в тот же чат, еще ожидающее в очереди, не дублируется - вызывающий получает
+    тот же future.
+    У каждого чата своя очередь, а воркеры берут из общей очереди "ходы" чатов: чат попадает туда,
+    только когда ему уже можно отправлять (таймер loop.call_later), и отправляет одно сообщение за ход.
+    Воркер не ждет интервал чата и повторы - занятый чат не задерживает остальные. Записи чата
+    удаляются, когда его очередь пуста и интервал прошел.
+    """
+
+    def __init__(self, bot, workers: int = DISPATCHER_WORKERS, global_rate: float = DISPATCHER_GLOBAL_RATE,
+                 per_chat_interval: float = DISPATCHER_PER_CHAT_INTERVAL, max_retries: int = DISPATCHER_MAX_RETRIES,
+                 backoff_seconds: float = DISPATCHER_BACKOFF_SECONDS):
+        self.bot = bot
+        self.workers = workers
+        self.per_chat_interval = per_chat_interval
+        self.max_retries = max_retries
+        self.backoff_seconds = backoff_seconds
+        self._bucket = TokenBucket(global_rate)
+        self._ready: asyncio.Queue = asyncio.Queue()  # id чатов, которым можно отправить следующее сообщение
+        self._chat_queues: dict[int, deque[_OutgoingMessage]] = {}  # Только чаты с ожидающими сообщениями
+        self._chat_next_allowed: dict[int, float] = {}
+        self._pending: dict[tuple, _OutgoingMessage] = {}
+        self._queued = 0  # Сообщения, доставка которых еще не завершена
+        self._drained = asyncio.Event()
+        self._drained.set()
+        self._tasks: list[asyncio.Task] = []
+        QUEUE_SIZE.set_function(lambda: self._queued)
+
+    def start(self):
+        if not self._tasks:
+            self._tasks = [asyncio.get_running_loop().create_task(self._worker()) for _ in range(self.workers)]
+
+    async def stop(self, drain_timeout: float = 10):
+        """Дожидается отправки очереди (не дольше drain_timeout) и останавливает воркеров."""
+        if not self._tasks:
+            return
+        try:
+            await asyncio.wait_for(self._drained.wait(), timeout=drain_timeout)
+        except asyncio.TimeoutError:
+            logger.warning(f"Очередь сообщений не опустела за {drain_timeout} с, осталось: {self._queued}")
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    def submit(self, chat_id: int, text: str, **kwargs) -> asyncio.Future:
+        """Ставит сообщение в очередь и сразу возвращает future с результатом send_message."""
+        key = (chat_id, text, repr(sorted(kwargs.items())))
+        pending = self._pending.get(key)
+        if pending is not None:
+            return pending.future
+        future = asyncio.get_running_loop().create_future()
+        # Ошибки уже залогированы воркером; без этого asyncio ругается на непрочитанное исключение
+        future.add_done_callback(lambda f: f.cancelled() or f.exception())
+        message = _OutgoingMessage(chat_id, text, kwargs, key, future)
+        self._pending[key] = message
+        self._queued += 1
+        self._drained.clear()
+        chat_queue = self._chat_queues.get(chat_id)
+        if chat_queue is None:
+            # У чата нет ожидающих сообщений - ему нужен ход; иначе ход уже запланирован
+            self._chat_queues[chat_id] = deque((message,))
+            self._schedule_turn(chat_id)
+        else:
+            chat_queue.append(message)
+        self.start()
+        return future
+
+    async def send(self, chat_id: int, text: str, **kwargs):
+        """Отправляет через очередь и ждет результата (исключение Telegram пробрасывается)."""
+        return await self.submit(chat_id, text, **kwargs)
+
+    async def broadcast(self, chat_ids, text: str, **kwargs) -> dict:
+        """Отправляет одно сообщение в несколько чатов параллельно; возвращает {chat_id: Message | Exception}."""
+        chat_ids = list(chat_ids)
+        results = await asyncio.gather(*(self.submit(chat_id, text, **kwargs) for chat_id in chat_ids), return_exceptions=True)
+        return dict(zip(chat_ids, results))
+
+    def _schedule_turn(self, chat_id: int, delay: float = 0):
+        """Ставит ход чата в общую очередь, как только чату можно отправлять (и не раньше delay)."""
+        delay = max(delay, self._chat_next_allowed.get(chat_id, 0) - timer.monotonic())
+        if delay > 0:
+            asyncio.get_running_loop().call_later(delay, self._ready.put_nowait, chat_id)
+        else:
+            self._ready.put_nowait(chat_id)
+
+    def _forget_chat(self, chat_id: int):
+        if chat_id not in self._chat_queues and self._chat_next_allowed.get(chat_id, 0) <= timer.monotonic():
+            self._chat_next_allowed.pop(chat_id, None)
+
+    async def _worker(self):
+        while True:
+            chat_id = await self._ready.get()
+            chat_queue = self._chat_queues[chat_id]
+            message = chat_queue[0]
+            retry_delay = None
+            try:
+                retry_delay = await self._deliver(message)
+            except Exception as e:
+                logger.error(f"Непредвиденная ошибка доставки сообщения в чат {message.chat_id}: {e}", exc_info=True)
+                if not message.future.done():
+                    message.future.set_exception(e)
+            finally:
+                if retry_delay is None:
+                    chat_queue.popleft()
+                    self._queued -= 1
+                    if not self._queued:
+                        self._drained.set()
+                if chat_queue:
+                    self._schedule_turn(chat_id, retry_delay or 0)
+                else:
+                    del self._chat_queues[chat_id]
+                    wait = max(0.0, self._chat_next_allowed.get(chat_id, 0) - timer.monotonic())
+                    asyncio.get_running_loop().call_later(wait, self._forget_chat, chat_id)
+
+    async def _deliver(self, message: _OutgoingMessage) -> float | None:
+        """
+        Одна попытка отправки. Возвращает задержку перед повтором (сообщение остается первым в очереди
+        чата) или None, если доставка завершена - future получил результат или ошибку.
+        """
+        # С этого момента такое же сообщение уже не склеивается с текущим - оно ставится заново
+        self._pending.pop(message.key, None)
+        message.attempts += 1
+        await self._bucket.acquire()
+        try:
+            with SEND_SECONDS.time():
+                result = await self.bot.send_message(chat_id=message.chat_id, text=message.text, **message.kwargs)
+        except RetryAfter as e:
+            RETRY_AFTER.inc()
+            delay = _seconds(e.retry_after)
+            logger.warning(f"Telegram просит подождать {delay} с (чат {message.chat_id}), отправка приостановлена.")
+            self._bucket.pause(delay)
+            self._chat_next_allowed[message.chat_id] = timer.monotonic() + delay
+            if message.attempts > self.max_retries:
+                logger.error(f"Сообщение в чат {message.chat_id} не отправлено: исчерпаны попытки после RetryAfter.")
+                MESSAGES_SENT.labels('retry_exhausted').inc()
+                message.future.set_exception(e)
+                return None
+            return delay
+        except (BadRequest, Forbidden) as e:
+            logger.error(f"Сообщение в чат {message.chat_id} отклонено Telegram: {e}")
+            MESSAGES_SENT.labels('rejected').inc()
+            message.future.set_exception(e)
+            return None
+        except NetworkError as e:
+            if message.attempts > self.max_retries or not _safe_to_retry(e):
+                logger.error(f"Не удалось отправить сообщение в чат {message.chat_id} после {message.attempts} попыток: {e}")
+                MESSAGES_SENT.labels('network_error').inc()
+                message.future.set_exception(e)
+                return None
+            delay = self.backoff_seconds * 2 ** (message.attempts - 1)
+            logger.warning(f"Сетевая ошибка при отправке в чат {message.chat_id}: {e}. Повтор через {delay} с.")
+            return delay
+        except Exception as e:
+            logger.error(f"Ошибка отправки сообщения в чат {message.chat_id}: {e}", exc_info=True)
+            MESSAGES_SENT.labels('error').inc()
+            message.future.set_exception(e)
+            return None
+        self._chat_next_allowed[message.chat_id] = timer.monotonic() + self.per_chat_interval
+        MESSAGES_SENT.labels('ok').inc()
+        message.future.set_result(result)
+        return None
+
+
+def _safe_to_retry(error: NetworkError) -> bool:
+    """
+    Повтор не должен дублировать сообщение. TimedOut (подкласс NetworkError) повторяется, только если
+    запрос точно не ушел - таймаут соединения или ожидания свободного соединения в пуле; после таймаута
+    записи/чтения Telegram мог сообщение уже принять, и повтор отправил бы его второй раз.
+    """
+    if isinstance(error, TimedOut):
+        return isinstance(error.__cause__, (httpx.ConnectTimeout, httpx.PoolTimeout))
+    return True
+
+
+def _seconds(retry_after) -> float:
+    return retry_after.total_seconds() if isinstance(retry_after, timedelta) else float(retry_after)
+
+
+_message_dispatcher = None
+
+def get_message_dispatcher(bot) -> MessageDispatcher:
+    """Возвращает общий диспетчер исходящих сообщений, создавая его при первом обращении."""
+    global _message_dispatcher
+    if _message_dispatcher is None:
+        # Лимит Telegram общий для бота - при шардировании каждый воркер получает свою долю
+        shard = sharding.current_shard()
+        global_rate = DISPATCHER_GLOBAL_RATE / shard[1] if shard else DISPATCHER_GLOBAL_RATE
+        _message_dispatcher = MessageDispatcher(bot, global_rate=global_rate)
+        logger.info("Диспетчер исходящих сообщений создан.")
+    return _message_dispatcher
+
+async def shutdown_message_dispatcher():
+    """Досылает очередь и останавливает воркеров диспетчера, если он был создан."""
+    global _message_dispatcher
+    if _message_dispatcher:
+        await _message_dispatcher.stop()
+        _message_dispatcher = None
@@ -0,0 +1,338 @@
+# metrics.py
+"""
+Метрики процесса (бота или веб-панели) в текстовом формате Prometheus: счетчики, гистограммы
+и датчики. Наблюдение - несколько арифметических операций без блокировок (все вызовы идут из
+одного event loop), серии с метками создаются один раз и кэшируются. Число серий каждой метрики
+ограничено METRICS_MAX_SERIES: лишние значения меток сливаются в серию со значениями "other".
+
+Метрики отдаются только на внутреннем листенере serve() (METRICS_HOST): процесс бота - на METRICS_PORT,
+веб-панель - на WEBAPP_METRICS_PORT, а не на своем публичном сервере.
+"""
+import asyncio
+import contextlib
+import functools
+import inspect
+import logging
+import time as timer
+from bisect import bisect_left
+
+from config import METRICS_MAX_SERIES
+
+logger = logging.getLogger(__name__)
+
+OVERFLOW_LABEL = "other"
+# Границы по умолчанию (секунды) - от запроса к кэшу до распознавания лица и долгой рассылки
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+def _escape(value: str) -> str:
+    return str(value).replace('\\', r'\\').replace('\n', r'\n').replace('"', r'\"')
+
+
+def _format_value(value: float) -> str:
+    if value != value:
+        return 'NaN'
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) and not value.is_integer() else str(int(value))
+
+
+class _Metric:
+    type_name = ""
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple = (), max_series: int = METRICS_MAX_SERIES):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.max_series = max_series
+        self._series = {}
+        if not self.labelnames:
+            self._series[()] = self._new_series()
+
+    def _new_series(self):
+        raise NotImplementedError
+
+    def labels(self, *values):
+        """Серия для значений меток (в порядке labelnames); повторный вызов возвращает ту же серию."""
+        key = tuple(str(value) for value in values)
+        series = self._series.get(key)
+        if series is None:
+            if len(self._series) >= self.max_series:
+                key = (OVERFLOW_LABEL,) * len(self.labelnames)
+                series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = self._new_series()
+        return series
+
+    def _label_string(self, key: tuple, extra: str = "") -> str:
+        pairs = [f'{name}="{_escape(value)}"' for name, value in zip(self.labelnames, key)]
+        if extra:
+            pairs.append(extra)
+        return "{" + ",".join(pairs) + "}" if pairs else ""
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type_name}"]
+        for key, series in list(self._series.items()):
+            lines.extend(self._render_series(key, series))
+        return lines
+
+
+class _CounterSeries:
+    __slots__ = ('value',)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount: float = 1):
+        self.value += amount
+
+
+class Counter(_Metric):
+    """Монотонно растущий счетчик (события, ошибки)."""
+    type_name = "counter"
+
+    def _new_series(self):
+        return _CounterSeries()
+
+    def inc(self, amount: float = 1):
+        self._series[()].inc(amount)
+
+    def _render_series(self, key, series):
+        return [f"{self.name}{self._label_string(key)} {_format_value(series.value)}"]
+
+
+class _GaugeSeries:
+    __slots__ = ('value', 'function')
+
+    def __init__(self):
+        self.value = 0
+        self.function = None
+
+    def set(self, value: float):
+        self.value = value
+
+    def inc(self, amount: float = 1):
+        self.value += amount
+
+    def dec(self, amount: float = 1):
+        self.value -= amount
+
+    def set_function(self, function):
+        """Значение считается при каждом чтении метрик (длина очереди, размер кэша)."""
+        self.function = function
+
+    def get(self) -> float:
+        if self.function is not None:
+            try:
+                return self.function()
+            except Exception:
+                return float('nan')
+        return self.value
+
+
+class Gauge(_Metric):
+    """Текущее значение, которое может расти и уменьшаться."""
+    type_name = "gauge"
+
+    def _new_series(self):
+        return _GaugeSeries()
+
+    def set(self, value: float):
+        self._series[()].set(value)
+
+    def set_function(self, function):
+        self._series[()].set_function(function)
+
+    def _render_series(self, key, series):
+        return [f"{self.name}{self._label_string(key)} {_format_value(series.get())}"]
+
+
+class _HistogramSeries:
+    __slots__ = ('upper_bounds', 'counts', 'sum', 'count')
+
+    def __init__(self, upper_bounds: tuple):
+        self.upper_bounds = upper_bounds
+        self.counts = [0] * (len(upper_bounds) + 1)  # Последний - значения больше всех границ (+Inf)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.upper_bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def time(self):
+        return _Timer(self)
+
+
+class _Timer:
+    """Контекстный менеджер: наблюдает длительность блока в секундах."""
+    __slots__ = ('series', 'started')
+
+    def __init__(self, series: _HistogramSeries):
+        self.series = series
+
+    def __enter__(self):
+        self.started = timer.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.series.observe(timer.perf_counter() - self.started)
+
+
+class Histogram(_Metric):
+    """Распределение значений (длительностей) по корзинам; хранит только счетчики корзин, сумму и количество."""
+    type_name = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple = (), buckets: tuple = DEFAULT_BUCKETS,
+                 max_series: int = METRICS_MAX_SERIES):
+        self.upper_bounds = tuple(sorted(buckets))
+        super().__init__(name, documentation, labelnames, max_series)
+
+    def _new_series(self):
+        return _HistogramSeries(self.upper_bounds)
+
+    def observe(self, value: float):
+        self._series[()].observe(value)
+
+    def time(self):
+        return self._series[()].time()
+
+    def _render_series(self, key, series):
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.upper_bounds + (float('inf'),), series.counts):
+            cumulative += count
+            le = 'le="' + _format_value(bound) + '"'
+            lines.append(f"{self.name}_bucket{self._label_string(key, le)} {cumulative}")
+        lines.append(f"{self.name}_sum{self._label_string(key)} {_format_value(series.sum)}")
+        lines.append(f"{self.name}_count{self._label_string(key)} {series.count}")
+        return lines
+
+
+class Registry:
+    """Набор метрик процесса; метрика с тем же именем регистрируется один раз (повторный вызов вернет ее же)."""
+
+    def __init__(self):
+        self._metrics: dict[str, _Metric] = {}
+
+    def _get_or_create(self, cls, name: str, *args, **kwargs):
+        metric = self._metrics.get(name)
+        if metric is None:
+            metric = self._metrics[name] = cls(name, *args, **kwargs)
+        return metric
+
+    def counter(self, name: str, documentation: str, labelnames: tuple = ()) -> Counter:
+        return self._get_or_create(Counter, name, documentation, labelnames)
+
+    def gauge(self, name: str, documentation: str, labelnames: tuple = ()) -> Gauge:
+        return self._get_or_create(Gauge, name, documentation, labelnames)
+
+    def histogram(self, name: str, documentation: str, labelnames: tuple = (), buckets: tuple = DEFAULT_BUCKETS) -> Histogram:
+        return self._get_or_create(Histogram, name, documentation, labelnames, buckets=buckets)
+
+    def render(self) -> str:
+        lines = []
+        for metric in list(self._metrics.values()):
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+# --- Общие метрики, которые пишут несколько модулей ---
+DB_CALL_SECONDS = registry.histogram("checkin_db_call_seconds", "Длительность функций database.py", ("function",))
+DB_CALL_ERRORS = registry.counter("checkin_db_call_errors_total", "Исключения в функциях database.py", ("function",))
+
+
+def timed(histogram: Histogram):
+    """Декоратор корутины: наблюдает ее длительность в histogram (без меток)."""
+    def decorator(function):
+        series = histogram._series[()]
+        @functools.wraps(function)
+        async def wrapper(*args, **kwargs):
+            started = timer.perf_counter()
+            try:
+                return await function(*args, **kwargs)
+            finally:
+                series.observe(timer.perf_counter() - started)
+        return wrapper
+    return decorator
+
+
+def instrument_async_functions(namespace: dict, histogram: Histogram, errors: Counter, module_name: str):
+    """
+    Оборачивает все корутины и асинхронные генераторы, определенные в модуле (namespace = globals()),
+    замером длительности с меткой - именем функции. Вызывается в конце модуля: импортирующие
+    его модули и внутренние вызовы через глобальные имена получают обернутые функции.
+    """
+    for name, function in list(namespace.items()):
+        if getattr(function, '__module__', None) != module_name or getattr(function, '_metrics_instrumented', False):
+            continue
+        if inspect.iscoroutinefunction(function):
+            namespace[name] = _timed_coroutine(function, histogram.labels(name), errors.labels(name))
+        elif inspect.isasyncgenfunction(function):
+            namespace[name] = _timed_async_generator(function, histogram.labels(name), errors.labels(name))
+
+
+def _timed_coroutine(function, series: _HistogramSeries, error_series: _CounterSeries):
+    @functools.wraps(function)
+    async def wrapper(*args, **kwargs):
+        started = timer.perf_counter()
+        try:
+            return await function(*args, **kwargs)
+        except Exception:
+            error_series.inc()
+            raise
+        finally:
+            series.observe(timer.perf_counter() - started)
+    wrapper._metrics_instrumented = True
+    return wrapper
+
+
+def _timed_async_generator(function, series: _HistogramSeries, error_series: _CounterSeries):
+    @functools.wraps(function)
+    async def wrapper(*args, **kwargs):
+        # Замеряется время от первого запроса строки до конца выдачи (включая паузы потребителя).
+        # aclosing: при досрочной остановке потребителя исходный генератор закрывается сразу
+        # (его курсор и транзакция), а не когда до него доберется сборщик мусора
+        started = timer.perf_counter()
+        try:
+            async with contextlib.aclosing(function(*args, **kwargs)) as items:
+                async for item in items:
+                    yield item
+        except Exception:
+            error_series.inc()
+            raise
+        finally:
+            series.observe(timer.perf_counter() - started)
+    wrapper._metrics_instrumented = True
+    return wrapper
+
+
+# --- Внутренний HTTP-листенер метрик (процесс бота и процесс веб-панели) ---
+async def _handle_scrape(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    try:
+        request_line = await asyncio.wait_for(reader.readline(), timeout=5)
+        while (await asyncio.wait_for(reader.readline(), timeout=5)) not in (b'\r\n', b'\n', b''):
+            pass  # Заголовки запроса не нужны
+        if request_line.split(b' ')[:2] == [b'GET', b'/metrics']:
+            status, body, content_type = "200 OK", registry.render().encode(), CONTENT_TYPE
+        else:
+            status, body, content_type = "404 Not Found", "Не найдено. Метрики: GET /metrics\n".encode(), "text/plain; charset=utf-8"
+        writer.write(f"HTTP/1.1 {status}\r\nContent-Type: {content_type}\r\nContent-Length: {len(body)}\r\n"
+                     f"Connection: close\r\n\r\n".encode() + body)
+        await writer.drain()
+    except (asyncio.TimeoutError, ConnectionError):
+        pass
+    finally:
+        writer.close()
+
+
+async def serve(host: str, port: int) -> asyncio.AbstractServer:
+    """Запускает минимальный HTTP-сервер метрик (только GET /metrics) в текущем event loop."""
+    server = await asyncio.start_server(_handle_scrape, host, port)
+    logger.info(f"Метрики процесса доступны на http://{host}:{port}/metrics")
+    return server
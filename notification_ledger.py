@@ -0,0 +1,120 @@
+# notification_ledger.py
+from array import array
+from datetime import date
+
+# --- Битовые флаги событий дня для одного сотрудника ---
+FLAG_WARNING = 1 << 0             # Напоминание о скором начале смены
+FLAG_MISSED = 1 << 1              # Сообщение о пропущенном чек-ине
+FLAG_DEPARTURE_REMINDER = 1 << 2  # Напоминание отметить уход
+FLAG_UNHANDLED_LATE = 1 << 3      # Опоздавший, еще не прошедший late check-in
+
+LEDGER_KEY = 'notification_ledger'
+
+
+class NotificationLedger:
+    """
+    Журнал отправленных за день уведомлений: по байту флагов на сотрудника в bytearray,
+    индекс сотрудника плотный (в порядке первого обращения за день). Проверка и установка
+    флага - O(1); при смене дня журнал обнуляется сам. Пиклится как день + два массива байт.
+    """
+
+    def __init__(self):
+        self.day: date | None = None
+        self._ids = array('q')
+        self._index: dict[int, int] = {}
+        self._flags = bytearray()
+
+    def _rollover(self, day: date):
+        if day != self.day:
+            self.day = day
+            self._ids = array('q')
+            self._index = {}
+            self._flags = bytearray()
+
+    def _slot(self, emp_id: int) -> int:
+        slot = self._index.get(emp_id)
+        if slot is None:
+            slot = len(self._ids)
+            self._index[emp_id] = slot
+            self._ids.append(emp_id)
+            self._flags.append(0)
+        return slot
+
+    def is_set(self, day: date, emp_id: int, flag: int) -> bool:
+        self._rollover(day)
+        slot = self._index.get(emp_id)
+        return slot is not None and bool(self._flags[slot] & flag)
+
+    def test_and_set(self, day: date, emp_id: int, flag: int) -> bool:
+        """Устанавливает флаг и возвращает, был ли он уже установлен."""
+        self._rollover(day)
+        slot = self._slot(emp_id)
+        was_set = bool(self._flags[slot] & flag)
+        self._flags[slot] |= flag
+        return was_set
+
+    def set(self, day: date, emp_id: int, flag: int):
+        self.test_and_set(day, emp_id, flag)
+
+    def clear(self, day: date, emp_id: int, flag: int):
+        self._rollover(day)
+        slot = self._index.get(emp_id)
+        if slot is not None:
+            self._flags[slot] &= ~flag & 0xFF
+
+    def merge(self, other: 'NotificationLedger'):
+        """
+        Добавляет флаги другого журнала (сохраненного другой репликой): за тот же день флаги
+        объединяются, более свежий день заменяет текущий, более старый игнорируется.
+        """
+        if other.day is None or (self.day is not None and other.day < self.day):
+            return
+        self._rollover(other.day)
+        for emp_id, flags in zip(other._ids, other._flags):
+            self._flags[self._slot(emp_id)] |= flags
+
+    def __getstate__(self):
+        return {
+            'day': self.day.toordinal() if self.day else None,
+            'ids': self._ids.tobytes(),
+            'flags': bytes(self._flags),
+        }
+
+    def __setstate__(self, state):
+        self.day = date.fromordinal(state['day']) if state['day'] else None
+        self._ids = array('q')
+        self._ids.frombytes(state['ids'])
+        self._index = {emp_id: slot for slot, emp_id in enumerate(self._ids)}
+        self._flags = bytearray(state['flags'])
+
+
+_LEGACY_FLAGS = {'warning': FLAG_WARNING, 'missed': FLAG_MISSED, 'departure_reminder': FLAG_DEPARTURE_REMINDER}
+
+
+def get_notification_ledger(bot_data: dict) -> NotificationLedger:
+    """
+    Возвращает журнал из bot_data, создавая его при первом обращении. Старые ключи
+    ('notifications_sent', 'unhandled_late_users', 'last_cleanup_date') переносятся в журнал
+    и удаляются, чтобы после обновления не повторить уже отправленные сегодня уведомления.
+    """
+    ledger = bot_data.get(LEDGER_KEY)
+    if ledger is not None:
+        return ledger
+
+    ledger = NotificationLedger()
+    legacy_sent = bot_data.pop('notifications_sent', None) or {}
+    legacy_late = bot_data.pop('unhandled_late_users', None) or set()
+    legacy_day = bot_data.pop('last_cleanup_date', None)
+    if legacy_day:
+        day = date.fromisoformat(legacy_day)
+        for key, was_sent in legacy_sent.items():
+            # Ключи вида "<emp_id>_<событие>_<YYYY-MM-DD>"
+            emp_id, _, rest = key.partition('_')
+            event, _, key_day = rest.rpartition('_')
+            if was_sent and key_day == legacy_day and event in _LEGACY_FLAGS:
+                ledger.set(day, int(emp_id), _LEGACY_FLAGS[event])
+        for emp_id in legacy_late:
+            ledger.set(day, emp_id, FLAG_UNHANDLED_LATE)
+
+    bot_data[LEDGER_KEY] = ledger
+    return ledger
@@ -0,0 +1,85 @@
+# profile_imports.py
+"""
+Профиль времени импорта при старте бота и веб-панели (python -X importtime в отдельном процессе).
+Запуск: python profile_imports.py [модуль ...] [--top N] [--budget-ms МС]
+По умолчанию профилируются main и webapp. Печатает общее время, самые дорогие модули
+(собственное и накопленное время) и сводку по пакетам верхнего уровня. С --budget-ms
+завершается с кодом 1, если импорт какого-либо модуля дольше бюджета.
+"""
+import argparse
+import os
+import subprocess
+import sys
+from collections import defaultdict
+
+
+def profile_module(module: str) -> list[tuple[str, int, int, int]]:
+    """Импортирует module в чистом интерпретаторе; возвращает [(модуль, глубина, self_us, cumulative_us), ...]."""
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        capture_output=True, text=True, cwd=os.path.dirname(os.path.abspath(__file__))
+    )
+    if result.returncode != 0:
+        last_line = (result.stderr.strip().splitlines() or ["?"])[-1]
+        raise RuntimeError(f"не удалось импортировать {module}: {last_line}")
+
+    rows = []
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "[us]" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|", 2)
+        depth = (len(name) - len(name.lstrip())) // 2
+        rows.append((name.strip(), depth, int(self_us), int(cumulative_us)))
+    return rows
+
+
+def print_report(module: str, rows: list, top: int) -> int:
+    total_us = next((cumulative for name, _, _, cumulative in rows if name == module), 0)
+    print(f"\n=== import {module}: {total_us / 1000:.1f} мс, модулей загружено: {len(rows)} ===")
+
+    print("\nСамые дорогие по накопленному времени (с зависимостями):")
+    for name, depth, self_us, cumulative_us in sorted(rows, key=lambda row: row[3], reverse=True)[:top]:
+        print(f"  {cumulative_us / 1000:9.1f} мс  {name}")
+
+    print("\nСамые дорогие по собственному времени:")
+    for name, depth, self_us, cumulative_us in sorted(rows, key=lambda row: row[2], reverse=True)[:top]:
+        print(f"  {self_us / 1000:9.1f} мс  {name}")
+
+    by_package = defaultdict(lambda: [0, 0])
+    for name, _, self_us, _ in rows:
+        package = by_package[name.split(".")[0]]
+        package[0] += self_us
+        package[1] += 1
+    print("\nПо пакетам верхнего уровня (сумма собственного времени):")
+    for package, (self_us, count) in sorted(by_package.items(), key=lambda item: item[1][0], reverse=True)[:top]:
+        print(f"  {self_us / 1000:9.1f} мс  {package} ({count} мод.)")
+    return total_us
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Профиль времени импорта модулей бота и веб-панели.")
+    parser.add_argument("modules", nargs="*", default=["main", "webapp"])
+    parser.add_argument("--top", type=int, default=15)
+    parser.add_argument("--budget-ms", type=float, default=None, help="бюджет времени импорта одного модуля")
+    args = parser.parse_args()
+
+    over_budget = []
+    for module in args.modules:
+        try:
+            total_us = print_report(module, profile_module(module), args.top)
+        except RuntimeError as e:
+            print(f"\n❌ {e}")
+            over_budget.append(module)
+            continue
+        if args.budget_ms is not None and total_us / 1000 > args.budget_ms:
+            over_budget.append(module)
+
+    if args.budget_ms is not None:
+        if over_budget:
+            print(f"\n❌ Бюджет {args.budget_ms:.0f} мс превышен: {', '.join(over_budget)}")
+            sys.exit(1)
+        print(f"\n✅ Все модули укладываются в бюджет {args.budget_ms:.0f} мс.")
+
+
+if __name__ == "__main__":
+    main()
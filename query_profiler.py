@@ -0,0 +1,280 @@
+# query_profiler.py
+"""
+Профиль SQL-запросов процесса. Соединения database.get_db_connection создаются с классом
+ProfiledConnection: каждый fetch/fetchrow/fetchval/execute/executemany и обход cursor замеряется и учитывается
+по паре (место вызова, текст запроса) - место вызова это функция вне asyncpg, например
+database.get_dashboard_stats. Запросы дольше DB_SLOW_QUERY_MS пишутся в лог, а с вероятностью
+DB_SLOW_QUERY_EXPLAIN_SAMPLE (не чаще раза в DB_SLOW_QUERY_EXPLAIN_INTERVAL_SECONDS на запрос)
+в фоне снимается план на отдельном соединении: для чтения - EXPLAIN (ANALYZE, BUFFERS) в транзакции
+READ ONLY, для изменяющих запросов - только EXPLAIN без выполнения.
+Сводку показывает админская команда /db_stats.
+"""
+import asyncio
+import logging
+import os
+import random
+import re
+import sys
+import time as timer
+from functools import lru_cache
+
+import asyncpg
+
+from config import (
+    DB_SLOW_QUERY_MS, DB_SLOW_QUERY_EXPLAIN_SAMPLE, DB_SLOW_QUERY_EXPLAIN_INTERVAL_SECONDS, DB_QUERY_STATS_MAX_ENTRIES
+)
+
+logger = logging.getLogger(__name__)
+
+# Кадры этих файлов пропускаются при поиске места вызова
+_SKIP_PREFIXES = (os.path.dirname(asyncpg.__file__), __file__)
+# EXPLAIN ANALYZE выполняет запрос повторно, поэтому применяется только к чистому чтению. Изменяющие запросы
+# получают EXPLAIN без ANALYZE: повтор записи ждал бы блокировок еще открытой исходной транзакции, мог бы
+# упасть на уникальном ключе, расходовал бы последовательности и удваивал нагрузку на и без того медленную БД
+_EXPLAINABLE = ('SELECT', 'WITH', 'INSERT', 'UPDATE', 'DELETE')
+_WRITE_RE = re.compile(r'\b(INSERT|UPDATE|DELETE|MERGE|FOR\s+(NO\s+KEY\s+)?UPDATE|FOR\s+(KEY\s+)?SHARE)\b', re.IGNORECASE)
+# Функции с побочными эффектами, которые выполнились бы и при чтении
+_SIDE_EFFECT_MARKERS = ('advisory', 'pg_notify', 'nextval', 'setval')
+
+
+def is_read_only(query: str) -> bool:
+    """SELECT (или WITH) без изменений данных, блокировок строк и функций с побочными эффектами."""
+    lowered = query.lower()
+    return (lowered.startswith(('select', 'with')) and not _WRITE_RE.search(query)
+            and not any(marker in lowered for marker in _SIDE_EFFECT_MARKERS))
+
+
+@lru_cache(maxsize=1024)
+def normalize_query(query: str) -> str:
+    return re.sub(r'\s+', ' ', query).strip()
+
+
+@lru_cache(maxsize=256)
+def _module_name(filename: str) -> str:
+    return os.path.splitext(os.path.basename(filename))[0]
+
+
+def _call_site() -> str:
+    frame = sys._getframe(2)  # _call_site <- _profiled или cursor <- ...; кадры этого модуля пропускаются ниже
+    while frame is not None and frame.f_code.co_filename.startswith(_SKIP_PREFIXES):
+        frame = frame.f_back
+    if frame is None:
+        return "?"
+    return f"{_module_name(frame.f_code.co_filename)}.{frame.f_code.co_qualname}"
+
+
+def _rows_from_status(status) -> int:
+    # Тег команды: "INSERT 0 5", "UPDATE 3", "DELETE 0", "SELECT 10"
+    tail = status.rsplit(' ', 1)[-1] if isinstance(status, str) else ''
+    return int(tail) if tail.isdigit() else 0
+
+
+class QueryStats:
+    """Накопленная статистика одного запроса из одного места вызова."""
+    __slots__ = ('calls', 'total', 'max', 'rows', 'errors', 'slow', 'last_explained')
+
+    def __init__(self):
+        self.calls = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.rows = 0
+        self.errors = 0
+        self.slow = 0
+        self.last_explained = 0.0
+
+
+class QueryProfiler:
+    """
+    Статистика запросов процесса (в памяти, с момента старта или /db_stats reset).
+    Число пар (место, запрос) ограничено max_entries: новые пары сверх лимита учитываются
+    только в счетчике untracked - тексты запросов в коде конечны, лимит защищает от запросов
+    со встроенными значениями.
+    """
+
+    def __init__(self, slow_ms: float = DB_SLOW_QUERY_MS, explain_sample: float = DB_SLOW_QUERY_EXPLAIN_SAMPLE,
+                 explain_interval: float = DB_SLOW_QUERY_EXPLAIN_INTERVAL_SECONDS,
+                 max_entries: int = DB_QUERY_STATS_MAX_ENTRIES):
+        self.slow_seconds = slow_ms / 1000
+        self.explain_sample = explain_sample
+        self.explain_interval = explain_interval
+        self.max_entries = max_entries
+        self.connect = None  # Корутина-фабрика соединения для EXPLAIN (database.get_db_connection)
+        self._stats: dict[tuple[str, str], QueryStats] = {}
+        self._explain_tasks: set[asyncio.Task] = set()
+        self.untracked = 0
+        self.started_at = timer.time()
+
+    def reset(self):
+        self._stats.clear()
+        self.untracked = 0
+        self.started_at = timer.time()
+
+    def record(self, call_site: str, query: str, seconds: float, rows: int, failed: bool) -> QueryStats | None:
+        key = (call_site, normalize_query(query))
+        stats = self._stats.get(key)
+        if stats is None:
+            if len(self._stats) >= self.max_entries:
+                self.untracked += 1
+                return None
+            stats = self._stats[key] = QueryStats()
+        stats.calls += 1
+        stats.total += seconds
+        stats.rows += rows
+        if seconds > stats.max:
+            stats.max = seconds
+        if failed:
+            stats.errors += 1
+        return stats
+
+    def by_function(self) -> list[tuple[str, QueryStats]]:
+        """Сводка по местам вызова, по убыванию суммарного времени."""
+        totals: dict[str, QueryStats] = {}
+        for (call_site, _), stats in self._stats.items():
+            total = totals.get(call_site)
+            if total is None:
+                total = totals[call_site] = QueryStats()
+            total.calls += stats.calls
+            total.total += stats.total
+            total.max = max(total.max, stats.max)
+            total.rows += stats.rows
+            total.errors += stats.errors
+            total.slow += stats.slow
+        return sorted(totals.items(), key=lambda item: item[1].total, reverse=True)
+
+    def top_queries(self, limit: int = 10, key: str = 'total') -> list[tuple[str, str, QueryStats]]:
+        items = sorted(self._stats.items(), key=lambda item: getattr(item[1], key), reverse=True)[:limit]
+        return [(call_site, query, stats) for (call_site, query), stats in items]
+
+    def on_slow_query(self, call_site: str, query: str, args: tuple, seconds: float, rows: int, stats: QueryStats | None):
+        if stats is not None:
+            stats.slow += 1
+        logger.warning(f"Медленный запрос: {seconds * 1000:.0f} мс, строк: {rows}, {call_site}: {normalize_query(query)[:500]}")
+        if stats is None or self.connect is None or random.random() >= self.explain_sample:
+            return
+        now = timer.monotonic()
+        normalized = normalize_query(query)
+        if now - stats.last_explained < self.explain_interval or not normalized.upper().startswith(_EXPLAINABLE):
+            return
+        if '$1' in normalized and not args:
+            return
+        stats.last_explained = now
+        task = asyncio.create_task(self._explain(call_site, normalized, args, analyze=is_read_only(normalized)))
+        self._explain_tasks.add(task)
+        task.add_done_callback(self._explain_tasks.discard)
+
+    async def _explain(self, call_site: str, query: str, args: tuple, analyze: bool):
+        """
+        План запроса на отдельном соединении. analyze=True (только для is_read_only) выполняет запрос
+        как EXPLAIN (ANALYZE, BUFFERS) в транзакции READ ONLY; иначе запрос не выполняется - EXPLAIN без ANALYZE.
+        """
+        try:
+            conn = await self.connect()
+        except Exception as e:
+            logger.warning(f"EXPLAIN медленного запроса ({call_site}) не выполнен: нет соединения ({e})")
+            return
+        try:
+            # Вызовы мимо профилирования: сам EXPLAIN в статистику и в лог медленных не попадает
+            if analyze:
+                await asyncpg.Connection.execute(conn, "BEGIN TRANSACTION READ ONLY")
+                try:
+                    plan_rows = await asyncpg.Connection.fetch(conn, f"EXPLAIN (ANALYZE, BUFFERS) {query}", *args)
+                finally:
+                    await asyncpg.Connection.execute(conn, "ROLLBACK")
+            else:
+                plan_rows = await asyncpg.Connection.fetch(conn, f"EXPLAIN {query}", *args)
+            plan = "\n".join(row[0] for row in plan_rows)
+            logger.warning(f"План медленного запроса ({call_site}, {'ANALYZE' if analyze else 'без выполнения'}):\n{query[:500]}\n{plan}")
+        except Exception as e:
+            logger.warning(f"EXPLAIN медленного запроса ({call_site}) не выполнен: {e}")
+        finally:
+            await conn.close()
+
+
+query_profiler = QueryProfiler()
+
+
+class ProfiledConnection(asyncpg.Connection):
+    """Соединение asyncpg, учитывающее каждый запрос в query_profiler."""
+
+    async def _profiled(self, method, query: str, args: tuple, kwargs: dict, count_rows):
+        call_site = _call_site()
+        started = timer.perf_counter()
+        failed = True
+        result = None
+        try:
+            result = await method(self, query, *args, **kwargs)
+            failed = False
+            return result
+        finally:
+            seconds = timer.perf_counter() - started
+            rows = 0 if failed else count_rows(result)
+            stats = query_profiler.record(call_site, query, seconds, rows, failed)
+            if seconds >= query_profiler.slow_seconds:
+                query_profiler.on_slow_query(call_site, query, args, seconds, rows, stats)
+
+    def cursor(self, query, *args, **kwargs):
+        return _ProfiledCursorFactory(super().cursor(query, *args, **kwargs), _call_site(), query, args)
+
+    async def fetch(self, query, *args, **kwargs):
+        return await self._profiled(asyncpg.Connection.fetch, query, args, kwargs, len)
+
+    async def fetchrow(self, query, *args, **kwargs):
+        return await self._profiled(asyncpg.Connection.fetchrow, query, args, kwargs, lambda row: int(row is not None))
+
+    async def fetchval(self, query, *args, **kwargs):
+        return await self._profiled(asyncpg.Connection.fetchval, query, args, kwargs, lambda value: int(value is not None))
+
+    async def execute(self, query, *args, **kwargs):
+        return await self._profiled(asyncpg.Connection.execute, query, args, kwargs, _rows_from_status)
+
+    async def executemany(self, command, args, **kwargs):
+        # Параметры пакета в EXPLAIN не передаются: в лог попадает только время и число наборов
+        return await self._profiled(
+            lambda conn, query, **kw: asyncpg.Connection.executemany(conn, query, args, **kw),
+            command, (), kwargs, lambda _: len(args) if hasattr(args, '__len__') else 0
+        )
+
+
+class _ProfiledCursorFactory:
+    """
+    Обертка CursorFactory: обход "async for row in conn.cursor(...)" учитывается одним вызовом -
+    время ожидания строк от БД (паузы потребителя между строками не считаются) и число строк.
+    aiter() возвращает асинхронный генератор: код, который может прервать обход досрочно, обходит его
+    внутри contextlib.aclosing - тогда запись учитывается сразу, а не финализатором генератора.
+    Ручное управление курсором (await conn.cursor(...), затем fetch/forward) не профилируется.
+    """
+
+    def __init__(self, factory, call_site: str, query: str, args: tuple):
+        self._factory = factory
+        self._call_site = call_site
+        self._query = query
+        self._args = args
+
+    def __await__(self):
+        return self._factory.__await__()
+
+    def __aiter__(self):
+        return self._iterate()
+
+    async def _iterate(self):
+        iterator = self._factory.__aiter__()
+        seconds, rows, failed = 0.0, 0, False
+        try:
+            while True:
+                started = timer.perf_counter()
+                try:
+                    row = await iterator.__anext__()
+                except StopAsyncIteration:
+                    break
+                finally:
+                    seconds += timer.perf_counter() - started
+                rows += 1
+                yield row
+        except Exception:
+            failed = True
+            raise
+        finally:
+            # Сюда приходим и при досрочном прекращении обхода (break, отключение клиента потока)
+            stats = query_profiler.record(self._call_site, self._query, seconds, rows, failed)
+            if seconds >= query_profiler.slow_seconds:
+                query_profiler.on_slow_query(self._call_site, self._query, self._args, seconds, rows, stats)
@@ -0,0 +1,112 @@
+# report_cache.py
+import logging
+from collections import OrderedDict
+from datetime import date, datetime
+
+from config import LOCAL_TIMEZONE, REPORT_CACHE_MAX_ENTRIES, REPORT_CACHE_MAX_WEIGHT
+from invalidation_bus import invalidation_bus, InvalidationMessage, EMPLOYEE, SCHEDULE, LEAVE, HOLIDAY, CHECK_IN, RESET
+
+logger = logging.getLogger(__name__)
+
+
+class ReportCache:
+    """
+    LRU-кэш готовых отчетов (статистика, таблицы, отрендеренный текст/CSV) по ключу
+    (тип отчета, начало, конец, доп. параметры). Кэшируются только закрытые периоды
+    (конец периода раньше сегодняшнего дня). Размер ограничен числом записей и суммарным
+    "весом" (примерно - числом символов или ячеек в значении).
+    Отчет считается дольше, чем приходит инвалидация: вызывающий код запоминает generation при промахе
+    get и передает его в put - если за время расчета кэш сбрасывался, устаревший результат не сохраняется.
+    """
+
+    def __init__(self, max_entries: int = REPORT_CACHE_MAX_ENTRIES, max_weight: int = REPORT_CACHE_MAX_WEIGHT):
+        self.max_entries = max_entries
+        self.max_weight = max_weight
+        self._entries = OrderedDict()  # key -> (value, weight)
+        self._total_weight = 0
+        self.generation = 0  # Увеличивается при каждом сбросе (invalidate_*/clear)
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def _key(report_type: str, start_date: date, end_date: date, extra: tuple) -> tuple:
+        return (report_type, start_date, end_date, extra)
+
+    def get(self, report_type: str, start_date: date, end_date: date, *extra):
+        """Возвращает закэшированное значение или None."""
+        key = self._key(report_type, start_date, end_date, extra)
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry[0]
+
+    def put(self, report_type: str, start_date: date, end_date: date, value, *extra, generation: int, weight: int = 1):
+        """
+        Сохраняет значение, если период уже закрыт, значение помещается в лимит веса и с момента
+        промаха (generation - значение self.generation до начала расчета) кэш не сбрасывался.
+        """
+        if (generation != self.generation or end_date >= datetime.now(LOCAL_TIMEZONE).date()
+                or weight > self.max_weight):
+            return
+        key = self._key(report_type, start_date, end_date, extra)
+        self._remove(key)
+        self._entries[key] = (value, weight)
+        self._total_weight += weight
+        while len(self._entries) > self.max_entries or self._total_weight > self.max_weight:
+            oldest_key = next(iter(self._entries))
+            self._remove(oldest_key)
+
+    def _remove(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._total_weight -= entry[1]
+
+    def invalidate_dates(self, first_date: date, last_date: date | None = None):
+        """Удаляет все отчеты, период которых пересекается с [first_date, last_date]."""
+        last_date = last_date or first_date
+        # Даже если удалять нечего: отчет за этот период может сейчас считаться по старым данным
+        self.generation += 1
+        stale = [key for key in self._entries if key[1] <= last_date and key[2] >= first_date]
+        for key in stale:
+            self._remove(key)
+        if stale:
+            logger.info(f"Кэш отчетов: сброшено {len(stale)} записей за {first_date}..{last_date}")
+
+    def invalidate_from(self, first_date: date):
+        """Удаляет все отчеты, затрагивающие first_date и более поздние даты (например, при смене графика)."""
+        self.invalidate_dates(first_date, date.max)
+
+    def clear(self):
+        """Полностью очищает кэш (например, при изменении списка сотрудников)."""
+        self.generation += 1
+        if self._entries:
+            logger.info(f"Кэш отчетов: очищено {len(self._entries)} записей")
+        self._entries.clear()
+        self._total_weight = 0
+
+
+report_cache = ReportCache()
+
+
+def _on_dated_change(message: InvalidationMessage):
+    report_cache.invalidate_dates(message.start_date, message.end_date)
+
+
+def _on_schedule_change(message: InvalidationMessage):
+    report_cache.invalidate_from(message.start_date)
+
+
+def _on_employee_change(message: InvalidationMessage):
+    # В отчеты попадают только активные сотрудники и их ФИО; прочие поля (фото) на отчеты не влияют
+    if message.is_active is not None:
+        report_cache.clear()
+
+
+for _entity in (LEAVE, HOLIDAY, CHECK_IN):
+    invalidation_bus.subscribe(_entity, _on_dated_change)
+invalidation_bus.subscribe(SCHEDULE, _on_schedule_change)
+invalidation_bus.subscribe(EMPLOYEE, _on_employee_change)
+invalidation_bus.subscribe(RESET, lambda message: report_cache.clear())
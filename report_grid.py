@@ -0,0 +1,260 @@
+# report_grid.py
+from __future__ import annotations
+
+from datetime import date, timedelta
+from functools import lru_cache
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    import numpy as np
+
+# NumPy импортируется внутри функций, строящих матрицу: подписи, заголовки и SQL-выражения
+# этого модуля нужны веб-панели и боту сразу, а сама матрица - только при построении отчета.
+
+# --- Битовые флаги событий дня в ячейке (сотрудник, день) ---
+FLAG_SUCCESS = 1 << 0
+FLAG_LATE = 1 << 1
+FLAG_APPROVED_LEAVE = 1 << 2
+FLAG_ABSENT_INCOMPLETE = 1 << 3
+FLAG_VACATION = 1 << 4
+FLAG_SICK_LEAVE = 1 << 5
+FLAG_WORK_DAY = 1 << 6
+FLAG_HOLIDAY = 1 << 7
+FLAG_PAST = 1 << 8
+
+# Статусы из check_ins и leaves, которые влияют на итоговую ячейку
+EVENT_FLAGS = {
+    'SUCCESS': FLAG_SUCCESS,
+    'LATE': FLAG_LATE,
+    'APPROVED_LEAVE': FLAG_APPROVED_LEAVE,
+    'ABSENT_INCOMPLETE': FLAG_ABSENT_INCOMPLETE,
+    'VACATION': FLAG_VACATION,
+    'SICK_LEAVE': FLAG_SICK_LEAVE,
+}
+
+# --- Итоговые коды ячеек и их подписи (индекс в кортеже = код) ---
+STATUS_LABELS = (
+    "—",                          # 0: будущий рабочий день
+    "Пропустил",                  # 1
+    "Праздник",                   # 2
+    "Выходной",                   # 3
+    "Отпуск",                     # 4
+    "Больничный",                 # 5
+    "Вовремя",                    # 6
+    "Вовремя, Отпросился",        # 7
+    "Вовремя, Не завершил день",  # 8
+    "Опоздал",                    # 9
+    "Опоздал, Отпросился",        # 10
+    "Опоздал, Не завершил день",  # 11
+)
+
+
+# Компактный формат отчета для веб-панели: строка сотрудника - по одному символу кода на день
+CODE_CHARS = "0123456789abcdefghijklmnopqrstuvwxyz"[:len(STATUS_LABELS)]
+
+
+@lru_cache(maxsize=1)
+def _labels_array():
+    import numpy as np
+    return np.array(STATUS_LABELS, dtype=object)
+
+
+@lru_cache(maxsize=1)
+def _code_chars_array():
+    import numpy as np
+    return np.frombuffer(CODE_CHARS.encode('ascii'), dtype=np.uint8)
+
+
+def range_header(start_date: date, end_date: date) -> list[str]:
+    """Заголовок таблицы отчета; если период захватывает несколько лет, в подписи дня добавляется год."""
+    day_format = '%d.%m' if start_date.year == end_date.year else '%d.%m.%Y'
+    num_days = (end_date - start_date).days + 1
+    return ["Сотрудник"] + [(start_date + timedelta(days=n)).strftime(day_format) for n in range(num_days)]
+
+
+def checkin_flags_sql(status_column: str = "status") -> str:
+    """SQL-выражение, переводящее статус чекина в битовый флаг (для bit_or в GROUP BY)."""
+    cases = " ".join(f"WHEN '{status}' THEN {flag}" for status, flag in EVENT_FLAGS.items())
+    return f"CASE {status_column} {cases} ELSE 0 END"
+
+
+class AttendanceGrid:
+    """
+    Матрица посещаемости (сотрудники x дни) с итоговыми кодами ячеек.
+    codes[i, j] - индекс в STATUS_LABELS для сотрудника i в день start_date + j.
+    """
+
+    def __init__(self, employee_ids: list[int], employee_names: list[str], start_date: date, codes: np.ndarray):
+        self.employee_ids = employee_ids
+        self.employee_names = employee_names
+        self.start_date = start_date
+        self.codes = codes
+
+    @property
+    def num_days(self) -> int:
+        return self.codes.shape[1]
+
+    @property
+    def dates(self) -> list[date]:
+        return [self.start_date + timedelta(days=n) for n in range(self.num_days)]
+
+    def header(self) -> list[str]:
+        return range_header(self.start_date, self.start_date + timedelta(days=self.num_days - 1))
+
+    def rows(self):
+        """Строки таблицы [ФИО, статус, статус, ...]; подписи подставляются одной операцией на всю матрицу."""
+        labels = _labels_array()[self.codes]
+        for name, row in zip(self.employee_names, labels.tolist()):
+            yield [name] + row
+
+    def to_table(self) -> list[list]:
+        return [self.header()] + list(self.rows())
+
+    def code_strings(self) -> list[str]:
+        """Строки кодов ячеек (символ CODE_CHARS на день) - без подстановки подписей в каждую ячейку."""
+        num_days = self.num_days
+        encoded = _code_chars_array()[self.codes].tobytes().decode('ascii')
+        return [encoded[i * num_days:(i + 1) * num_days] for i in range(len(self.employee_ids))]
+
+
+def _work_day_mask(emp_idx: np.ndarray, dows: np.ndarray, eff_ords: np.ndarray, is_work: np.ndarray,
+                   num_emps: int, day_ords: np.ndarray) -> np.ndarray:
+    """
+    Для каждой ячейки находит действующую версию графика (последнюю с effective_from_date <= дня)
+    одним searchsorted по составному ключу (сотрудник, день недели, дата версии).
+    """
+    import numpy as np
+    if emp_idx.size == 0:
+        return np.zeros((num_emps, day_ords.size), dtype=bool)
+
+    keys = emp_idx * 7 + dows
+    order = np.lexsort((eff_ords, keys))
+    keys, eff_ords, is_work = keys[order], eff_ords[order], is_work[order]
+
+    base = min(int(eff_ords.min()), int(day_ords[0]))
+    span = max(int(eff_ords.max()), int(day_ords[-1])) - base + 1
+    version_keys = keys * span + (eff_ords - base)
+
+    # date(1, 1, 1).toordinal() == 1 и это понедельник, поэтому weekday = (ordinal - 1) % 7
+    day_dows = (day_ords - 1) % 7
+    cell_keys = np.arange(num_emps, dtype=np.int64)[:, None] * 7 + day_dows[None, :]
+    cell_composite = cell_keys * span + (day_ords - base)[None, :]
+
+    idx = np.searchsorted(version_keys, cell_composite, side='right') - 1
+    safe_idx = np.clip(idx, 0, None)
+    return (idx >= 0) & (keys[safe_idx] == cell_keys) & is_work[safe_idx]
+
+
+def _interval_mask(emp_idx: np.ndarray, start_offsets: np.ndarray, end_offsets: np.ndarray,
+                   num_emps: int, num_days: int) -> np.ndarray:
+    """Маска покрытия интервалов [start, end] (включительно) через разностный массив и cumsum."""
+    import numpy as np
+    diff = np.zeros((num_emps, num_days + 1), dtype=np.int32)
+    starts = np.clip(start_offsets, 0, num_days)
+    ends = np.clip(end_offsets + 1, 0, num_days)
+    valid = starts < ends
+    np.add.at(diff, (emp_idx[valid], starts[valid]), 1)
+    np.add.at(diff, (emp_idx[valid], ends[valid]), -1)
+    return np.cumsum(diff, axis=1)[:, :num_days] > 0
+
+
+def build_status_codes(flags: np.ndarray) -> np.ndarray:
+    """Переводит матрицу битовых флагов в коды STATUS_LABELS (приоритеты как в сводном отчете)."""
+    import numpy as np
+    holiday = (flags & FLAG_HOLIDAY) != 0
+    work = (flags & FLAG_WORK_DAY) != 0
+    vacation = (flags & FLAG_VACATION) != 0
+    sick = (flags & FLAG_SICK_LEAVE) != 0
+    late = (flags & FLAG_LATE) != 0
+    success = (flags & FLAG_SUCCESS) != 0
+    approved = (flags & FLAG_APPROVED_LEAVE) != 0
+    incomplete = (flags & FLAG_ABSENT_INCOMPLETE) != 0
+    past = (flags & FLAG_PAST) != 0
+
+    conditions = [
+        holiday, ~work, vacation, sick,
+        late & approved, late & incomplete, late,
+        success & approved, success & incomplete, success,
+        past,
+    ]
+    choices = [2, 3, 4, 5, 10, 11, 9, 7, 8, 6, 1]
+    return np.select(conditions, choices, default=0).astype(np.uint8)
+
+
+def build_attendance_grid(employees: list[tuple], start_date: date, end_date: date, today: date,
+                          schedule_rows: list, checkin_rows: list, leave_rows: list, holidays) -> AttendanceGrid:
+    """
+    Строит матрицу посещаемости векторными операциями.
+
+    employees     - [(telegram_id, full_name), ...] в порядке строк отчета;
+    schedule_rows - [(telegram_id, day_of_week, effective_from_date, is_work_day), ...];
+    checkin_rows  - [(telegram_id, day_offset, flags), ...], где day_offset - номер дня от start_date,
+                    а флаги уже сложены через bit_or (и то и другое считается в SQL);
+    leave_rows    - [(telegram_id, start_date, end_date, leave_type), ...];
+    holidays      - даты праздников.
+    """
+    import numpy as np
+    employee_ids = [emp[0] for emp in employees]
+    employee_names = [emp[1] for emp in employees]
+    num_emps = len(employee_ids)
+    num_days = (end_date - start_date).days + 1
+    start_ord = start_date.toordinal()
+    day_ords = np.arange(start_ord, start_ord + num_days, dtype=np.int64)
+
+    ids_array = np.array(employee_ids, dtype=np.int64)
+    sorter = np.argsort(ids_array)
+    sorted_ids = ids_array[sorter]
+
+    def emp_indexes(rows) -> np.ndarray:
+        """Индексы строк матрицы для telegram_id из rows; -1 для неизвестных сотрудников."""
+        ids = np.array([row[0] for row in rows], dtype=np.int64)
+        if num_emps == 0:
+            return np.full(ids.shape, -1, dtype=np.int64)
+        pos = np.clip(np.searchsorted(sorted_ids, ids), 0, num_emps - 1)
+        return np.where(sorted_ids[pos] == ids, sorter[pos], -1)
+
+    def day_offsets(rows, column: int) -> np.ndarray:
+        """Смещения дат столбца column относительно start_date (в днях)."""
+        return np.array([row[column].toordinal() for row in rows], dtype=np.int64) - start_ord
+
+    flags = np.zeros((num_emps, num_days), dtype=np.uint16)
+
+    # 1. Рабочие дни по версиям графиков
+    if schedule_rows:
+        idx = emp_indexes(schedule_rows)
+        known = idx >= 0
+        work = _work_day_mask(
+            idx[known],
+            np.array([row[1] for row in schedule_rows], dtype=np.int64)[known],
+            (day_offsets(schedule_rows, 2) + start_ord)[known],
+            np.array([bool(row[3]) for row in schedule_rows], dtype=bool)[known],
+            num_emps, day_ords
+        )
+        flags |= np.where(work, FLAG_WORK_DAY, 0).astype(np.uint16)
+
+    # 2. События чекинов
+    if checkin_rows:
+        idx = emp_indexes(checkin_rows)
+        offsets = np.array([row[1] for row in checkin_rows], dtype=np.int64)
+        values = np.array([row[2] for row in checkin_rows], dtype=np.uint16)
+        valid = (idx >= 0) & (offsets >= 0) & (offsets < num_days)
+        np.bitwise_or.at(flags, (idx[valid], offsets[valid]), values[valid])
+
+    # 3. Отпуска и больничные
+    if leave_rows:
+        idx = emp_indexes(leave_rows)
+        starts = day_offsets(leave_rows, 1)
+        ends = day_offsets(leave_rows, 2)
+        types = np.array([row[3] for row in leave_rows], dtype=object)
+        for leave_type, flag in (('VACATION', FLAG_VACATION), ('SICK_LEAVE', FLAG_SICK_LEAVE)):
+            selected = (idx >= 0) & (types == leave_type)
+            mask = _interval_mask(idx[selected], starts[selected], ends[selected], num_emps, num_days)
+            flags |= np.where(mask, flag, 0).astype(np.uint16)
+
+    # 4. Праздники и прошедшие дни - маски по столбцам
+    holiday_offsets = [d.toordinal() - start_ord for d in holidays if start_date <= d <= end_date]
+    if holiday_offsets:
+        flags[:, holiday_offsets] |= FLAG_HOLIDAY
+    flags[:, day_ords <= today.toordinal()] |= FLAG_PAST
+
+    return AttendanceGrid(employee_ids, employee_names, start_date, build_status_codes(flags))
@@ -0,0 +1,299 @@
+# sharding.py
+"""
+Горизонтальное шардирование обработки апдейтов по telegram id пользователя.
+
+Фронт (front) один получает апдейты от Telegram - опросом или вебхуком - и, не разбирая их,
+пересылает строкой NDJSON через локальный Unix-сокет воркеру, владеющему диапазоном хэшей
+отправителя. Каждый воркер (worker) - отдельный процесс бота со своим пулом распознавания лиц,
+своей долей лимита исходящих сообщений, своими состояниями диалогов и своим журналом
+уведомлений; напоминания сотрудникам шлет воркер-владелец, общие задачи (отчеты, штрафы)
+выполняет один воркер через JobLeader.
+
+Запуск всего на одной машине:  python sharding.py serve --shards 4 [--mode polling|webhook]
+Отдельно:                      python sharding.py worker 0 4   /   python sharding.py front --shards 4
+Для проверки без Telegram укажите BOT_API_BASE_URL на fake_bot_api.py и шлите апдейты
+в POST /fake/updates.
+"""
+import argparse
+import asyncio
+import hashlib
+import hmac
+import json
+import logging
+import os
+import sys
+from functools import partial
+
+import config
+
+logger = logging.getLogger(__name__)
+
+_current_shard: tuple[int, int] | None = None  # (номер, всего) в процессе воркера
+
+
+def shard_for(user_id: int, shards: int) -> int:
+    """Номер шарда, владеющего пользователем: 64-битный хэш id, поделенный на равные диапазоны."""
+    digest = hashlib.blake2b(int(user_id).to_bytes(8, 'big', signed=True), digest_size=8).digest()
+    return (int.from_bytes(digest, 'big') * shards) >> 64
+
+
+def set_current_shard(index: int, shards: int):
+    global _current_shard
+    _current_shard = (index, shards)
+
+
+def current_shard() -> tuple[int, int] | None:
+    return _current_shard
+
+
+def owns_user(user_id: int) -> bool:
+    """True, если пользователь обслуживается этим процессом (без шардирования - всегда)."""
+    if _current_shard is None:
+        return True
+    index, shards = _current_shard
+    return shard_for(user_id, shards) == index
+
+
+def owns_key(key) -> bool:
+    """Владение ключом состояния PTB: id пользователя/чата или кортеж диалога (chat_id, user_id)."""
+    if isinstance(key, tuple):
+        key = key[-1]
+    return not isinstance(key, int) or owns_user(key)
+
+
+def job_suffix() -> str:
+    """Суффикс имени задачи планировщика, выполняемой каждым шардом для своих сотрудников."""
+    return f":shard{_current_shard[0]}of{_current_shard[1]}" if _current_shard else ""
+
+
+def socket_path(index: int) -> str:
+    return os.path.join(config.SHARD_SOCKET_DIR, f"checkin-shard-{index}.sock")
+
+
+def update_owner_id(data: dict) -> int | None:
+    """
+    Id отправителя из "сырого" апдейта (тот же приоритет, что у KeyedUpdateProcessor:
+    пользователь, иначе чат), без построения объекта Update.
+    """
+    chat_id = None
+    for field, value in data.items():
+        if field == 'update_id' or not isinstance(value, dict):
+            continue
+        user = value.get('from') or value.get('user')
+        if user:
+            return user['id']
+        chat = value.get('chat') or (value.get('message') or {}).get('chat')
+        if chat and chat_id is None:
+            chat_id = chat['id']
+    return chat_id
+
+
+# --- Фронт: пересылка апдейтов воркерам ---
+class ShardRouter:
+    """
+    Одна очередь и один отправитель на каждый воркер: порядок апдейтов внутри шарда сохраняется,
+    а пока воркер перезапускается, апдейты копятся в очереди (до max_buffer на шард; сверх - отбрасываются
+    и считаются в dropped, чтобы недоступный воркер не останавливал доставку остальным шардам).
+    """
+
+    def __init__(self, shards: int, max_buffer: int = 10_000):
+        self.shards = shards
+        self._queues = [asyncio.Queue(maxsize=max_buffer) for _ in range(shards)]
+        self._tasks: list[asyncio.Task] = []
+        self.forwarded = [0] * shards
+        self.dropped = [0] * shards
+
+    def start(self):
+        self._tasks = [asyncio.get_running_loop().create_task(self._sender(i)) for i in range(self.shards)]
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+
+    async def forward(self, data: dict):
+        owner = update_owner_id(data)
+        index = shard_for(owner, self.shards) if owner is not None else 0
+        try:
+            # Без ожидания: полная очередь одного шарда (воркер упал) не должна останавливать прием для всех
+            self._queues[index].put_nowait(json.dumps(data, ensure_ascii=False, separators=(',', ':')).encode() + b'\n')
+        except asyncio.QueueFull:
+            self.dropped[index] += 1
+            if self.dropped[index] == 1 or self.dropped[index] % 1000 == 0:
+                logger.error(f"Очередь шарда {index} переполнена (воркер недоступен): отброшено апдейтов - {self.dropped[index]}.")
+
+    async def _sender(self, index: int):
+        queue = self._queues[index]
+        line = None
+        while True:
+            try:
+                _, writer = await asyncio.open_unix_connection(socket_path(index))
+            except OSError:
+                await asyncio.sleep(1)
+                continue
+            logger.info(f"Фронт подключен к шарду {index}.")
+            try:
+                while True:
+                    if line is None:
+                        line = await queue.get()
+                    writer.write(line)
+                    await writer.drain()
+                    line = None
+                    self.forwarded[index] += 1
+            except (ConnectionError, OSError) as e:
+                # Неотправленная строка (line) уйдет первой после переподключения
+                logger.warning(f"Соединение с шардом {index} потеряно: {e}. Переподключение...")
+            finally:
+                writer.close()
+
+
+async def _poll_updates(router: ShardRouter):
+    from telegram import Bot, Update
+    from telegram.error import NetworkError
+
+    bot_kwargs = {'base_url': config.BOT_API_BASE_URL} if config.BOT_API_BASE_URL else {}
+    async with Bot(config.BOT_TOKEN, **bot_kwargs) as bot:
+        await bot.delete_webhook()
+        offset = None
+        while True:
+            try:
+                updates = await bot.get_updates(offset=offset, timeout=30, allowed_updates=Update.ALL_TYPES)
+            except NetworkError as e:
+                logger.warning(f"Ошибка получения апдейтов: {e}")
+                await asyncio.sleep(1)
+                continue
+            for update in updates:
+                await router.forward(update.to_dict())
+                offset = update.update_id + 1
+
+
+async def _serve_webhook(router: ShardRouter):
+    import uvicorn
+    from fastapi import FastAPI, HTTPException, Request
+    from telegram import Bot, Update
+    import webhook
+
+    if not config.WEBHOOK_URL or not config.WEBHOOK_SECRET_TOKEN:
+        raise ValueError("Для режима вебхука нужно задать WEBHOOK_URL и WEBHOOK_SECRET_TOKEN в файле .env.")
+    asgi_app = FastAPI(title="Check-in Bot Shard Front", docs_url=None, redoc_url=None, openapi_url=None)
+
+    @asgi_app.post(config.WEBHOOK_PATH)
+    async def receive(request: Request):
+        secret = request.headers.get(webhook.SECRET_HEADER, "")
+        if not hmac.compare_digest(secret, config.WEBHOOK_SECRET_TOKEN):
+            raise HTTPException(status_code=403, detail="Неверный секретный токен вебхука.")
+        await router.forward(await request.json())
+        return {"ok": True}
+
+    bot_kwargs = {'base_url': config.BOT_API_BASE_URL} if config.BOT_API_BASE_URL else {}
+    async with Bot(config.BOT_TOKEN, **bot_kwargs) as bot:
+        await bot.set_webhook(url=config.WEBHOOK_URL.rstrip('/') + config.WEBHOOK_PATH,
+                              secret_token=config.WEBHOOK_SECRET_TOKEN, allowed_updates=Update.ALL_TYPES)
+    server = uvicorn.Server(uvicorn.Config(
+        asgi_app, host=config.WEBHOOK_LISTEN_HOST, port=config.WEBHOOK_LISTEN_PORT, log_level="warning"
+    ))
+    await server.serve()
+
+
+async def run_front(shards: int, mode: str):
+    router = ShardRouter(shards)
+    router.start()
+    logger.info(f"Фронт запущен: {shards} шардов, режим {mode}.")
+    try:
+        if mode == "webhook":
+            await _serve_webhook(router)
+        else:
+            await _poll_updates(router)
+    finally:
+        await router.stop()
+
+
+# --- Воркер: бот, обслуживающий один шард ---
+async def _read_updates(application, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    from telegram import Update
+
+    try:
+        while line := await reader.readline():
+            try:
+                update = Update.de_json(json.loads(line), application.bot)
+            except Exception as e:
+                logger.error(f"Некорректный апдейт от фронта: {e}", exc_info=True)
+                continue
+            await application.update_queue.put(update)
+    finally:
+        writer.close()
+
+
+async def run_worker(index: int, shards: int):
+    set_current_shard(index, shards)
+    import main as bot_main  # тяжелый импорт (распознавание лиц) - только в процессе воркера
+
+    application = bot_main.build_application()
+    scheduler = bot_main.build_scheduler(application)
+    path = socket_path(index)
+    if os.path.exists(path):
+        os.unlink(path)
+    try:
+        await bot_main.start_bot(application, scheduler, update_mode="shard")
+        server = await asyncio.start_unix_server(partial(_read_updates, application), path=path)
+        logger.info(f"Шард {index} из {shards} слушает {path}.")
+        async with server:
+            await server.serve_forever()
+    finally:
+        await bot_main.stop_bot(application, scheduler)
+        bot_main.shutdown_executor()
+
+
+# --- Запуск фронта и воркеров вместе ---
+async def _supervise(index: int, shards: int):
+    """Держит процесс воркера запущенным, перезапуская его после падения."""
+    while True:
+        process = await asyncio.create_subprocess_exec(sys.executable, os.path.abspath(__file__), 'worker', str(index), str(shards))
+        try:
+            code = await process.wait()
+        except asyncio.CancelledError:
+            process.terminate()
+            await process.wait()
+            raise
+        logger.error(f"Воркер шарда {index} завершился с кодом {code}, перезапуск через 5 с.")
+        await asyncio.sleep(5)
+
+
+async def serve(shards: int, mode: str):
+    supervisors = [asyncio.create_task(_supervise(i, shards)) for i in range(shards)]
+    try:
+        await run_front(shards, mode)
+    finally:
+        for task in supervisors:
+            task.cancel()
+        await asyncio.gather(*supervisors, return_exceptions=True)
+
+
+def main(argv=None):
+    logging.basicConfig(format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.INFO)
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+    parser = argparse.ArgumentParser(description="Шардированный запуск бота: фронт и воркеры по диапазонам id пользователей.")
+    commands = parser.add_subparsers(dest='command', required=True)
+    serve_parser = commands.add_parser('serve', help="фронт и все воркеры на этой машине")
+    front_parser = commands.add_parser('front', help="только фронт")
+    for command_parser in (serve_parser, front_parser):
+        command_parser.add_argument('--shards', type=int, default=os.cpu_count() or 1)
+        command_parser.add_argument('--mode', choices=('polling', 'webhook'), default='polling')
+    worker_parser = commands.add_parser('worker', help="один воркер")
+    worker_parser.add_argument('index', type=int)
+    worker_parser.add_argument('shards', type=int)
+    args = parser.parse_args(argv)
+
+    try:
+        if args.command == 'worker':
+            asyncio.run(run_worker(args.index, args.shards))
+        elif args.command == 'front':
+            asyncio.run(run_front(args.shards, args.mode))
+        else:
+            asyncio.run(serve(args.shards, args.mode))
+    except KeyboardInterrupt:
+        logger.info("Остановлено.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,441 @@
+# tracing.py
+"""
+Трассировка чекина по этапам. Чекин растянут на несколько апдейтов (кнопка "Приход" -> фото ->
+геолокация), поэтому trace id хранится в context.user_data и продолжается каждым обработчиком;
+внутри апдейта текущий спан передается через contextvars, а в пул процессов - вместе с задачей
+(run_in_executor): спаны воркера возвращаются с результатом и попадают в общий буфер.
+
+Завершенные спаны лежат в кольцевом буфере процесса (TRACE_BUFFER_SIZE) и периодически
+выгружаются в JSONL-файл (TRACE_EXPORT_FILE) и/или OTLP/HTTP-коллектор (TRACE_OTLP_ENDPOINT).
+
+Запуск как скрипта:
+  python tracing.py report traces.jsonl [--prefix ИМЯ]   - p50/p95/p99 по этапам
+  python tracing.py collect --port 4318 --output traces.jsonl - простой OTLP/HTTP-коллектор в файл
+"""
+import argparse
+import asyncio
+import contextvars
+import functools
+import json
+import logging
+import os
+import secrets
+import sys
+import time as timer
+from collections import defaultdict, deque
+from contextlib import contextmanager
+
+import config
+
+logger = logging.getLogger(__name__)
+
+USER_DATA_KEY = "trace_id"
+SERVICE_NAME = "checkin-bot"
+
+
+class Span:
+    """Один этап трассы. start_ns - unix-время в наносекундах (сравнимо между процессами), duration_ns - длительность."""
+    __slots__ = ('trace_id', 'span_id', 'parent_id', 'name', 'start_ns', 'duration_ns', 'attributes')
+
+    def __init__(self, trace_id: str, parent_id: str | None, name: str, start_ns: int, attributes: dict | None = None,
+                 span_id: str | None = None):
+        self.trace_id = trace_id
+        self.span_id = span_id or secrets.token_hex(8)
+        self.parent_id = parent_id
+        self.name = name
+        self.start_ns = start_ns
+        self.duration_ns = 0
+        self.attributes = attributes or {}
+
+    def to_dict(self) -> dict:
+        return {
+            'trace_id': self.trace_id, 'span_id': self.span_id, 'parent_id': self.parent_id, 'name': self.name,
+            'start_ns': self.start_ns, 'duration_ms': round(self.duration_ns / 1e6, 3), 'attributes': self.attributes,
+        }
+
+
+class SpanBuffer:
+    """Кольцевой буфер завершенных спанов; помнит, до какого спана уже выгружено."""
+
+    def __init__(self, size: int = config.TRACE_BUFFER_SIZE):
+        self._spans: deque = deque(maxlen=size)  # (номер, спан)
+        self._seq = 0
+        self._exported_seq = 0
+        self.dropped = 0  # Вытеснено из буфера до выгрузки
+
+    def add(self, span: Span):
+        if len(self._spans) == self._spans.maxlen and self._spans[0][0] > self._exported_seq:
+            self.dropped += 1
+        self._seq += 1
+        self._spans.append((self._seq, span))
+
+    def recent(self, limit: int | None = None) -> list[Span]:
+        spans = [span for _, span in self._spans]
+        return spans[-limit:] if limit else spans
+
+    def take_unexported(self) -> list[Span]:
+        spans = [span for seq, span in self._spans if seq > self._exported_seq]
+        self._exported_seq = self._seq
+        return spans
+
+
+span_buffer = SpanBuffer()
+
+_current_span: contextvars.ContextVar[Span | None] = contextvars.ContextVar('current_span', default=None)
+# В воркере пула спаны собираются в список, который вернется вместе с результатом задачи
+_worker_sink: contextvars.ContextVar[list | None] = contextvars.ContextVar('worker_sink', default=None)
+
+
+def new_trace_id() -> str:
+    return secrets.token_hex(16)
+
+
+def current_span() -> Span | None:
+    return _current_span.get()
+
+
+def _record(span: Span):
+    sink = _worker_sink.get()
+    if sink is not None:
+        sink.append(span)
+    else:
+        span_buffer.add(span)
+
+
+@contextmanager
+def span(name: str, trace_id: str | None = None, **attributes):
+    """
+    Замеряет блок как дочерний спан текущего. trace_id начинает корневой спан этой трассы
+    (обработчик апдейта). Без активной трассы (или при TRACE_ENABLED=0) ничего не записывает.
+    """
+    parent = _current_span.get()
+    if not config.TRACE_ENABLED or (parent is None and trace_id is None):
+        yield None
+        return
+    if trace_id is not None:
+        new_span = Span(trace_id, None, name, timer.time_ns(), attributes)
+    else:
+        new_span = Span(parent.trace_id, parent.span_id, name, timer.time_ns(), attributes)
+    token = _current_span.set(new_span)
+    started = timer.perf_counter_ns()
+    try:
+        yield new_span
+    except BaseException as e:
+        new_span.attributes['error'] = type(e).__name__
+        raise
+    finally:
+        new_span.duration_ns = timer.perf_counter_ns() - started
+        _current_span.reset(token)
+        _record(new_span)
+
+
+def traced(name: str | None = None):
+    """Декоратор корутины: вызов внутри активной трассы записывается спаном name (по умолчанию - имя функции)."""
+    def decorator(function):
+        span_name = name or function.__name__
+
+        @functools.wraps(function)
+        async def wrapper(*args, **kwargs):
+            if _current_span.get() is None:
+                return await function(*args, **kwargs)
+            with span(span_name):
+                return await function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def traced_handler(name: str, start: bool = False, continue_states: tuple = ()):
+    """
+    Декоратор обработчика PTB (update, context): записывает обработчик корневым спаном трассы
+    из context.user_data. start=True начинает новую трассу (первый шаг чекина); без start
+    обработчик вне начатой трассы не трассируется. Трасса продолжается, только если обработчик
+    вернул одно из continue_states (следующий шаг чекина); при любом другом результате или ошибке
+    она завершается - id трассы удаляется из user_data (оно сохраняется), чтобы не достаться
+    следующим, несвязанным апдейтам пользователя.
+    """
+    def decorator(function):
+        @functools.wraps(function)
+        async def wrapper(update, context, *args, **kwargs):
+            if start and config.TRACE_ENABLED:
+                context.user_data[USER_DATA_KEY] = new_trace_id()
+            trace_id = context.user_data.get(USER_DATA_KEY)
+            if trace_id is None:
+                return await function(update, context, *args, **kwargs)
+            result = None
+            try:
+                with span(name, trace_id=trace_id):
+                    result = await function(update, context, *args, **kwargs)
+                return result
+            finally:
+                if result not in continue_states:
+                    context.user_data.pop(USER_DATA_KEY, None)
+        return wrapper
+    return decorator
+
+
+# --- Передача трассы в пул процессов ---
+def _run_traced_in_worker(function, args: tuple, trace_id: str, parent_id: str):
+    """Выполняется в воркере: запускает function под спаном worker.<имя> и возвращает результат вместе со спанами."""
+    started_ns = timer.time_ns()
+    spans = []
+    sink_token = _worker_sink.set(spans)
+    # Родитель - спан основного процесса: в воркере нужны только его trace id и span id
+    span_token = _current_span.set(Span(trace_id, None, "", started_ns, span_id=parent_id))
+    try:
+        with span(f"worker.{function.__name__}", pid=os.getpid()):
+            result = function(*args)
+    finally:
+        _current_span.reset(span_token)
+        _worker_sink.reset(sink_token)
+    return result, spans, started_ns, timer.time_ns()
+
+
+async def run_in_executor(executor, function, *args):
+    """
+    loop.run_in_executor с продолжением трассы: ожидание свободного воркера (executor_queue),
+    работа воркера со спанами изнутри function и возврат результата (executor_return) становятся
+    отдельными спанами. Вне трассы - обычный run_in_executor без накладных расходов.
+    """
+    loop = asyncio.get_running_loop()
+    parent = _current_span.get()
+    if parent is None or not config.TRACE_ENABLED:
+        return await loop.run_in_executor(executor, function, *args)
+
+    submitted_ns = timer.time_ns()
+    result, worker_spans, started_ns, finished_ns = await loop.run_in_executor(
+        executor, _run_traced_in_worker, function, args, parent.trace_id, parent.span_id
+    )
+    received_ns = timer.time_ns()
+    for name, start_ns, end_ns in (("executor_queue", submitted_ns, started_ns), ("executor_return", finished_ns, received_ns)):
+        stage = Span(parent.trace_id, parent.span_id, name, start_ns)
+        stage.duration_ns = max(0, end_ns - start_ns)
+        span_buffer.add(stage)
+    for worker_span in worker_spans:
+        span_buffer.add(worker_span)
+    return result
+
+
+# --- Выгрузка: JSONL-файл и OTLP/HTTP (JSON) ---
+def _append_jsonl(path: str, spans: list[Span]):
+    lines = "".join(json.dumps(span.to_dict(), ensure_ascii=False) + "\n" for span in spans)
+    with open(path, "a", encoding="utf-8") as f:
+        f.write(lines)  # Одной записью - строки процессов-шардов в общем файле не перемешиваются
+
+
+def _otlp_attributes(attributes: dict) -> list:
+    result = []
+    for key, value in attributes.items():
+        if isinstance(value, bool):
+            typed = {'boolValue': value}
+        elif isinstance(value, int):
+            typed = {'intValue': str(value)}
+        elif isinstance(value, float):
+            typed = {'doubleValue': value}
+        else:
+            typed = {'stringValue': str(value)}
+        result.append({'key': key, 'value': typed})
+    return result
+
+
+def to_otlp(spans: list[Span]) -> dict:
+    """Тело запроса OTLP/HTTP JSON (POST /v1/traces)."""
+    return {'resourceSpans': [{
+        'resource': {'attributes': _otlp_attributes({'service.name': SERVICE_NAME, 'process.pid': os.getpid()})},
+        'scopeSpans': [{
+            'scope': {'name': __name__},
+            'spans': [{
+                'traceId': span.trace_id,
+                'spanId': span.span_id,
+                'parentSpanId': span.parent_id or '',
+                'name': span.name,
+                'kind': 1,
+                'startTimeUnixNano': str(span.start_ns),
+                'endTimeUnixNano': str(span.start_ns + span.duration_ns),
+                'attributes': _otlp_attributes(span.attributes),
+            } for span in spans],
+        }],
+    }]}
+
+
+def from_otlp(body: dict) -> list[dict]:
+    """Обратное преобразование OTLP JSON в записи формата JSONL-выгрузки (для коллектора)."""
+    records = []
+    for resource_spans in body.get('resourceSpans', []):
+        for scope_spans in resource_spans.get('scopeSpans', []):
+            for item in scope_spans.get('spans', []):
+                start_ns, end_ns = int(item['startTimeUnixNano']), int(item['endTimeUnixNano'])
+                attributes = {a['key']: next(iter(a['value'].values()), None) for a in item.get('attributes', [])}
+                records.append({
+                    'trace_id': item['traceId'], 'span_id': item['spanId'], 'parent_id': item.get('parentSpanId') or None,
+                    'name': item['name'], 'start_ns': start_ns, 'duration_ms': round((end_ns - start_ns) / 1e6, 3),
+                    'attributes': attributes,
+                })
+    return records
+
+
+class TraceExporter:
+    """Фоновая выгрузка новых спанов буфера раз в interval секунд; при остановке выгружает остаток."""
+
+    def __init__(self, buffer: SpanBuffer, file_path: str = config.TRACE_EXPORT_FILE,
+                 otlp_endpoint: str = config.TRACE_OTLP_ENDPOINT, interval: float = config.TRACE_EXPORT_INTERVAL_SECONDS):
+        self.buffer = buffer
+        self.file_path = file_path
+        self.otlp_endpoint = otlp_endpoint
+        self.interval = interval
+        self._task: asyncio.Task | None = None
+        self._client = None
+
+    @property
+    def enabled(self) -> bool:
+        return config.TRACE_ENABLED and bool(self.file_path or self.otlp_endpoint)
+
+    async def flush(self):
+        spans = self.buffer.take_unexported()
+        if not spans:
+            return
+        if self.file_path:
+            try:
+                await asyncio.to_thread(_append_jsonl, self.file_path, spans)
+            except OSError as e:
+                logger.warning(f"Не удалось записать {len(spans)} спанов в {self.file_path}: {e}")
+        if self.otlp_endpoint:
+            try:
+                if self._client is None:
+                    import httpx  # Зависимость python-telegram-bot; нужна только при выгрузке в коллектор
+                    self._client = httpx.AsyncClient(timeout=5)
+                response = await self._client.post(self.otlp_endpoint, json=to_otlp(spans))
+                response.raise_for_status()
+            except Exception as e:
+                logger.warning(f"Не удалось отправить {len(spans)} спанов в {self.otlp_endpoint}: {e}")
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            await self.flush()
+
+    def start(self):
+        if self.enabled and self._task is None:
+            self._task = asyncio.create_task(self._run())
+            logger.info(f"Выгрузка трасс чекина: {self.file_path or ''} {self.otlp_endpoint or ''}".rstrip())
+
+    async def stop(self):
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+        await self.flush()
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+
+trace_exporter = TraceExporter(span_buffer)
+
+
+# --- CLI: отчет по перцентилям и коллектор-заглушка ---
+TOTAL_ROW = "(чекин целиком, без ожидания сотрудника)"
+
+
+def _percentile(sorted_values: list[float], q: float) -> float:
+    # Метод ближайшего ранга: значение, не меньше которого q% наблюдений
+    index = max(0, min(len(sorted_values) - 1, int(-(-q * len(sorted_values) // 100)) - 1))
+    return sorted_values[index]
+
+
+def stage_durations(records) -> dict[str, list[float]]:
+    """Длительности (мс) по имени этапа; строка TOTAL_ROW - сумма корневых спанов (обработчиков) каждой трассы."""
+    by_stage = defaultdict(list)
+    totals = defaultdict(float)
+    for record in records:
+        by_stage[record['name']].append(record['duration_ms'])
+        if not record.get('parent_id'):
+            totals[record['trace_id']] += record['duration_ms']
+    if totals:
+        by_stage[TOTAL_ROW] = list(totals.values())
+    return by_stage
+
+
+def _read_records(path: str):
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+
+def print_report(path: str, prefix: str = ""):
+    by_stage = stage_durations(_read_records(path))
+    rows = sorted((name, sorted(values)) for name, values in by_stage.items() if name.startswith(prefix) or name == TOTAL_ROW)
+    if not rows:
+        print("Спанов не найдено.")
+        return
+    width = max(len(name) for name, _ in rows)
+    print(f"{'этап':<{width}}  {'кол-во':>7}  {'p50, мс':>9}  {'p95, мс':>9}  {'p99, мс':>9}  {'макс, мс':>9}")
+    for name, values in rows:
+        print(f"{name:<{width}}  {len(values):>7}  {_percentile(values, 50):>9.1f}  {_percentile(values, 95):>9.1f}  "
+              f"{_percentile(values, 99):>9.1f}  {values[-1]:>9.1f}")
+
+
+async def _handle_collect(reader: asyncio.StreamReader, writer: asyncio.StreamWriter, output: str):
+    try:
+        request_line = await asyncio.wait_for(reader.readline(), timeout=5)
+        content_length = 0
+        while (line := await asyncio.wait_for(reader.readline(), timeout=5)) not in (b'\r\n', b'\n', b''):
+            name, _, value = line.decode('latin-1').partition(':')
+            if name.strip().lower() == 'content-length':
+                content_length = int(value)
+        body = await asyncio.wait_for(reader.readexactly(content_length), timeout=5)
+        if request_line.split(b' ')[:2] == [b'POST', b'/v1/traces']:
+            records = from_otlp(json.loads(body or b'{}'))
+            with open(output, "a", encoding="utf-8") as f:
+                f.write("".join(json.dumps(record, ensure_ascii=False) + "\n" for record in records))
+            status, response_body = "200 OK", b'{}'
+        else:
+            status, response_body = "404 Not Found", b'{}'
+        writer.write(f"HTTP/1.1 {status}\r\nContent-Type: application/json\r\nContent-Length: {len(response_body)}\r\n"
+                     f"Connection: close\r\n\r\n".encode() + response_body)
+        await writer.drain()
+    except (asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionError, ValueError) as e:
+        logger.warning(f"Некорректный запрос к коллектору: {e}")
+    finally:
+        writer.close()
+
+
+async def collect(host: str, port: int, output: str):
+    """Принимает OTLP/HTTP JSON (POST /v1/traces) от бота и дописывает спаны в output в формате JSONL."""
+    server = await asyncio.start_server(functools.partial(_handle_collect, output=output), host, port)
+    print(f"Коллектор трасс: http://{host}:{port}/v1/traces -> {output} (Ctrl+C - остановка)")
+    async with server:
+        await server.serve_forever()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Трассы чекина: отчет по этапам и локальный коллектор.")
+    commands = parser.add_subparsers(dest="command", required=True)
+    report = commands.add_parser("report", help="p50/p95/p99 по этапам из JSONL-выгрузки")
+    report.add_argument("path")
+    report.add_argument("--prefix", default="", help="только этапы с этим началом имени")
+    collector = commands.add_parser("collect", help="OTLP/HTTP-коллектор, пишущий спаны в JSONL")
+    collector.add_argument("--host", default="127.0.0.1")
+    collector.add_argument("--port", type=int, default=4318)
+    collector.add_argument("--output", default="traces.jsonl")
+    args = parser.parse_args()
+
+    if args.command == "report":
+        try:
+            print_report(args.path, args.prefix)
+        except OSError as e:
+            print(f"❌ {e}")
+            sys.exit(1)
+    else:
+        try:
+            asyncio.run(collect(args.host, args.port, args.output))
+        except KeyboardInterrupt:
+            pass
+
+
+if __name__ == "__main__":
+    main()
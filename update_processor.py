@@ -0,0 +1,65 @@
+# update_processor.py
+import asyncio
+import logging
+
+from telegram import Update
+from telegram.ext import BaseUpdateProcessor
+
+logger = logging.getLogger(__name__)
+
+
+class KeyedUpdateProcessor(BaseUpdateProcessor):
+    """
+    Параллельная обработка апдейтов с сохранением порядка для одного пользователя.
+    Апдейты разных пользователей выполняются одновременно (не больше max_running),
+    а апдейты одного пользователя (или чата, если пользователя нет) - строго по очереди,
+    как того требуют состояния ConversationHandler.
+
+    Семафор базового класса (process_update, его переопределять нельзя) ограничивает число
+    принятых апдейтов - max_pending, вместе с ожидающими очереди своего пользователя. Порядок
+    по ключу и ограничение одновременно выполняемых - в do_process_update: блокировка ключа
+    берется до слота выполнения, поэтому очередь одного пользователя не занимает слоты,
+    нужные другим.
+    """
+
+    def __init__(self, max_running: int, max_pending: int | None = None):
+        super().__init__(max(max_pending or 0, max_running))
+        self.max_running = max_running
+        self._running = asyncio.Semaphore(max_running)
+        self._key_locks: dict[int, list] = {}  # ключ -> [asyncio.Lock, число ожидающих и выполняющихся]
+
+    @staticmethod
+    def _key_for(update: object) -> int | None:
+        if isinstance(update, Update):
+            if update.effective_user:
+                return update.effective_user.id
+            if update.effective_chat:
+                return update.effective_chat.id
+        return None
+
+    async def do_process_update(self, update: object, coroutine) -> None:
+        key = self._key_for(update)
+        if key is None:
+            async with self._running:
+                await coroutine
+            return
+
+        entry = self._key_locks.get(key)
+        if entry is None:
+            entry = self._key_locks[key] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                async with self._running:
+                    await coroutine
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self._key_locks[key]
+
+    async def initialize(self) -> None:
+        logger.info(f"Параллельная обработка апдейтов: до {self.max_running} одновременно "
+                    f"(принято до {self.max_concurrent_updates}), порядок сохраняется по пользователю.")
+
+    async def shutdown(self) -> None:
+        pass
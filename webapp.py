@@ -1,19 +1,28 @@
 # webapp.py
 import logging
-import urllib.parse
-import hmac
-import hashlib
+import base64
 import json
 import config
 import database
 import re
-
-from fastapi import FastAPI, HTTPException
-from fastapi.responses import FileResponse
-from pydantic import BaseModel, field_validator
+import csv
+import report_grid
+import http_cache
+import webapp_auth
+import metrics
+import time as timer
+import asyncio
+import live_events
+
+from contextlib import asynccontextmanager
+from io import StringIO
+from fastapi import FastAPI, HTTPException, Query, Request
+from fastapi.responses import FileResponse, StreamingResponse
+from pydantic import BaseModel, Field, field_validator
 from typing import Dict, List, Optional
 
-from datetime import date, time
+from datetime import date, time, datetime
+from invalidation_bus import EMPLOYEE, SCHEDULE, HOLIDAY, CHECK_IN
 from database import add_leave_period, cancel_leave_period
 
 logging.basicConfig(level=logging.INFO)
@@ -25,12 +34,40 @@ class Employee(BaseModel):
     full_name: str
     is_active: bool
 
+class EmployeePage(BaseModel):
+    items: List[Employee]
+    next_cursor: Optional[str] = None   # Передается в cursor для следующей страницы; None - страниц больше нет
+    total: Optional[int] = None         # Только на первой странице
+    total_is_estimate: bool = False     # total - нижняя граница ("1000+")
+
+class EmployeeLogPage(BaseModel):
+    items: List[dict]
+    next_cursor: Optional[str] = None
+
+# Модели тяжелых ответов: с response_model FastAPI сериализует ответ сразу в JSON-байты через
+# pydantic-core, минуя jsonable_encoder (обход каждой ячейки матрицы на Python)
+class CompactMonthlyReport(BaseModel):
+    labels: List[str]   # Подписи статусов; код ячейки - индекс в этом списке
+    header: List[str]
+    names: List[str]
+    codes: List[str]    # Строка на сотрудника: символ на день, "0".."9" = 0..9, "a" = 10, "b" = 11 ...
+
+class RangeReportPage(BaseModel):
+    header: List[str]
+    rows: List[List[str]]
+    offset: int
+    limit: int
+    total: int
+
 class DeactivateRequest(BaseModel):
     id: int
 
 class AuthRequest(BaseModel):
     initData: str
 
+class UrlTokenRequest(BaseModel):
+    path: str
+
 class LeaveRequest(BaseModel):
     employee_id: int
     leave_type: str
@@ -66,8 +103,137 @@ class Holiday(BaseModel):
 class HolidayDeleteRequest(BaseModel):
     holiday_date: date
 
+# --- Пакетные запросы: элементы проверяются все сразу, применяются одной транзакцией ---
+class HolidayBatchRequest(BaseModel):
+    items: List[Holiday] = Field(min_length=1, max_length=config.BATCH_MAX_ITEMS)
+
+class DeactivateBatchRequest(BaseModel):
+    ids: List[int] = Field(min_length=1, max_length=config.BATCH_MAX_ITEMS)
+
+class LeaveBatchRequest(BaseModel):
+    items: List[LeaveRequest] = Field(min_length=1, max_length=config.BATCH_MAX_ITEMS)
+
+class EmployeeBatchUpdateRequest(BaseModel):
+    items: List[EmployeeUpdateRequest] = Field(min_length=1, max_length=config.BATCH_MAX_ITEMS)
+
+class BatchItemResult(BaseModel):
+    index: int              # Позиция элемента в запросе
+    status: str             # created / updated / deactivated / not_found
+    id: Optional[int] = None
+
+class BatchResult(BaseModel):
+    applied: int            # Сколько элементов изменило данные
+    results: List[BatchItemResult]
+
 # --- Создание FastAPI приложения ---
-app = FastAPI(title="Check-in Bot Admin Panel")
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Запуск по порядку: листенер метрик, кэши и шина инвалидации, встроенный бот; остановка - в обратном."""
+    await start_metrics_listener()
+    await load_caches()
+    if config.UPDATE_MODE == "webapp":
+        await start_embedded_bot()
+    try:
+        yield
+    finally:
+        if config.UPDATE_MODE == "webapp":
+            await stop_embedded_bot()
+        await close_cache_listeners()
+        await stop_metrics_listener()
+
+app = FastAPI(title="Check-in Bot Admin Panel", lifespan=lifespan)
+
+# --- НОВЫЙ БЛОК: HTTP-КЭШИРОВАНИЕ ЧТЕНИЙ (ETag по версиям сущностей, 304, Cache-Control) ---
+http_cache.install(app, [
+    http_cache.CacheRule(r"/", static_file="index.html"),
+    http_cache.CacheRule(r"/api/holidays/\d+", (HOLIDAY,)),
+    http_cache.CacheRule(r"/api/employees", (EMPLOYEE,)),
+    http_cache.CacheRule(r"/api/employees/\d+", (EMPLOYEE, SCHEDULE)),
+    http_cache.CacheRule(r"/api/employees/\d+/log(\.ndjson)?", (EMPLOYEE, CHECK_IN)),
+    http_cache.CacheRule(r"/api/reports/monthly/(?P<year>\d+)/(?P<month>\d+)", http_cache.ALL_ENTITIES, period_end=http_cache.month_end),
+    http_cache.CacheRule(r"/api/reports/range(/csv)?", http_cache.ALL_ENTITIES, period_end=http_cache.query_end_date),
+])
+# --- КОНЕЦ НОВОГО БЛОКА ---
+
+# --- НОВЫЙ БЛОК: СЕССИИ ВЕБ-ПАНЕЛИ (токен после /api/validate_user обязателен для всех /api/*) ---
+# EventSource и ссылка на скачивание не передают заголовки: для них - короткий токен в URL (POST /api/url_token)
+URL_TOKEN_PATHS = (r"/api/events", r"/api/employees/\d+/log\.ndjson")
+webapp_auth.install(app, public_paths=("/api/validate_user",), url_token_paths=URL_TOKEN_PATHS)
+# --- КОНЕЦ НОВОГО БЛОКА ---
+
+# --- НОВЫЙ БЛОК: МЕТРИКИ HTTP (подключается последним - замеряет и отказы авторизации, и ответы 304) ---
+HTTP_SECONDS = metrics.registry.histogram(
+    "checkin_http_request_seconds", "Обработка запросов веб-панели (до начала отдачи тела)", ("method", "route", "status")
+)
+metrics.registry.gauge("checkin_live_event_subscribers", "Подключенные клиенты живой ленты").set_function(
+    lambda: live_events.live_event_hub.subscriber_count
+)
+
+@app.middleware("http")
+async def http_metrics_middleware(request: Request, call_next):
+    started = timer.perf_counter()
+    response = await call_next(request)
+    # Метка - шаблон маршрута (/api/employees/{employee_id}), а не сам путь: число серий ограничено
+    route = request.scope.get("route")
+    HTTP_SECONDS.labels(request.method, route.path if route else "unmatched", response.status_code).observe(
+        timer.perf_counter() - started
+    )
+    return response
+
+# Метрики отдает внутренний листенер (METRICS_HOST:WEBAPP_METRICS_PORT), а не публичный сервер панели
+async def start_metrics_listener():
+    app.state.metrics_server = None
+    if not config.WEBAPP_METRICS_PORT:
+        return
+    try:
+        app.state.metrics_server = await metrics.serve(config.METRICS_HOST, config.WEBAPP_METRICS_PORT)
+    except OSError as e:
+        logger.warning(f"Не удалось открыть порт метрик {config.WEBAPP_METRICS_PORT}: {e}. Веб-панель работает без метрик.")
+
+async def stop_metrics_listener():
+    if app.state.metrics_server is not None:
+        app.state.metrics_server.close()
+        await app.state.metrics_server.wait_closed()
+# --- КОНЕЦ НОВОГО БЛОКА ---
+
+async def load_caches():
+    """
+    Заранее загружает кэши (праздники, активные сотрудники) и подписывается на шину инвалидации.
+    Шаги независимы: без календаря или кэша сотрудников панель все равно должна слушать инвалидации.
+    """
+    try:
+        await database.load_holiday_calendar()
+    except Exception as e:
+        logger.error(f"Не удалось загрузить календарь праздников при старте: {e}", exc_info=True)
+    try:
+        await database.load_employee_cache()
+    except Exception as e:
+        logger.error(f"Не удалось загрузить кэш сотрудников при старте: {e}", exc_info=True)
+    try:
+        await database.start_invalidation_bus()
+    except Exception as e:
+        logger.error(f"Не удалось подписаться на шину инвалидации при старте: {e}", exc_info=True)
+
+async def close_cache_listeners():
+    await database.stop_invalidation_bus()
+
+# --- НОВЫЙ БЛОК: БОТ ВНУТРИ ВЕБ-ПАНЕЛИ (UPDATE_MODE=webapp) ---
+if config.UPDATE_MODE == "webapp":
+    import webhook  # Бот (telegram, обработчики) грузится только в этом режиме
+    app.include_router(webhook.router)
+
+    async def start_embedded_bot():
+        """Запускает бота в этом же процессе; апдейты приходят через вебхук на этот же сервер."""
+        import main as bot_main  # Импорт только в этом режиме: тянет за собой распознавание лиц
+        app.state.bot_application = bot_main.build_application()
+        app.state.bot_scheduler = bot_main.build_scheduler(app.state.bot_application)
+        await bot_main.start_bot(app.state.bot_application, app.state.bot_scheduler, update_mode="webapp")
+
+    async def stop_embedded_bot():
+        import main as bot_main
+        await bot_main.stop_bot(app.state.bot_application, app.state.bot_scheduler)
+        bot_main.shutdown_executor()
+# --- КОНЕЦ НОВОГО БЛОКА ---
 
 # --- API Эндпоинты (точки доступа к данным) ---
 
@@ -102,36 +268,92 @@ async def delete_existing_holiday(request: HolidayDeleteRequest):
         raise HTTPException(status_code=500, detail="Ошибка сервера при удалении праздника.")
 # --- КОНЕЦ НОВЫХ ЭНДПОИНТОВ ---
 
+# --- Курсоры keyset-пагинации (список сотрудников, лог) ---
+def _encode_cursor(after: tuple) -> str:
+    return base64.urlsafe_b64encode(json.dumps(after, ensure_ascii=False).encode()).decode().rstrip('=')
+
+def _decode_cursor(cursor: str, parse) -> tuple:
+    """Курсор - ключ последней строки страницы (JSON-массив в base64url); parse проверяет и приводит типы."""
+    try:
+        return parse(json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))))
+    except (ValueError, TypeError):
+        raise HTTPException(status_code=400, detail="Некорректный курсор страницы.")
+
+def _parse_employee_cursor(sort_by: str):
+    def parse(values: list) -> tuple:
+        if sort_by == 'full_name':
+            full_name, telegram_id = values
+            return str(full_name), int(telegram_id)
+        (telegram_id,) = values
+        return (int(telegram_id),)
+    return parse
+
 # --- НОВЫЙ ЭНДПОИНТ ДЛЯ ПОЛУЧЕНИЯ ЛОГА ---
-@app.get("/api/employees/{employee_id}/log", response_model=List[dict])
-async def get_log_for_employee(employee_id: int, start_date: date, end_date: date):
-    """Возвращает детализированный лог событий для сотрудника."""
+def _parse_log_cursor(values: list) -> tuple:
+    timestamp, event_id = values
+    return datetime.fromisoformat(timestamp), int(event_id)
+
+@app.get("/api/employees/{employee_id}/log", response_model=EmployeeLogPage)
+async def get_log_for_employee(employee_id: int, start_date: date, end_date: date,
+                               limit: int = Query(100, ge=1, le=500), cursor: Optional[str] = None):
+    """Возвращает страницу лога событий сотрудника (от новых к старым); следующая - с cursor из ответа."""
+    if start_date > end_date:
+        raise HTTPException(status_code=400, detail="Начальная дата не может быть позже конечной.")
+    before = _decode_cursor(cursor, _parse_log_cursor) if cursor else None
     try:
-        if start_date > end_date:
-            raise HTTPException(status_code=400, detail="Начальная дата не может быть позже конечной.")
-        
-        log_data = await database.get_employee_log(employee_id, start_date, end_date)
-        return log_data
+        items, next_before = await database.get_employee_log_page(employee_id, start_date, end_date, limit=limit, before=before)
+        next_cursor = _encode_cursor((next_before[0].isoformat(), next_before[1])) if next_before else None
+        return EmployeeLogPage(items=items, next_cursor=next_cursor)
     except Exception as e:
         logger.error(f"Ошибка при получении лога для сотрудника {employee_id}: {e}", exc_info=True)
         raise HTTPException(status_code=500, detail="Внутренняя ошибка сервера")
+
+@app.get("/api/employees/{employee_id}/log.ndjson")
+async def stream_log_for_employee(employee_id: int, start_date: date, end_date: date):
+    """Отдает весь лог сотрудника за период потоком NDJSON (одно событие на строку) для длинных периодов."""
+    if start_date > end_date:
+        raise HTTPException(status_code=400, detail="Начальная дата не может быть позже конечной.")
+
+    async def generate_ndjson():
+        buffer = []
+        size = 0
+        async for entry in database.iter_employee_log(employee_id, start_date, end_date):
+            line = json.dumps(entry, ensure_ascii=False) + "\n"
+            buffer.append(line)
+            size += len(line)
+            if size >= 64 * 1024:
+                yield "".join(buffer)
+                buffer, size = [], 0
+        yield "".join(buffer)
+
+    return StreamingResponse(generate_ndjson(), media_type="application/x-ndjson")
 # --- КОНЕЦ НОВОГО ЭНДПОИНТА ---
 
 
-@app.get("/api/employees", response_model=List[Employee])
-async def get_employees(q: Optional[str] = None, sort_by: Optional[str] = 'full_name', sort_order: Optional[str] = 'asc'):
+@app.get("/api/employees", response_model=EmployeePage)
+async def get_employees(q: Optional[str] = None, sort_by: Optional[str] = 'full_name', sort_order: Optional[str] = 'asc',
+                        limit: int = Query(config.EMPLOYEE_PAGE_SIZE, ge=1, le=200), cursor: Optional[str] = None):
     """
-    Возвращает список всех активных сотрудников, используя database.py с поиском и сортировкой.
+    Возвращает страницу активных сотрудников с поиском и сортировкой (keyset-пагинация:
+    следующая страница запрашивается с cursor из ответа, сортировка должна совпадать).
     """
+    if sort_by not in ('telegram_id', 'full_name'):
+        sort_by = 'full_name'
+    after = _decode_cursor(cursor, _parse_employee_cursor(sort_by)) if cursor else None
     try:
-        # Передаем параметры из запроса в нашу функцию для работы с БД
-        db_employees = await database.get_all_active_employees(
-            search_query=q, 
-            sort_by=sort_by, 
-            sort_order=sort_order
+        page = await database.get_active_employees_page(
+            search_query=q,
+            sort_by=sort_by,
+            sort_order=sort_order,
+            limit=limit,
+            after=after
+        )
+        return EmployeePage(
+            items=[Employee(id=emp['telegram_id'], full_name=emp['full_name'], is_active=emp['is_active']) for emp in page['items']],
+            next_cursor=_encode_cursor(page['next_after']) if page['next_after'] else None,
+            total=page['total'],
+            total_is_estimate=page['total_is_estimate']
         )
-        # Преобразуем ответ БД в модель Pydantic
-        return [Employee(id=emp['telegram_id'], full_name=emp['full_name'], is_active=emp['is_active']) for emp in db_employees]
     except Exception as e:
         logger.error(f"Ошибка при получении списка сотрудников через API: {e}", exc_info=True)
         raise HTTPException(status_code=500, detail="Внутренняя ошибка сервера")
@@ -149,27 +371,34 @@ async def get_employee_details(employee_id: int):
         raise HTTPException(status_code=500, detail="Внутренняя ошибка сервера")
 
 # --- НОВЫЙ ЭНДПОИНТ для обновления сотрудника ---
+def _schedule_for_db(schedule: Dict[str, ScheduleData]) -> dict:
+    """
+    Преобразует график из формы (строки ЧЧ:ММ по дням "0".."6") в объекты time для функций БД.
+    Формат времени проверяет модель; неверный день недели - ValueError с понятным текстом.
+    """
+    schedule_for_db = {}
+    for day_index_str, times in schedule.items():
+        if not day_index_str.isdigit() or not 0 <= int(day_index_str) <= 6:
+            raise ValueError(f"Неверный день недели '{day_index_str}': ожидается число от 0 до 6.")
+        if times.start and times.end:
+            schedule_for_db[int(day_index_str)] = {
+                "start": time.fromisoformat(times.start),
+                "end": time.fromisoformat(times.end)
+            }
+        else:
+            schedule_for_db[int(day_index_str)] = {}  # Выходной
+    return schedule_for_db
+
 @app.post("/api/employees/update")
 async def update_employee(request: EmployeeUpdateRequest):
     """Обновляет данные сотрудника и его график (создает новую версию)."""
     try:
         # Эта логика полностью аналогична добавлению, т.к. add_or_update_employee
         # обрабатывает и создание, и обновление. Мы просто вызываем ту же функцию.
-        schedule_for_db = {}
-        for day_index_str, times in request.schedule.items():
-            day_index = int(day_index_str)
-            if times.start and times.end:
-                schedule_for_db[day_index] = {
-                    "start": time.fromisoformat(times.start),
-                    "end": time.fromisoformat(times.end)
-                }
-            else:
-                schedule_for_db[day_index] = {}
-
         await database.add_or_update_employee(
             telegram_id=request.telegram_id,
             full_name=request.full_name,
-            schedule_data=schedule_for_db,
+            schedule_data=_schedule_for_db(request.schedule),
             effective_date=request.effective_date
         )
         logger.info(f"Сотрудник {request.full_name} ({request.telegram_id}) обновлен через веб-интерфейс.")
@@ -185,22 +414,10 @@ async def update_employee(request: EmployeeUpdateRequest):
 async def add_employee(request: EmployeeUpdateRequest):
     """Добавляет нового сотрудника и его график."""
     try:
-        # Преобразуем schedule из строк в объекты time для функции БД
-        schedule_for_db = {}
-        for day_index_str, times in request.schedule.items():
-            day_index = int(day_index_str)
-            if times.start and times.end:
-                schedule_for_db[day_index] = {
-                    "start": time.fromisoformat(times.start),
-                    "end": time.fromisoformat(times.end)
-                }
-            else:
-                schedule_for_db[day_index] = {} # Выходной
-
         await database.add_or_update_employee(
             telegram_id=request.telegram_id,
             full_name=request.full_name,
-            schedule_data=schedule_for_db,
+            schedule_data=_schedule_for_db(request.schedule),
             effective_date=request.effective_date
         )
         logger.info(f"Сотрудник {request.full_name} ({request.telegram_id}) добавлен через веб-интерфейс.")
@@ -250,46 +467,246 @@ async def cancel_leave(request: LeaveRequest):
         logger.error(f"Ошибка при отмене периода отсутствия через API: {e}", exc_info=True)
         raise HTTPException(status_code=500, detail=f"Ошибка сервера: {e}")
 
-@app.get("/api/reports/monthly/{year}/{month}")
+# --- НОВЫЙ БЛОК: ПАКЕТНЫЕ ИЗМЕНЕНИЯ (массив элементов за один запрос и одну транзакцию) ---
+def _duplicate_errors(keys) -> list[dict]:
+    """Ошибки для элементов, ключ которых (дата, id сотрудника) уже встречался в пакете."""
+    first_index = {}
+    errors = []
+    for index, key in enumerate(keys):
+        if key in first_index:
+            errors.append({"index": index, "detail": f"Повторяет элемент {first_index[key]}."})
+        else:
+            first_index[key] = index
+    return errors
+
+def _raise_batch_errors(errors: list[dict]):
+    """Пакет с ошибками не применяется целиком: клиент получает 400 и ошибки по индексам элементов."""
+    if errors:
+        raise HTTPException(status_code=400, detail={
+            "message": "Пакет не применен: исправьте ошибки в элементах.",
+            "errors": sorted(errors, key=lambda error: error["index"])
+        })
+
+@app.post("/api/holidays/add/batch", response_model=BatchResult)
+async def add_holidays_batch(request: HolidayBatchRequest):
+    """Добавляет несколько праздничных дней (например, праздничную неделю) одним запросом."""
+    _raise_batch_errors(_duplicate_errors(item.holiday_date for item in request.items))
+    try:
+        inserted = await database.add_holidays_batch([(item.holiday_date, item.holiday_name) for item in request.items])
+    except Exception as e:
+        logger.error(f"Ошибка при пакетном добавлении праздников: {e}", exc_info=True)
+        raise HTTPException(status_code=500, detail="Ошибка сервера при добавлении праздников.")
+    results = [BatchItemResult(index=index, status="created" if inserted[item.holiday_date] else "updated")
+               for index, item in enumerate(request.items)]
+    return BatchResult(applied=len(results), results=results)
+
+@app.post("/api/employees/deactivate/batch", response_model=BatchResult)
+async def deactivate_employees_batch(request: DeactivateBatchRequest):
+    """Деактивирует нескольких сотрудников (например, целый отдел) одним запросом."""
+    try:
+        found = await database.set_employees_active_status_batch(list(set(request.ids)), is_active=False)
+    except Exception as e:
+        logger.error(f"Ошибка при пакетной деактивации сотрудников: {e}", exc_info=True)
+        raise HTTPException(status_code=500, detail="Ошибка на сервере при деактивации сотрудников.")
+    logger.info(f"Через веб-интерфейс деактивировано сотрудников: {len(found)}")
+    results = [BatchItemResult(index=index, id=employee_id, status="deactivated" if employee_id in found else "not_found")
+               for index, employee_id in enumerate(request.ids)]
+    return BatchResult(applied=len(found), results=results)
+
+@app.post("/api/leaves/add/batch", response_model=BatchResult)
+async def add_leaves_batch(request: LeaveBatchRequest):
+    """Назначает периоды отсутствия нескольким сотрудникам одним запросом (все или ни одного)."""
+    try:
+        existing = await database.get_existing_employee_ids(list({item.employee_id for item in request.items}))
+    except Exception as e:
+        logger.error(f"Ошибка при проверке сотрудников пакета отсутствий: {e}", exc_info=True)
+        raise HTTPException(status_code=500, detail="Ошибка сервера при добавлении периодов отсутствия.")
+    errors = []
+    for index, item in enumerate(request.items):
+        if item.start_date > item.end_date:
+            errors.append({"index": index, "detail": "Начальная дата не может быть позже конечной."})
+        if item.employee_id not in existing:
+            errors.append({"index": index, "detail": f"Сотрудник {item.employee_id} не найден."})
+    _raise_batch_errors(errors)
+    try:
+        await database.add_leave_periods_batch(
+            [(item.employee_id, item.start_date, item.end_date, item.leave_type) for item in request.items]
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    except Exception as e:
+        logger.error(f"Ошибка при пакетном добавлении периодов отсутствия: {e}", exc_info=True)
+        raise HTTPException(status_code=500, detail="Ошибка сервера при добавлении периодов отсутствия.")
+    results = [BatchItemResult(index=index, id=item.employee_id, status="created") for index, item in enumerate(request.items)]
+    return BatchResult(applied=len(results), results=results)
+
+@app.post("/api/employees/update/batch", response_model=BatchResult)
+async def update_employees_batch(request: EmployeeBatchUpdateRequest):
+    """Добавляет или обновляет нескольких сотрудников с графиками (новая версия графика) одним запросом."""
+    errors = _duplicate_errors(item.telegram_id for item in request.items)
+    employees = []
+    for index, item in enumerate(request.items):
+        try:
+            employees.append((item.telegram_id, item.full_name, _schedule_for_db(item.schedule), item.effective_date))
+        except ValueError as e:
+            errors.append({"index": index, "detail": str(e)})
+    _raise_batch_errors(errors)
+    try:
+        inserted = await database.add_or_update_employees_batch(employees)
+    except Exception as e:
+        logger.error(f"Ошибка при пакетном обновлении сотрудников: {e}", exc_info=True)
+        raise HTTPException(status_code=500, detail="Ошибка сервера при обновлении сотрудников.")
+    logger.info(f"Через веб-интерфейс добавлено/обновлено сотрудников: {len(inserted)}")
+    results = [BatchItemResult(index=index, id=item.telegram_id, status="created" if inserted[item.telegram_id] else "updated")
+               for index, item in enumerate(request.items)]
+    return BatchResult(applied=len(results), results=results)
+# --- КОНЕЦ НОВОГО БЛОКА ---
+
+@app.get("/api/reports/monthly/{year}/{month}", response_model=CompactMonthlyReport)
 async def get_monthly_report(year: int, month: int):
-    """Возвращает данные для сводного отчета за месяц, используя database.py."""
+    """Возвращает сводный отчет за месяц в компактном формате (коды ячеек и словарь подписей)."""
     try:
-        report_data = await database.get_monthly_summary_data(year, month)
-        if not report_data or len(report_data) <= 1:
+        report = await database.get_monthly_report_compact(year, month)
+        if not report or not report['names']:
             raise HTTPException(status_code=404, detail="Нет данных за указанный период")
-        return {"data": report_data}
+        return report
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Ошибка при формировании месячного отчета через API: {e}", exc_info=True)
         raise HTTPException(status_code=500, detail="Внутренняя ошибка сервера")
 
+# --- НОВЫЕ ЭНДПОИНТЫ: ОТЧЕТ ЗА ПРОИЗВОЛЬНЫЙ ПЕРИОД ---
+def _validate_report_range(start_date: date, end_date: date):
+    if start_date > end_date:
+        raise HTTPException(status_code=400, detail="Начальная дата не может быть позже конечной.")
+    if (end_date - start_date).days + 1 > config.REPORT_MAX_RANGE_DAYS:
+        raise HTTPException(status_code=400, detail=f"Период не может быть длиннее {config.REPORT_MAX_RANGE_DAYS} дней.")
+
+@app.get("/api/reports/range", response_model=RangeReportPage)
+async def get_range_report(start_date: date, end_date: date, offset: int = Query(0, ge=0), limit: int = Query(100, ge=1, le=1000)):
+    """Возвращает страницу матрицы посещаемости (сотрудники с offset по offset + limit) за произвольный период."""
+    _validate_report_range(start_date, end_date)
+    try:
+        rows = [row async for row in database.iter_attendance_rows(start_date, end_date, offset=offset, limit=limit)]
+        total = await database.count_active_employees()
+        return {
+            "header": report_grid.range_header(start_date, end_date),
+            "rows": rows,
+            "offset": offset,
+            "limit": limit,
+            "total": total,
+        }
+    except Exception as e:
+        logger.error(f"Ошибка при формировании отчета за период через API: {e}", exc_info=True)
+        raise HTTPException(status_code=500, detail="Внутренняя ошибка сервера")
+
+@app.get("/api/reports/range/csv")
+async def get_range_report_csv(start_date: date, end_date: date):
+    """Отдает матрицу посещаемости за период в CSV потоком, по мере расчета строк."""
+    _validate_report_range(start_date, end_date)
+
+    async def generate_csv():
+        buffer = StringIO()
+        writer = csv.writer(buffer)
+        writer.writerow(report_grid.range_header(start_date, end_date))
+        async for employee_row in database.iter_attendance_rows(start_date, end_date):
+            writer.writerow(employee_row)
+            if buffer.tell() >= 64 * 1024:
+                yield buffer.getvalue()
+                buffer.seek(0)
+                buffer.truncate()
+        yield buffer.getvalue()
+
+    filename = f"attendance_{start_date.isoformat()}_{end_date.isoformat()}.csv"
+    return StreamingResponse(
+        generate_csv(),
+        media_type="text/csv; charset=utf-8",
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'}
+    )
+# --- КОНЕЦ НОВЫХ ЭНДПОИНТОВ ---
+
 @app.post("/api/validate_user")
 async def validate_user(request: AuthRequest):
-    """Проверяет подлинность данных, полученных от Telegram Web App."""
+    """
+    Проверяет подлинность данных, полученных от Telegram Web App, и выдает токен сессии:
+    остальные /api/* запросы передают его в заголовке Authorization: Bearer <токен>.
+    """
     try:
-        init_data = request.initData
-        parsed_data = dict(urllib.parse.parse_qsl(init_data))
-        hash_from_telegram = parsed_data.pop('hash', '')
-        if not hash_from_telegram:
-            raise ValueError("Хэш отсутствует в initData")
-        
-        data_check_string = "\n".join(f"{k}={v}" for k, v in sorted(parsed_data.items()))
-        secret_key = hmac.new("WebAppData".encode(), config.BOT_TOKEN.encode(), hashlib.sha256).digest()
-        calculated_hash = hmac.new(secret_key, data_check_string.encode(), hashlib.sha256).hexdigest()
-        
-        if calculated_hash != hash_from_telegram:
-            raise HTTPException(status_code=403, detail="Проверка данных не пройдена.")
-        
-        user_info = json.loads(urllib.parse.unquote(parsed_data.get('user', '{}')))
-        user_id = user_info.get('id')
-        if user_id not in config.ADMIN_IDS:
-            raise HTTPException(status_code=403, detail="Доступ запрещен.")
-            
+        user_id = webapp_auth.init_data_validator.validate(request.initData)
+        token, expires = webapp_auth.issue_token(user_id)
         logger.info(f"Пользователь {user_id} успешно прошел авторизацию в веб-панели.")
-        return {"status": "ok", "user_id": user_id}
+        return {"status": "ok", "user_id": user_id, "token": token, "expires_at": expires}
+    except webapp_auth.AuthError as e:
+        logger.warning(f"Авторизация в веб-панели отклонена: {e}")
+        raise HTTPException(status_code=e.status_code, detail=str(e))
     except Exception as e:
         logger.error(f"Ошибка валидации пользователя: {e}", exc_info=True)
         raise HTTPException(status_code=400, detail="Некорректные данные для авторизации.")
 
+@app.post("/api/url_token")
+async def issue_url_token(request: UrlTokenRequest, http_request: Request):
+    """Выдает короткоживущий токен для ?token= одного пути (живая лента, скачивание журнала)."""
+    if not webapp_auth.matches_any(request.path, URL_TOKEN_PATHS):
+        raise HTTPException(status_code=400, detail="Для этого пути токен в ссылке не выдается.")
+    token, expires = webapp_auth.issue_url_token(http_request.state.user_id, request.path)
+    return {"token": token, "expires_at": expires}
+
+# --- НОВЫЙ БЛОК: ЖИВАЯ ЛЕНТА ДАШБОРДА (Server-Sent Events) ---
+_live_snapshot = {'key': None, 'data': None}
+
+async def _get_live_snapshot() -> str:
+    """Снимок дашборда на сегодня; пока данные не менялись, повторно для новых клиентов не считается."""
+    today = datetime.now(config.LOCAL_TIMEZONE).date()
+    key = (today, http_cache.entity_versions.snapshot(http_cache.ALL_ENTITIES))
+    if _live_snapshot['key'] != key:
+        stats = await database.get_dashboard_stats(today)
+        _live_snapshot.update(key=key, data=live_events.compact_snapshot(today, stats))
+    return _live_snapshot['data']
+
+@app.get("/api/events")
+async def stream_live_events(request: Request, last_event_id: Optional[str] = None):
+    """
+    Поток изменений посещаемости (приходы, уходы, отпуска, штрафы) в формате text/event-stream.
+    Новый клиент сначала получает событие snapshot; переподключившийся с Last-Event-ID
+    (заголовок EventSource или параметр last_event_id) - только пропущенные события.
+    """
+    hub = live_events.live_event_hub
+    subscriber, replay = hub.subscribe(request.headers.get("last-event-id") or last_event_id)
+    start_seq = hub.seq
+
+    async def generate():
+        try:
+            yield "retry: 3000\n\n"  # Пауза EventSource перед переподключением, мс
+            if replay is None:
+                try:
+                    snapshot = await _get_live_snapshot()
+                except Exception as e:
+                    logger.error(f"Ошибка при построении снимка дашборда: {e}", exc_info=True)
+                    return  # Клиент переподключится через retry
+                yield live_events.format_event(hub.event_id(start_seq), "snapshot", snapshot)
+            else:
+                for seq, event_type, data in replay:
+                    yield live_events.format_event(hub.event_id(seq), event_type, data)
+            while not subscriber.overflowed:
+                try:
+                    seq, event_type, data = await asyncio.wait_for(
+                        subscriber.queue.get(), timeout=config.LIVE_EVENTS_HEARTBEAT_SECONDS
+                    )
+                except asyncio.TimeoutError:
+                    yield ": ping\n\n"  # Не дает прокси закрыть простаивающее соединение
+                    continue
+                yield live_events.format_event(hub.event_id(seq), event_type, data)
+        finally:
+            hub.unsubscribe(subscriber)
+
+    return StreamingResponse(
+        generate(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+# --- КОНЕЦ НОВОГО БЛОКА ---
+
 # --- Эндпоинт для отдачи главной HTML страницы ---
 @app.get("/")
 async def read_root():
@@ -0,0 +1,180 @@
+# webapp_auth.py
+import base64
+import hashlib
+import hmac
+import json
+import logging
+import re
+import time as timer
+import urllib.parse
+from collections import OrderedDict
+from functools import lru_cache
+
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse
+
+import config
+
+logger = logging.getLogger(__name__)
+
+TOKEN_HEADER_PREFIX = "Bearer "
+# Токен в URL - только короткоживущий и привязанный к одному пути (EventSource, ссылки на скачивание, где
+# заголовок не передать): URL попадает в журналы доступа сервера и прокси, токен сессии туда попадать не должен
+TOKEN_QUERY_PARAM = "token"
+
+
+class AuthError(Exception):
+    """Данные авторизации веб-панели не прошли проверку; status_code - код ответа API."""
+
+    def __init__(self, message: str, status_code: int = 401):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+@lru_cache(maxsize=1)
+def _init_data_secret() -> bytes:
+    """Ключ проверки initData (HMAC от токена бота с ключом "WebAppData") - один раз на процесс."""
+    return hmac.new(b"WebAppData", config.BOT_TOKEN.encode(), hashlib.sha256).digest()
+
+
+@lru_cache(maxsize=1)
+def _session_secret() -> bytes:
+    """Ключ подписи сессионных токенов; выводится из токена бота, но отличается от ключа initData."""
+    return hmac.new(b"WebAppSession", config.BOT_TOKEN.encode(), hashlib.sha256).digest()
+
+
+@lru_cache(maxsize=1)
+def _url_token_secret() -> bytes:
+    """Отдельный ключ токенов для URL: такой токен нельзя выдать за токен сессии и наоборот."""
+    return hmac.new(b"WebAppUrlToken", config.BOT_TOKEN.encode(), hashlib.sha256).digest()
+
+
+class InitDataValidator:
+    """
+    Проверка initData от Telegram Web App. Хэши недавно проверенных initData хранятся в LRU:
+    повторная авторизация тем же initData (обновление сессии, перезагрузка страницы) не пересчитывает HMAC.
+    """
+
+    def __init__(self, max_entries: int = config.WEBAPP_INIT_DATA_CACHE_SIZE,
+                 max_age_seconds: int = config.WEBAPP_INIT_DATA_MAX_AGE_SECONDS):
+        self.max_entries = max_entries
+        self.max_age_seconds = max_age_seconds
+        self._validated = OrderedDict()  # hash -> (data_check_string, user_id, auth_date)
+
+    def validate(self, init_data: str) -> int:
+        """Возвращает telegram id администратора или бросает AuthError."""
+        parsed_data = dict(urllib.parse.parse_qsl(init_data))
+        hash_from_telegram = parsed_data.pop('hash', '')
+        if not hash_from_telegram:
+            raise AuthError("Хэш отсутствует в initData", status_code=400)
+
+        data_check_string = "\n".join(f"{k}={v}" for k, v in sorted(parsed_data.items()))
+        cached = self._validated.get(hash_from_telegram)
+        # Совпадение только хэша недостаточно: данные тоже должны быть теми же, что проверялись
+        if cached is not None and cached[0] == data_check_string:
+            self._validated.move_to_end(hash_from_telegram)
+            _, user_id, auth_date = cached
+        else:
+            calculated_hash = hmac.new(_init_data_secret(), data_check_string.encode(), hashlib.sha256).hexdigest()
+            if not hmac.compare_digest(calculated_hash, hash_from_telegram):
+                raise AuthError("Проверка данных не пройдена.", status_code=403)
+            user_id = json.loads(urllib.parse.unquote(parsed_data.get('user', '{}'))).get('id')
+            auth_date = int(parsed_data.get('auth_date', 0))
+            self._validated[hash_from_telegram] = (data_check_string, user_id, auth_date)
+            while len(self._validated) > self.max_entries:
+                self._validated.popitem(last=False)
+
+        if self.max_age_seconds and timer.time() - auth_date > self.max_age_seconds:
+            raise AuthError("Данные авторизации устарели, откройте панель заново.")
+        if user_id not in config.ADMIN_IDS:
+            raise AuthError("Доступ запрещен.", status_code=403)
+        return user_id
+
+
+def _b64(data: bytes) -> str:
+    return base64.urlsafe_b64encode(data).decode().rstrip('=')
+
+
+def issue_token(user_id: int, ttl_seconds: int = config.WEBAPP_SESSION_TTL_SECONDS) -> tuple[str, int]:
+    """Выдает подписанный токен сессии "id.срок.подпись"; возвращает (токен, срок в unix-времени)."""
+    expires = int(timer.time()) + ttl_seconds
+    payload = f"{user_id}.{expires}"
+    signature = hmac.new(_session_secret(), payload.encode(), hashlib.sha256).digest()[:16]
+    return f"{payload}.{_b64(signature)}", expires
+
+
+def verify_token(token: str) -> int:
+    """Проверяет подпись и срок токена (один HMAC по короткой строке); возвращает telegram id."""
+    try:
+        user_id, expires, signature = token.split('.')
+        user_id, expires = int(user_id), int(expires)
+    except ValueError:
+        raise AuthError("Некорректный токен сессии.")
+    expected = hmac.new(_session_secret(), f"{user_id}.{expires}".encode(), hashlib.sha256).digest()[:16]
+    if not hmac.compare_digest(_b64(expected), signature):
+        raise AuthError("Некорректный токен сессии.")
+    if expires < timer.time():
+        raise AuthError("Сессия истекла.")
+    if user_id not in config.ADMIN_IDS:
+        raise AuthError("Доступ запрещен.", status_code=403)
+    return user_id
+
+
+def _url_token_signature(user_id: int, expires: int, path: str) -> str:
+    return _b64(hmac.new(_url_token_secret(), f"{user_id}.{expires}.{path}".encode(), hashlib.sha256).digest()[:16])
+
+
+def issue_url_token(user_id: int, path: str, ttl_seconds: int = config.WEBAPP_URL_TOKEN_TTL_SECONDS) -> tuple[str, int]:
+    """Токен для параметра ?token= одного пути (без строки запроса); живет ttl_seconds."""
+    expires = int(timer.time()) + ttl_seconds
+    return f"{user_id}.{expires}.{_url_token_signature(user_id, expires, path)}", expires
+
+
+def verify_url_token(token: str, path: str) -> int:
+    """Проверяет токен из URL для этого пути; возвращает telegram id."""
+    try:
+        user_id, expires, signature = token.split('.')
+        user_id, expires = int(user_id), int(expires)
+    except ValueError:
+        raise AuthError("Некорректный токен ссылки.")
+    if not hmac.compare_digest(_url_token_signature(user_id, expires, path), signature):
+        raise AuthError("Некорректный токен ссылки.")
+    if expires < timer.time():
+        raise AuthError("Ссылка устарела.")
+    if user_id not in config.ADMIN_IDS:
+        raise AuthError("Доступ запрещен.", status_code=403)
+    return user_id
+
+
+def matches_any(path: str, patterns: tuple) -> bool:
+    return any(re.fullmatch(pattern, path) for pattern in patterns)
+
+
+def install(app: FastAPI, protected_prefix: str = "/api/", public_paths: tuple = (), url_token_paths: tuple = ()):
+    """
+    Подключает проверку сессии ко всем путям protected_prefix, кроме public_paths:
+    запрос без действительного токена получает 401/403, эндпоинт не вызывается.
+    Токен сессии принимается только из заголовка Authorization; пути из url_token_paths
+    (регулярные выражения) принимают вместо него ?token= с токеном issue_url_token для этого пути.
+    Подключать последним из middleware - тогда проверка выполняется первой (до кэша ответов).
+    """
+    @app.middleware("http")
+    async def session_auth_middleware(request: Request, call_next):
+        path = request.url.path
+        if not path.startswith(protected_prefix) or path in public_paths:
+            return await call_next(request)
+        authorization = request.headers.get("authorization", "")
+        url_token = request.query_params.get(TOKEN_QUERY_PARAM)
+        try:
+            if authorization.startswith(TOKEN_HEADER_PREFIX):
+                request.state.user_id = verify_token(authorization[len(TOKEN_HEADER_PREFIX):])
+            elif url_token and matches_any(path, url_token_paths):
+                request.state.user_id = verify_url_token(url_token, path)
+            else:
+                return JSONResponse(status_code=401, content={"detail": "Требуется авторизация."})
+        except AuthError as e:
+            return JSONResponse(status_code=e.status_code, content={"detail": str(e)})
+        return await call_next(request)
+
+
+init_data_validator = InitDataValidator()
@@ -0,0 +1,65 @@
+# webhook.py
+import hmac
+import logging
+
+from fastapi import APIRouter, FastAPI, HTTPException, Request
+from telegram import Update
+from telegram.ext import Application
+
+import config
+
+logger = logging.getLogger(__name__)
+
+SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+
+router = APIRouter()
+_application: Application | None = None
+
+
+def attach_application(application: Application):
+    """Привязывает к роутеру Application, в очередь которого складываются апдейты."""
+    global _application
+    _application = application
+
+
+@router.post(config.WEBHOOK_PATH, include_in_schema=False)
+async def telegram_webhook(request: Request):
+    """Принимает апдейт от Telegram, проверяет секретный токен и кладет апдейт в очередь Application."""
+    secret = request.headers.get(SECRET_HEADER, "")
+    if not config.WEBHOOK_SECRET_TOKEN or not hmac.compare_digest(secret, config.WEBHOOK_SECRET_TOKEN):
+        raise HTTPException(status_code=403, detail="Неверный секретный токен вебхука.")
+    if _application is None or not _application.running:
+        # 503 - Telegram повторит доставку позже
+        raise HTTPException(status_code=503, detail="Бот еще не запущен.")
+    try:
+        update = Update.de_json(await request.json(), _application.bot)
+    except Exception as e:
+        logger.error(f"Не удалось разобрать апдейт из вебхука: {e}", exc_info=True)
+        raise HTTPException(status_code=400, detail="Некорректный апдейт.")
+    # Отвечаем сразу: обработка идет в фоне, иначе Telegram ждет завершения хэндлера
+    await _application.update_queue.put(update)
+    return {"ok": True}
+
+
+async def register_webhook(application: Application):
+    """Регистрирует вебхук в Telegram (WEBHOOK_URL + WEBHOOK_PATH) с секретным токеном."""
+    if not config.WEBHOOK_URL or not config.WEBHOOK_SECRET_TOKEN:
+        raise ValueError("Для режима вебхука нужно задать WEBHOOK_URL и WEBHOOK_SECRET_TOKEN в файле .env.")
+    attach_application(application)
+    url = config.WEBHOOK_URL.rstrip('/') + config.WEBHOOK_PATH
+    await application.bot.set_webhook(url=url, secret_token=config.WEBHOOK_SECRET_TOKEN, allowed_updates=Update.ALL_TYPES)
+    logger.info(f"Вебхук зарегистрирован: {url}")
+
+
+async def serve_standalone(application: Application):
+    """Запускает отдельный ASGI-сервер только с вебхуком (режим UPDATE_MODE=webhook)."""
+    import uvicorn
+
+    attach_application(application)
+    asgi_app = FastAPI(title="Check-in Bot Webhook", docs_url=None, redoc_url=None, openapi_url=None)
+    asgi_app.include_router(router)
+    server = uvicorn.Server(uvicorn.Config(
+        asgi_app, host=config.WEBHOOK_LISTEN_HOST, port=config.WEBHOOK_LISTEN_PORT, log_level="warning"
+    ))
+    logger.info(f"Вебхук слушает {config.WEBHOOK_LISTEN_HOST}:{config.WEBHOOK_LISTEN_PORT}{config.WEBHOOK_PATH}")
+    await server.serve()